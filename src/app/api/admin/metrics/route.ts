@@ -9,6 +9,15 @@ const redis = new Redis({
   token: process.env.REDIS_TOKEN || 'local_token',
 })
 
+interface AutoscaleMetrics {
+  processes: number
+  target: number
+  scaleUps: number
+  scaleDowns: number
+  // Latest evaluation of each worker master (workers/common/autoscale.py), keyed by host:pid
+  masters: Record<string, any>
+}
+
 interface QueueMetrics {
   name: string
   waiting: number
@@ -17,6 +26,36 @@ interface QueueMetrics {
   failed: number
   delayed: number
   paused: boolean
+  autoscale?: AutoscaleMetrics
+}
+
+// Masters that haven't reported for this long are left out
+const AUTOSCALE_STALE_SECONDS = 60
+
+async function getAutoscaleMetrics(queueName: string): Promise<AutoscaleMetrics | undefined> {
+  const entries = await redis.hgetall<Record<string, any>>(`autoscale:${queueName}`)
+  if (!entries) {
+    return undefined
+  }
+  const now = Date.now() / 1000
+  const masters: Record<string, any> = {}
+  for (const [instance, value] of Object.entries(entries)) {
+    const status = typeof value === 'string' ? JSON.parse(value) : value
+    if (status && now - status.updatedAt <= AUTOSCALE_STALE_SECONDS) {
+      masters[instance] = status
+    }
+  }
+  const statuses = Object.values(masters)
+  if (statuses.length === 0) {
+    return undefined
+  }
+  return {
+    processes: statuses.reduce((sum, status) => sum + status.processes, 0),
+    target: statuses.reduce((sum, status) => sum + status.target, 0),
+    scaleUps: statuses.reduce((sum, status) => sum + status.scaleUps, 0),
+    scaleDowns: statuses.reduce((sum, status) => sum + status.scaleDowns, 0),
+    masters
+  }
 }
 
 interface SystemMetrics {
@@ -115,7 +154,8 @@ export async function GET(request: NextRequest): Promise<NextResponse> {
         const active = await redis.llen(`${queueName}:active`) || 0
         const completed = await redis.llen(`${queueName}:completed`) || 0
         const failed = await redis.llen(`${queueName}:failed`) || 0
-        const delayed = await redis.llen(`${queueName}:delayed`) || 0
+        // Delayed retries live in a sorted set scored by their next attempt time
+        const delayed = await redis.zcard(`${queueName}:delayed`) || 0
         
         const queueMetrics: QueueMetrics = {
           name: queueName,
@@ -124,7 +164,8 @@ export async function GET(request: NextRequest): Promise<NextResponse> {
           completed: Number(completed),
           failed: Number(failed),
           delayed: Number(delayed),
-          paused: false // Would need additional Redis key to track this
+          paused: false, // Would need additional Redis key to track this
+          autoscale: await getAutoscaleMetrics(queueName)
         }
         
         metrics.queues.push(queueMetrics)
@@ -1,5 +1,5 @@
 import { NextRequest, NextResponse } from 'next/server'
-import { queueManager } from '@/lib/queue'
+import { queueManager, getConverterSpec, getPipelineEntry, getPipelineTarget, validateOutputs, PIPELINE } from '@/lib/queue'
 import { storageManager } from '@/lib/storage'
 import { validateFile } from '@/lib/validation'
 import { rateLimitMiddleware } from '@/lib/rate-limit'
@@ -24,13 +24,49 @@ export async function POST(request: NextRequest) {
       )
     }
 
+    // A pipeline is validated against the converter that receives the upload
+    const sourceExtension = file.name.split('.').pop()?.toLowerCase() || ''
+    const entryConverter = converter === PIPELINE
+      ? getPipelineEntry(options, sourceExtension)
+      : converter
+
+    if (!entryConverter || !getConverterSpec(entryConverter)) {
+      return NextResponse.json(
+        { error: converter === PIPELINE ? 'No pipeline step accepts this file' : `Unsupported converter: ${converter}` },
+        { status: 400 }
+      )
+    }
+
+    if (options.outputs !== undefined) {
+      const outputsError = validateOutputs(converter, options.outputs)
+      if (outputsError) {
+        return NextResponse.json(
+          { error: outputsError },
+          { status: 400 }
+        )
+      }
+    }
+
+    // Turn the upload away while its queue is past the latency budget
+    const admission = await queueManager.checkAdmission(converter, options, sourceExtension)
+    if (!admission.admitted) {
+      return NextResponse.json(
+        {
+          error: 'Conversion queue is busy, please try again later',
+          retryAfter: admission.retryAfterSeconds,
+          estimatedWaitSeconds: admission.waitSeconds
+        },
+        { status: 503, headers: { 'Retry-After': String(admission.retryAfterSeconds) } }
+      )
+    }
+
     // Enhanced file validation with magic bytes
     const validationResult = await validateFile(file, {
       maxSize: 512 * 1024 * 1024, // 512MB
       allowedTypes: [], // Will be checked by magic bytes
       allowedExtensions: [], // Will be checked by magic bytes
       checkMagicBytes: true,
-      converterId: converter
+      converterId: entryConverter
     })
 
     if (!validationResult.isValid) {
@@ -44,8 +80,19 @@ export async function POST(request: NextRequest) {
     const inputKey = await storageManager.uploadFile(file, 'input')
     
     // Generate output key
-    const outputExtension = getOutputExtension(converter, file.name)
-    const outputKey = storageManager.generateKey('output', outputExtension)
+    const outputExtension = converter === PIPELINE
+      ? getPipelineTarget(options, sourceExtension) || 'bin'
+      : getOutputExtension(converter, file.name)
+    const outputKey = storageManager.generateKey('output', options.outputs ? options.outputs[0].format : outputExtension)
+
+    // Every listed output gets a key of its own; the first is the job's output
+    if (options.outputs) {
+      options.outputs = options.outputs.map((output: { format: string; bitrate?: string }, index: number) => ({
+        format: output.format,
+        bitrate: output.bitrate,
+        key: index === 0 ? outputKey : storageManager.generateKey('output', output.format)
+      }))
+    }
 
     // Create conversion job
     const jobId = await queueManager.createJob(converter, inputKey, outputKey, options)
@@ -55,6 +102,7 @@ export async function POST(request: NextRequest) {
       jobId,
       status: 'pending',
       progress: 0,
+      estimatedTimeRemaining: admission.etaSeconds ?? null,
       message: 'Conversion started. Use jobId to check status and get download URL.'
     })
 
@@ -91,6 +139,8 @@ function getOutputExtension(converter: string, inputFileName: string): string {
       return 'jpg'
     case 'svg-to-png':
       return 'png'
+    case 'jpg-to-pdf':
+      return 'pdf'
     case 'remove-background':
       return 'png'
     case 'image-upscaler':
@@ -38,7 +38,7 @@ export async function GET(request: NextRequest) {
       )
     }
 
-    if (job.outputKey !== key) {
+    if (job.outputKey !== key && !job.outputKeys?.includes(key)) {
       return NextResponse.json(
         { error: 'Invalid download key' },
         { status: 403 }
@@ -52,8 +52,22 @@ export async function GET(request: NextRequest) {
     
     console.log(`Download requested: jobId=${jobId}, key=${key}, ip=${clientIP}, userAgent=${userAgent}, referer=${referer}`)
 
+    // Locally stored outputs are served by this route itself
+    if (storageManager.isLocal(key) && searchParams.get('stream') === '1') {
+      const { stream, size } = await storageManager.readLocalFile(key)
+      return new NextResponse(stream, {
+        headers: {
+          'Content-Type': 'application/octet-stream',
+          'Content-Length': String(size),
+          'Content-Disposition': `attachment; filename="${key.split('/').pop() || 'download'}"`
+        }
+      })
+    }
+
     // Generate short-lived signed URL (5 minutes max)
-    const downloadUrl = await storageManager.getFileUrl(key, 300) // 5 minutes
+    const downloadUrl = storageManager.isLocal(key)
+      ? `/api/download?key=${encodeURIComponent(key)}&jobId=${encodeURIComponent(jobId)}&stream=1`
+      : await storageManager.getFileUrl(key, 300) // 5 minutes
     
     // Log successful download generation
     console.log(`Download URL generated for jobId=${jobId}, expires in 5 minutes`)
@@ -0,0 +1,135 @@
+import { NextRequest, NextResponse } from 'next/server'
+import { queueManager } from '@/lib/queue'
+import { jobEventHub, JobEvent } from '@/lib/job-events'
+import { rateLimitMiddleware } from '@/lib/rate-limit'
+
+export const dynamic = 'force-dynamic'
+
+// Comment lines keep proxies from closing an idle stream
+const HEARTBEAT_MS = 15000
+// Streams are recycled after this long; EventSource reconnects with Last-Event-ID
+const MAX_STREAM_MS = 5 * 60 * 1000
+
+const TERMINAL_STATUSES = ['completed', 'failed']
+
+/**
+ * Server-sent job progress: the current state first, then every event the
+ * workers publish until the job completes or fails.
+ */
+export async function GET(
+  request: NextRequest,
+  { params }: { params: { jobId: string } }
+) {
+  // Apply rate limiting
+  const rateLimitResponse = await rateLimitMiddleware(request, 'status')
+  if (rateLimitResponse) {
+    return rateLimitResponse
+  }
+
+  try {
+    const { jobId } = params
+
+    // Read the newest event ID before the hash, so nothing between the two is skipped
+    const resumeFrom = request.headers.get('last-event-id')
+    const lastId = resumeFrom || await jobEventHub.latestId(jobId)
+
+    const job = await queueManager.getJobStatus(jobId)
+    if (!job) {
+      return NextResponse.json(
+        { error: 'Job not found' },
+        { status: 404 }
+      )
+    }
+
+    const encoder = new TextEncoder()
+    let cleanup = () => {}
+
+    const stream = new ReadableStream({
+      async start(controller) {
+        let closed = false
+        let unsubscribe = () => {}
+        let heartbeat: ReturnType<typeof setInterval> | undefined
+        let expiry: ReturnType<typeof setTimeout> | undefined
+
+        cleanup = () => {
+          if (closed) {
+            return
+          }
+          closed = true
+          unsubscribe()
+          clearInterval(heartbeat)
+          clearTimeout(expiry)
+          try {
+            controller.close()
+          } catch (error) {
+            // Already closed by the client
+          }
+        }
+
+        const send = (data: Record<string, any>, id?: string) => {
+          if (closed) {
+            return
+          }
+          if (data.status === 'completed' && job.outputKey) {
+            data.downloadEndpoint = `/api/download?key=${job.outputKey}&jobId=${jobId}`
+          }
+          const idLine = id ? `id: ${id}\n` : ''
+          controller.enqueue(encoder.encode(`${idLine}data: ${JSON.stringify(data)}\n\n`))
+          if (TERMINAL_STATUSES.includes(data.status)) {
+            cleanup()
+          }
+        }
+
+        controller.enqueue(encoder.encode('retry: 2000\n\n'))
+        if (!resumeFrom) {
+          send({
+            status: job.status,
+            progress: job.progress || 0,
+            // Queued jobs get an ETA from the queue's published estimate
+            eta: job.status === 'pending' ? await queueManager.estimateJob(job) : job.estimatedTimeRemaining,
+            error: job.error || undefined
+          })
+        }
+        if (closed) {
+          return
+        }
+
+        unsubscribe = await jobEventHub.subscribe(jobId, lastId, (event: JobEvent) => {
+          const { id, ...data } = event
+          send(data, id)
+        })
+        if (closed) {
+          unsubscribe()
+          return
+        }
+
+        heartbeat = setInterval(() => {
+          if (!closed) {
+            controller.enqueue(encoder.encode(': keepalive\n\n'))
+          }
+        }, HEARTBEAT_MS)
+        expiry = setTimeout(cleanup, MAX_STREAM_MS)
+        request.signal.addEventListener('abort', cleanup)
+      },
+      cancel() {
+        cleanup()
+      }
+    })
+
+    return new Response(stream, {
+      headers: {
+        'Content-Type': 'text/event-stream',
+        'Cache-Control': 'no-cache, no-transform',
+        'Connection': 'keep-alive',
+        'X-Accel-Buffering': 'no'
+      }
+    })
+
+  } catch (error) {
+    console.error('Status stream error:', error)
+    return NextResponse.json(
+      { error: 'Internal server error' },
+      { status: 500 }
+    )
+  }
+}
@@ -35,7 +35,19 @@ export async function GET(
       updatedAt: new Date().toISOString()
     }
 
+    // Queued jobs get an ETA from the queue's published estimate
+    if (job.status === 'pending') {
+      response.queueDetails = {
+        estimatedTimeRemaining: (await queueManager.estimateJob(job)) ?? null
+      }
+    }
+
     // Add detailed progress information
+    if (job.status === 'uploading' && job.outputKeys) {
+      response.outputsReady = job.outputsReady || 0
+      response.outputsTotal = job.outputKeys.length
+    }
+
     if (job.status === 'processing') {
       response.processingDetails = {
         stage: job.stage || 'converting',
@@ -50,6 +62,9 @@ export async function GET(
       response.downloadEndpoint = `/api/download?key=${job.outputKey}&jobId=${jobId}`
       response.outputSize = job.outputSize || null
       response.processingTime = job.processingTime || null
+      if (job.outputKeys) {
+        response.downloadEndpoints = job.outputKeys.map(key => `/api/download?key=${key}&jobId=${jobId}`)
+      }
     }
 
     // Add retry information if applicable
@@ -1,5 +1,6 @@
 import { NextRequest, NextResponse } from 'next/server'
 import { storageManager } from '@/lib/storage'
+import { queueManager, getConverterSpec, PIPELINE } from '@/lib/queue'
 import { rateLimitMiddleware } from '@/lib/rate-limit'
 import { v4 as uuidv4 } from 'uuid'
 
@@ -11,7 +12,7 @@ export async function POST(request: NextRequest) {
   }
 
   try {
-    const { fileName, fileType, fileSize } = await request.json()
+    const { fileName, fileType, fileSize, converter, options } = await request.json()
 
     if (!fileName || !fileType || !fileSize) {
       return NextResponse.json(
@@ -31,6 +32,27 @@ export async function POST(request: NextRequest) {
 
     // Generate unique key
     const fileExtension = fileName.split('.').pop()?.toLowerCase()
+
+    // When the converter is known, check the queue before the client spends time uploading
+    let etaSeconds: number | undefined
+    if (converter && (converter === PIPELINE || getConverterSpec(converter))) {
+      try {
+        const admission = await queueManager.checkAdmission(converter, options || {}, fileExtension || '')
+        if (!admission.admitted) {
+          return NextResponse.json(
+            {
+              error: 'Conversion queue is busy, please try again later',
+              retryAfter: admission.retryAfterSeconds,
+              estimatedWaitSeconds: admission.waitSeconds
+            },
+            { status: 503, headers: { 'Retry-After': String(admission.retryAfterSeconds) } }
+          )
+        }
+        etaSeconds = admission.etaSeconds
+      } catch (error) {
+        // A pipeline without a step for this file is rejected later by /api/convert
+      }
+    }
     const key = storageManager.generateKey('input', fileExtension || 'bin')
 
     // Generate presigned URL for direct upload to R2
@@ -47,7 +69,8 @@ export async function POST(request: NextRequest) {
         'Content-Type': fileType,
         'Content-Length': fileSize.toString()
       },
-      expiresIn: 3600 // 1 hour
+      expiresIn: 3600, // 1 hour
+      estimatedTimeRemaining: etaSeconds ?? null
     })
 
   } catch (error) {
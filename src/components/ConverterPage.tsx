@@ -216,8 +216,8 @@ export default function ConverterPage({ config, locale }: ConverterPageProps) {
           })
         )
 
-        // Start polling for job status
-        pollJobStatus(fileItem.id, result.jobId)
+        // Follow the job's progress
+        watchJobStatus(fileItem.id, result.jobId)
 
       } catch (error) {
         const errorMessage = error instanceof Error ? error.message : 'Upload failed'
@@ -269,6 +269,45 @@ export default function ConverterPage({ config, locale }: ConverterPageProps) {
     }
   }, [config.id])
 
+  const applyJobStatus = useCallback((fileId: string, status: any) => {
+    setFiles(prev => prev.map(f => {
+      if (f.id === fileId) {
+        const newFile = { ...f }
+        
+        switch (status.status) {
+          case 'pending':
+            newFile.status = 'processing'
+            newFile.progress = 10
+            break
+          case 'downloading':
+            newFile.status = 'processing'
+            newFile.progress = 20
+            break
+          case 'processing':
+            newFile.status = 'processing'
+            newFile.progress = status.progress || 50
+            break
+          case 'uploading':
+            newFile.status = 'processing'
+            newFile.progress = 80
+            break
+          case 'completed':
+            newFile.status = 'completed'
+            newFile.progress = 100
+            newFile.downloadUrl = status.downloadUrl
+            break
+          case 'failed':
+            newFile.status = 'error'
+            newFile.error = status.error || 'Conversion failed'
+            break
+        }
+        
+        return newFile
+      }
+      return f
+    }))
+  }, [])
+
   const pollJobStatus = useCallback(async (fileId: string, jobId: string) => {
     const pollInterval = setInterval(async () => {
       try {
@@ -278,45 +317,7 @@ export default function ConverterPage({ config, locale }: ConverterPageProps) {
         }
 
         const status = await response.json()
-        
-        setFiles(prev => prev.map(f => {
-          if (f.id === fileId) {
-            const newFile = { ...f }
-            
-            switch (status.status) {
-              case 'pending':
-                newFile.status = 'processing'
-                newFile.progress = 10
-                break
-              case 'downloading':
-                newFile.status = 'processing'
-                newFile.progress = 20
-                break
-              case 'processing':
-                newFile.status = 'processing'
-                newFile.progress = 50
-                break
-              case 'uploading':
-                newFile.status = 'processing'
-                newFile.progress = 80
-                break
-              case 'completed':
-                newFile.status = 'completed'
-                newFile.progress = 100
-                newFile.downloadUrl = status.downloadUrl
-                clearInterval(pollInterval)
-                break
-              case 'failed':
-                newFile.status = 'error'
-                newFile.error = status.error || 'Conversion failed'
-                clearInterval(pollInterval)
-                break
-            }
-            
-            return newFile
-          }
-          return f
-        }))
+        applyJobStatus(fileId, status)
 
         // Stop polling if job is completed or failed
         if (status.status === 'completed' || status.status === 'failed') {
@@ -335,7 +336,35 @@ export default function ConverterPage({ config, locale }: ConverterPageProps) {
 
     // Cleanup interval after 5 minutes
     setTimeout(() => clearInterval(pollInterval), 300000)
-  }, [])
+  }, [applyJobStatus])
+
+  // Progress is pushed over server-sent events; polling is the fallback when no stream can be opened
+  const watchJobStatus = useCallback((fileId: string, jobId: string) => {
+    if (typeof EventSource === 'undefined') {
+      pollJobStatus(fileId, jobId)
+      return
+    }
+
+    const source = new EventSource(`/api/status/${jobId}/events`)
+    let received = false
+
+    source.onmessage = (message) => {
+      received = true
+      const status = JSON.parse(message.data)
+      applyJobStatus(fileId, status)
+      if (status.status === 'completed' || status.status === 'failed') {
+        source.close()
+      }
+    }
+
+    source.onerror = () => {
+      // Once a stream has worked EventSource reconnects by itself, resuming after the last event
+      if (!received) {
+        source.close()
+        pollJobStatus(fileId, jobId)
+      }
+    }
+  }, [applyJobStatus, pollJobStatus])
 
   const handleDrop = useCallback((e: React.DragEvent) => {
     e.preventDefault()
@@ -0,0 +1,162 @@
+import Redis from 'ioredis'
+
+// Per-job progress streams written next to the job hash (workers/common/progress.py)
+export const JOB_EVENTS_MAXLEN = parseInt(process.env.JOB_EVENTS_MAXLEN || '100')
+export const JOB_EVENTS_TTL_SECONDS = parseInt(process.env.JOB_EVENTS_TTL_SECONDS || '3600')
+
+// How long one XREAD waits; new subscriptions join the read after at most this long
+const READ_BLOCK_MS = 1000
+
+export interface JobEvent {
+  id: string
+  status: string
+  progress: number
+  eta?: number
+  error?: string
+}
+
+type Listener = (event: JobEvent) => void
+
+interface Subscription {
+  lastId: string
+  listener: Listener
+}
+
+/** Stream key of a job's events; kept outside job:* so hash scans skip it */
+export function jobEventsKey(jobId: string): string {
+  return `job-events:${jobId}`
+}
+
+/** Order of two stream IDs ("<ms>-<seq>") */
+function compareIds(a: string, b: string): number {
+  const [aMs, aSeq] = a.split('-').map(Number)
+  const [bMs, bSeq] = b.split('-').map(Number)
+  return aMs - bMs || (aSeq || 0) - (bSeq || 0)
+}
+
+function parseEvent(id: string, fields: string[]): JobEvent {
+  const values: Record<string, string> = {}
+  for (let i = 0; i < fields.length; i += 2) {
+    values[fields[i]] = fields[i + 1]
+  }
+  const event: JobEvent = {
+    id,
+    status: values.status,
+    progress: parseInt(values.progress || '0')
+  }
+  if (values.eta !== undefined) {
+    event.eta = parseInt(values.eta)
+  }
+  if (values.error) {
+    event.error = values.error
+  }
+  return event
+}
+
+/**
+ * Fans job progress streams out to SSE clients. Every subscription in this
+ * process shares one blocking XREAD connection, so open tabs cost neither a
+ * Redis connection nor a poll each.
+ */
+export class JobEventHub {
+  private redis: Redis
+  private reader: Redis | null = null
+  private subscriptions = new Map<string, Set<Subscription>>()
+  // Stream key -> ID the shared read continues after
+  private cursors = new Map<string, string>()
+  private reading = false
+
+  constructor() {
+    this.redis = new Redis(process.env.REDIS_URL || 'redis://localhost:6379')
+  }
+
+  /** ID of a job's newest event, '0' when it has none yet */
+  async latestId(jobId: string): Promise<string> {
+    const newest = await this.redis.xrevrange(jobEventsKey(jobId), '+', '-', 'COUNT', 1)
+    return newest.length > 0 ? newest[0][0] : '0'
+  }
+
+  /**
+   * Deliver a job's events after lastId, in order, until unsubscribed.
+   * Events already in the stream are replayed first.
+   */
+  async subscribe(jobId: string, lastId: string, listener: Listener): Promise<() => void> {
+    const key = jobEventsKey(jobId)
+    const subscription: Subscription = { lastId, listener }
+
+    const backlog = await this.redis.xrange(key, `(${lastId}`, '+')
+    for (const [id, fields] of backlog) {
+      this.deliver(subscription, parseEvent(id, fields))
+    }
+
+    if (!this.subscriptions.has(key)) {
+      this.subscriptions.set(key, new Set())
+      this.cursors.set(key, subscription.lastId)
+    }
+    this.subscriptions.get(key)!.add(subscription)
+    this.startReading()
+
+    return () => {
+      const subscribers = this.subscriptions.get(key)
+      subscribers?.delete(subscription)
+      if (subscribers && subscribers.size === 0) {
+        this.subscriptions.delete(key)
+        this.cursors.delete(key)
+      }
+    }
+  }
+
+  private deliver(subscription: Subscription, event: JobEvent) {
+    // The shared read may start behind a subscriber's replayed backlog
+    if (compareIds(event.id, subscription.lastId) <= 0) {
+      return
+    }
+    subscription.lastId = event.id
+    subscription.listener(event)
+  }
+
+  private startReading() {
+    if (this.reading) {
+      return
+    }
+    this.reading = true
+    this.read()
+      .catch(error => console.error('Job event reader error:', error))
+      .finally(() => {
+        this.reading = false
+        // Subscriptions left after an error (or arriving as the read wound down) get a fresh read
+        if (this.subscriptions.size > 0) {
+          setTimeout(() => this.startReading(), READ_BLOCK_MS)
+        }
+      })
+  }
+
+  private async read(): Promise<void> {
+    if (!this.reader) {
+      // Blocking reads need a connection of their own
+      this.reader = this.redis.duplicate()
+    }
+    while (this.subscriptions.size > 0) {
+      const keys = Array.from(this.cursors.keys())
+      const ids = keys.map(key => this.cursors.get(key)!)
+      const results = await this.reader.xread('COUNT', JOB_EVENTS_MAXLEN, 'BLOCK', READ_BLOCK_MS, 'STREAMS', ...keys, ...ids)
+      if (!results) {
+        continue
+      }
+      for (const [key, entries] of results) {
+        if (entries.length === 0 || !this.cursors.has(key)) {
+          continue
+        }
+        this.cursors.set(key, entries[entries.length - 1][0])
+        for (const [id, fields] of entries) {
+          const event = parseEvent(id, fields)
+          for (const subscription of Array.from(this.subscriptions.get(key) || [])) {
+            this.deliver(subscription, event)
+          }
+        }
+      }
+    }
+  }
+}
+
+export const jobEventHub = new JobEventHub()
@@ -148,6 +148,7 @@ export function validateFileType(buffer: Buffer, converterId: string): { isValid
     'heic-to-jpg': ['image/heic', 'image/heif'],
     'webp-to-jpg': ['image/webp'],
     'svg-to-png': ['image/svg+xml'],
+    'jpg-to-pdf': ['image/jpeg', 'image/png'],
     'bmp-to-jpg': ['image/bmp'],
     'tiff-to-jpg': ['image/tiff'],
     'jpg-to-webp': ['image/jpeg'],
@@ -160,7 +161,7 @@ export function validateFileType(buffer: Buffer, converterId: string): { isValid
     'resize-image': ['image/jpeg', 'image/png', 'image/webp'],
     
     // Audio converters
-    'mp4-to-mp3': ['video/mp4'],
+    'mp4-to-mp3': ['video/mp4', 'video/quicktime'],
     'wav-to-mp3': ['audio/wav'],
     'mp3-to-wav': ['audio/mpeg'],
     'aac-to-mp3': ['audio/mpeg'], // AAC files often have MP3-like headers
@@ -1,5 +1,7 @@
 import Redis from 'ioredis'
 import { v4 as uuidv4 } from 'uuid'
+import converterRegistry from '../../workers/common/converters.json'
+import { JOB_EVENTS_MAXLEN, JOB_EVENTS_TTL_SECONDS, jobEventsKey } from './job-events'
 
 const redis = new Redis(process.env.REDIS_URL || 'redis://localhost:6379')
 
@@ -10,9 +12,145 @@ export interface ConversionJob {
   outputKey: string
   options?: Record<string, any>
   createdAt: string
-  status: 'pending' | 'downloading' | 'processing' | 'uploading' | 'completed' | 'failed'
+  status: 'pending' | 'downloading' | 'processing' | 'uploading' | 'retrying' | 'completed' | 'failed'
   progress: number
   error?: string
+  estimatedTimeRemaining?: number
+  retryAttempt?: number
+  maxRetries?: number
+  nextRetryAt?: string
+  currentStep?: number
+  totalSteps?: number
+  stepConverter?: string
+  // Every output of a multi-output job, outputKey first
+  outputKeys?: string[]
+  outputsReady?: number
+}
+
+export interface ConverterSpec {
+  from: string[]
+  to?: string
+  transform?: boolean
+  queue: string
+  tools: string[]
+  cost: 'light' | 'medium' | 'heavy'
+  memoryMb: number
+  memoryPerMb?: number
+  memoryPerMegapixel?: number
+}
+
+// Declared once and shared with the workers, which dispatch from the same file
+const converters = converterRegistry.converters as Record<string, ConverterSpec>
+const formatAliases = converterRegistry.formatAliases as Record<string, string>
+const queueNames = Object.keys(converterRegistry.queues)
+
+// Multi-step job; the worker plans and runs the chain without intermediate uploads
+export const PIPELINE = 'pipeline'
+
+export interface PipelineStep {
+  converter: string
+  options?: Record<string, any>
+}
+
+// Converters that encode several audio outputs from one decode (workers/av/worker.py)
+export const MULTI_OUTPUT_CONVERTERS = ['mp4-to-mp3', 'wav-to-mp3']
+export const AUDIO_OUTPUT_FORMATS = ['mp3', 'aac', 'm4a', 'wav', 'flac']
+export const MAX_AUDIO_OUTPUTS = 4
+
+export interface AudioOutput {
+  format: string
+  bitrate?: string
+  // Storage key, assigned by the web tier
+  key?: string
+}
+
+/** Why an output list can't be used with a converter, or undefined when it can */
+export function validateOutputs(converter: string, outputs: AudioOutput[]): string | undefined {
+  if (!MULTI_OUTPUT_CONVERTERS.includes(converter)) {
+    return `${converter} does not take an output list`
+  }
+  if (!Array.isArray(outputs) || outputs.length === 0 || outputs.length > MAX_AUDIO_OUTPUTS) {
+    return `Output list needs 1 to ${MAX_AUDIO_OUTPUTS} entries`
+  }
+  const invalid = outputs.find(output => !AUDIO_OUTPUT_FORMATS.includes(output?.format))
+  if (invalid) {
+    return `Unsupported audio output format: ${invalid?.format}`
+  }
+  return undefined
+}
+
+export function getConverterSpec(converter: string): ConverterSpec | undefined {
+  return Object.prototype.hasOwnProperty.call(converters, converter) ? converters[converter] : undefined
+}
+
+export function normalizeFormat(name: string): string {
+  const format = name.toLowerCase().replace(/^\./, '')
+  return formatAliases[format] || format
+}
+
+function stepConverter(step: string | PipelineStep): string {
+  return typeof step === 'string' ? step : step.converter
+}
+
+/**
+ * Converter that receives the uploaded file in a pipeline job: the first
+ * listed step, or a converter accepting the source format when only a
+ * target is given. Used for routing and content validation.
+ */
+export function getPipelineEntry(options: JobOptions, sourceFormat: string): string | undefined {
+  if (options.steps && options.steps.length > 0) {
+    const first = stepConverter(options.steps[0])
+    return getConverterSpec(first) ? first : undefined
+  }
+  const source = normalizeFormat(options.source || sourceFormat)
+  return Object.keys(converters).find(name => {
+    const spec = converters[name]
+    return !spec.transform && spec.from.includes(source)
+  })
+}
+
+/** Format a pipeline job produces, for naming the output */
+export function getPipelineTarget(options: JobOptions, sourceFormat: string): string | undefined {
+  if (options.target) {
+    return normalizeFormat(options.target)
+  }
+  let format = normalizeFormat(options.source || sourceFormat)
+  for (const step of options.steps || []) {
+    const spec = getConverterSpec(stepConverter(step))
+    if (!spec) {
+      return undefined
+    }
+    format = spec.to || format
+  }
+  return format
+}
+
+// Published by the workers of each queue (workers/common/eta.py)
+export interface QueueEstimate {
+  queue: string
+  depth: number
+  delayed: number
+  activeJobs: number
+  slots: number
+  waitSeconds: number | null
+  throughputPerMinute: number
+  converters: Record<string, { serviceSeconds: number; etaSeconds: number | null }>
+  updatedAt: number
+}
+
+export interface AdmissionDecision {
+  queue: string
+  admitted: boolean
+  etaSeconds?: number
+  waitSeconds?: number
+  budgetSeconds?: number
+  retryAfterSeconds?: number
+}
+
+/** Longest acceptable queue wait in seconds; 0 turns admission control off */
+export function getLatencyBudget(queue: string): number {
+  const perQueue = process.env[`QUEUE_LATENCY_BUDGET_${queue.toUpperCase()}`]
+  return parseInt(perQueue || process.env.QUEUE_LATENCY_BUDGET_SECONDS || '0') || 0
 }
 
 export interface JobOptions {
@@ -20,6 +158,22 @@ export interface JobOptions {
   quality?: string
   resolution?: number
   scale?: number
+  // Audio outputs encoded from one decode; the first goes to the job's outputKey
+  outputs?: AudioOutput[]
+  // TXT -> PDF layout (workers/doc/txtpdf.py)
+  engine?: 'native' | 'libreoffice'
+  font?: 'mono' | 'sans' | 'serif'
+  paper?: 'a3' | 'a4' | 'a5' | 'letter' | 'legal'
+  orientation?: 'portrait' | 'landscape'
+  points?: number
+  margin?: number
+  // MP4 layout: fragmented (streamed to storage while encoding) or faststart
+  container?: 'fragmented' | 'faststart'
+  // Image encoder preset (workers/img/worker.py ENCODER_PRESETS)
+  preset?: 'fast' | 'balanced' | 'smallest'
+  steps?: (string | PipelineStep)[]
+  target?: string
+  source?: string
 }
 
 export class QueueManager {
@@ -49,9 +203,12 @@ export class QueueManager {
 
     // Store job data
     await this.redis.hset(`job:${jobId}`, job)
+    if (options.outputs && options.outputs.length > 1) {
+      await this.redis.hset(`job:${jobId}`, 'outputKeys', JSON.stringify(options.outputs.map(output => output.key)))
+    }
 
     // Add to appropriate queue
-    const queueName = this.getQueueName(converter)
+    const queueName = this.getQueueName(converter, options, inputKey.split('.').pop() || '')
     await this.redis.lpush(queueName, JSON.stringify(job))
 
     return jobId
@@ -72,7 +229,18 @@ export class QueueManager {
       createdAt: jobData.createdAt,
       status: jobData.status as ConversionJob['status'],
       progress: parseInt(jobData.progress) || 0,
-      error: jobData.error
+      error: jobData.error,
+      estimatedTimeRemaining: jobData.estimatedTimeRemaining
+        ? parseInt(jobData.estimatedTimeRemaining)
+        : undefined,
+      retryAttempt: jobData.retryAttempt ? parseInt(jobData.retryAttempt) : undefined,
+      maxRetries: jobData.maxRetries ? parseInt(jobData.maxRetries) : undefined,
+      nextRetryAt: jobData.nextRetryAt || undefined,
+      currentStep: jobData.currentStep ? parseInt(jobData.currentStep) : undefined,
+      totalSteps: jobData.totalSteps ? parseInt(jobData.totalSteps) : undefined,
+      stepConverter: jobData.stepConverter || undefined,
+      outputKeys: jobData.outputKeys ? JSON.parse(jobData.outputKeys) : undefined,
+      outputsReady: jobData.outputsReady ? parseInt(jobData.outputsReady) : undefined
     }
   }
 
@@ -91,35 +259,40 @@ export class QueueManager {
       updates.error = error
     }
 
-    await this.redis.hset(`job:${jobId}`, updates)
+    // Same event the workers publish, for SSE clients (src/lib/job-events.ts)
+    const event: string[] = ['status', status, 'progress', updates.progress]
+    if (error) {
+      event.push('error', error)
+    }
+    const eventsKey = jobEventsKey(jobId)
+    await this.redis.multi()
+      .hset(`job:${jobId}`, updates)
+      .xadd(eventsKey, 'MAXLEN', '~', JOB_EVENTS_MAXLEN, '*', ...event)
+      .expire(eventsKey, JOB_EVENTS_TTL_SECONDS)
+      .exec()
   }
 
-  private getQueueName(converter: string): string {
-    // Map converters to appropriate queues
-    if (converter.includes('pdf') || converter.includes('docx') || converter.includes('txt') || converter.includes('pptx')) {
-      return 'doc_queue'
-    }
-    
-    if (converter.includes('jpg') || converter.includes('png') || converter.includes('heic') || 
-        converter.includes('webp') || converter.includes('svg') || converter.includes('background') || 
-        converter.includes('upscaler')) {
-      return 'img_queue'
-    }
-    
-    if (converter.includes('mp4') || converter.includes('mp3') || converter.includes('mov') || 
-        converter.includes('wav') || converter.includes('srt') || converter.includes('vtt')) {
-      return 'av_queue'
+  getQueueName(converter: string, options: JobOptions, sourceFormat: string): string {
+    if (converter === PIPELINE) {
+      // Pipelines run where their first step runs
+      const entry = getPipelineEntry(options, sourceFormat)
+      if (!entry) {
+        throw new Error('Pipeline has no step for this input')
+      }
+      converter = entry
     }
 
-    // Default to document queue
-    return 'doc_queue'
+    const spec = getConverterSpec(converter)
+    if (!spec) {
+      throw new Error(`Unknown converter: ${converter}`)
+    }
+    return spec.queue
   }
 
   async getQueueStats(): Promise<Record<string, number>> {
-    const queues = ['doc_queue', 'img_queue', 'av_queue']
     const stats: Record<string, number> = {}
 
-    for (const queue of queues) {
+    for (const queue of queueNames) {
       const length = await this.redis.llen(queue)
       stats[queue] = length
     }
@@ -127,6 +300,49 @@ export class QueueManager {
     return stats
   }
 
+  async getQueueEstimate(queue: string): Promise<QueueEstimate | null> {
+    try {
+      const raw = await this.redis.get(`eta:${queue}`)
+      return raw ? JSON.parse(raw) : null
+    } catch (error) {
+      // Estimates are advisory; never fail a request over them
+      console.error('Queue estimate error:', error)
+      return null
+    }
+  }
+
+  /**
+   * Expected time until a new job would be done and whether its queue is
+   * within the latency budget. Without a published estimate (no workers
+   * reporting) the job is admitted and no ETA is given.
+   */
+  async checkAdmission(converter: string, options: JobOptions, sourceFormat: string): Promise<AdmissionDecision> {
+    const queue = this.getQueueName(converter, options, sourceFormat)
+    const estimate = await this.getQueueEstimate(queue)
+    const etaSeconds = estimate?.converters[converter]?.etaSeconds ?? undefined
+    const waitSeconds = estimate?.waitSeconds ?? undefined
+    const budgetSeconds = getLatencyBudget(queue)
+
+    if (!budgetSeconds || waitSeconds === undefined || waitSeconds <= budgetSeconds) {
+      return { queue, admitted: true, etaSeconds, waitSeconds }
+    }
+
+    // Time for the backlog to drain back under budget if nothing else arrived
+    const retryAfterSeconds = Math.min(Math.max(Math.ceil(waitSeconds - budgetSeconds), 5), 3600)
+    return { queue, admitted: false, etaSeconds, waitSeconds, budgetSeconds, retryAfterSeconds }
+  }
+
+  /** Estimated seconds until a pending job is done, at most the whole queue's wait */
+  async estimateJob(job: ConversionJob): Promise<number | undefined> {
+    try {
+      const queue = this.getQueueName(job.converter, job.options || {}, job.inputKey.split('.').pop() || '')
+      const estimate = await this.getQueueEstimate(queue)
+      return estimate?.converters[job.converter]?.etaSeconds ?? undefined
+    } catch (error) {
+      return undefined
+    }
+  }
+
   async cleanup(): Promise<void> {
     // This would be called by the janitor worker
     // Implementation is in the janitor worker
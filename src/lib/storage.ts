@@ -1,5 +1,8 @@
 import { S3Client, PutObjectCommand, GetObjectCommand, DeleteObjectCommand } from '@aws-sdk/client-s3'
 import { v4 as uuidv4 } from 'uuid'
+import { createReadStream, promises as fs } from 'fs'
+import path from 'path'
+import { Readable } from 'stream'
 
 const s3Client = new S3Client({
   region: 'auto',
@@ -10,6 +13,15 @@ const s3Client = new S3Client({
   },
 })
 
+// Single-host deployments keep objects on a volume shared with the workers
+// (workers/common/storage.py); LOCAL_STORAGE_PREFIXES keeps only some key prefixes there
+const storageBackend = (process.env.STORAGE_BACKEND || 's3').toLowerCase()
+const localRoot = path.resolve(process.env.LOCAL_STORAGE_ROOT || '/data/storage')
+const localPrefixes = (process.env.LOCAL_STORAGE_PREFIXES || '')
+  .split(',')
+  .map(prefix => prefix.trim())
+  .filter(Boolean)
+
 export class StorageManager {
   private bucketName: string
   private publicUrl: string
@@ -26,6 +38,16 @@ export class StorageManager {
     const arrayBuffer = await file.arrayBuffer()
     const buffer = Buffer.from(arrayBuffer)
 
+    if (this.isLocal(key)) {
+      // Write beside the target and rename so workers never see a partial file
+      const target = this.localPath(key)
+      const staging = path.join(path.dirname(target), `.${uuidv4()}.part`)
+      await fs.mkdir(path.dirname(target), { recursive: true })
+      await fs.writeFile(staging, buffer)
+      await fs.rename(staging, target)
+      return key
+    }
+
     const command = new PutObjectCommand({
       Bucket: this.bucketName,
       Key: key,
@@ -41,11 +63,38 @@ export class StorageManager {
     return key
   }
 
-  async getFileUrl(key: string): Promise<string> {
+  async getFileUrl(key: string, expiresIn?: number): Promise<string> {
     return `${this.publicUrl}/${key}`
   }
 
+  isLocal(key: string): boolean {
+    return storageBackend === 'local' || localPrefixes.some(prefix => key.startsWith(prefix))
+  }
+
+  private localPath(key: string): string {
+    const target = path.resolve(localRoot, key)
+    if (!target.startsWith(localRoot + path.sep)) {
+      throw new Error(`Key escapes storage root: ${key}`)
+    }
+    return target
+  }
+
+  /** Stream a locally stored object, for serving downloads without R2 */
+  async readLocalFile(key: string): Promise<{ stream: ReadableStream; size: number }> {
+    const target = this.localPath(key)
+    const stat = await fs.stat(target)
+    return {
+      stream: Readable.toWeb(createReadStream(target)) as ReadableStream,
+      size: stat.size
+    }
+  }
+
   async deleteFile(key: string): Promise<void> {
+    if (this.isLocal(key)) {
+      await fs.rm(this.localPath(key), { force: true })
+      return
+    }
+
     const command = new DeleteObjectCommand({
       Bucket: this.bucketName,
       Key: key,
@@ -56,6 +105,16 @@ export class StorageManager {
 
   async getFileMetadata(key: string): Promise<any> {
     try {
+      if (this.isLocal(key)) {
+        const stat = await fs.stat(this.localPath(key))
+        return {
+          contentType: undefined,
+          contentLength: stat.size,
+          lastModified: stat.mtime,
+          metadata: {},
+        }
+      }
+
       const command = new GetObjectCommand({
         Bucket: this.bucketName,
         Key: key,
@@ -2,39 +2,74 @@
 """
 Audio/Video conversion worker using FFmpeg
 Handles: MP4 → MP3, MOV → MP4, WAV → MP3, SRT → VTT
+MP4 → MP3 and WAV → MP3 can encode several audio outputs (options.outputs)
+from a single decode of the source. MOV → MP4 streams fragmented MP4 from
+FFmpeg straight into a multipart upload by default (options.container)
 """
 
 import os
 import sys
-import json
 import redis
-import boto3
-import subprocess
 import tempfile
 import logging
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
-from typing import Dict, Any
+from typing import Dict, Any, List, Optional
+
+from common.aio import AsyncWorkerCore, run_command
+from common.durations import DurationModel
+from common.inmemory import InMemoryPipeline
+from common.prefork import serve
+from common.progress import write_job_status
+from common.registry import converter, dispatch
+from common.sniff import probed_units
+from common.storage import open_storage
+from common.threads import ffmpeg_threads
+from common.tracing import span
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Encoder and muxer of each audio output format; lossless formats ignore the bitrate
+AUDIO_FORMATS = {
+    'mp3': (['-acodec', 'mp3'], 'mp3', True),
+    'aac': (['-acodec', 'aac'], 'adts', True),
+    'm4a': (['-acodec', 'aac'], 'ipod', True),
+    'wav': (['-acodec', 'pcm_s16le'], 'wav', False),
+    'flac': (['-acodec', 'flac'], 'flac', False)
+}
+# Upper bound on outputs of one audio job
+MAX_AUDIO_OUTPUTS = 4
+
+# 'fragmented' streams to storage while encoding; 'faststart' writes a file with the index up front
+MP4_CONTAINER = os.getenv('MP4_CONTAINER') or 'fragmented'
+# Self-contained fragments at each keyframe, playable before the upload completes
+FRAGMENTED_MOVFLAGS = 'frag_keyframe+empty_moov+default_base_moof'
+
+
 class AudioVideoWorker:
     def __init__(self):
         self.redis_client = redis.Redis.from_url(os.getenv('REDIS_URL', 'redis://localhost:6379'))
-        self.s3_client = boto3.client(
-            's3',
-            endpoint_url=os.getenv('R2_PUBLIC_URL', '').replace('https://', 'https://'),
-            aws_access_key_id=os.getenv('R2_ACCESS_KEY_ID'),
-            aws_secret_access_key=os.getenv('R2_SECRET_ACCESS_KEY'),
-            region_name='auto'
-        )
-        self.bucket_name = os.getenv('R2_BUCKET_NAME', 'aic-files')
+        self.storage = open_storage()
+        
+        # Small inputs of these converters never touch the filesystem
+        self.in_memory = InMemoryPipeline(self, {'srt-to-vtt', 'wav-to-mp3'})
         
+        # Fallback timeouts until the duration model has enough samples
+        self.timeouts = {
+            'srt-to-vtt': 30,
+            'default': 300
+        }
+        self.durations = DurationModel(self.redis_client)
+    
     def download_file(self, key: str, local_path: str) -> bool:
-        """Download file from R2 storage"""
+        """Download file from storage"""
         try:
-            self.s3_client.download_file(self.bucket_name, key, local_path)
+            with span('download', key=key) as download_span:
+                self.storage.download_file(key, local_path)
+                download_span.set('size', os.path.getsize(local_path))
             logger.info(f"Downloaded {key} to {local_path}")
             return True
         except Exception as e:
@@ -42,130 +77,232 @@ class AudioVideoWorker:
             return False
     
     def upload_file(self, local_path: str, key: str) -> bool:
-        """Upload file to R2 storage"""
+        """Upload file to storage"""
         try:
-            self.s3_client.upload_file(local_path, self.bucket_name, key)
+            with span('upload', key=key, size=os.path.getsize(local_path)):
+                self.storage.upload_file(local_path, key)
             logger.info(f"Uploaded {local_path} to {key}")
             return True
         except Exception as e:
             logger.error(f"Failed to upload {local_path}: {e}")
             return False
     
-    def update_job_status(self, job_id: str, status: str, progress: int = 0, error: str = None):
-        """Update job status in Redis"""
+    def update_job_status(self, job_id: str, status: str, progress: int = 0, error: str = None,
+                          eta: float = None):
+        """Update job status in Redis and publish it as a progress event"""
         job_data = {
             'status': status,
             'progress': progress,
-            'error': error
+            'error': error or ''
         }
-        self.redis_client.hset(f"job:{job_id}", mapping=job_data)
+        if eta is not None:
+            job_data['estimatedTimeRemaining'] = int(round(eta))
+        with span('status.write', status=status, progress=progress):
+            write_job_status(self.redis_client, job_id, job_data)
         logger.info(f"Updated job {job_id}: {status} ({progress}%)")
     
-    def mp4_to_mp3(self, input_path: str, output_path: str, bitrate: str = '192k') -> bool:
-        """Extract audio from MP4 to MP3 using FFmpeg"""
+    def audio_output_paths(self, output_path: str, outputs: List[Dict[str, Any]]) -> List[str]:
+        """Local file of each requested output; the first is the job's own output file"""
+        return [output_path] + [f"{output_path}.{index}" for index in range(1, len(outputs))]
+    
+    def encode_audio(self, input_path: str, output_path: str, outputs: List[Dict[str, Any]],
+                     timeout: int = 300) -> bool:
+        """
+        Encode every requested audio output in one FFmpeg run. The source is
+        demuxed and decoded once and each output gets its own encoder, so
+        extra formats and bitrates cost an encode, not another decode.
+        """
+        if not outputs or len(outputs) > MAX_AUDIO_OUTPUTS:
+            logger.error(f"Audio jobs take 1 to {MAX_AUDIO_OUTPUTS} outputs, got {len(outputs or [])}")
+            return False
+        cmd = ['ffmpeg', '-y', '-i', input_path]
+        for output, path in zip(outputs, self.audio_output_paths(output_path, outputs)):
+            fmt = output.get('format', 'mp3')
+            if fmt not in AUDIO_FORMATS:
+                logger.error(f"Unsupported audio output format: {fmt}")
+                return False
+            codec, muxer, lossy = AUDIO_FORMATS[fmt]
+            cmd += ['-map', '0:a:0', '-vn', *codec]
+            if lossy:
+                cmd += ['-ab', output.get('bitrate') or '192k']
+            cmd += ['-ar', '44100', *ffmpeg_threads(), '-f', muxer, path]
+        result = run_command(cmd, timeout=timeout, text=True)
+        return result.returncode == 0
+    
+    @converter('mp4-to-mp3', bitrate='192k', outputs=None)
+    def mp4_to_mp3(self, input_path: str, output_path: str, bitrate: str = '192k',
+                   outputs: List[Dict[str, Any]] = None, timeout: int = 300) -> bool:
+        """Extract audio from MP4 to MP3 (or the listed outputs) using FFmpeg"""
         try:
-            cmd = [
-                'ffmpeg',
-                '-i', input_path,
-                '-vn',  # No video
-                '-acodec', 'mp3',
-                '-ab', bitrate,
-                '-ar', '44100',
-                '-y',  # Overwrite output file
-                output_path
-            ]
-            result = subprocess.run(cmd, capture_output=True, text=True, timeout=300)
-            return result.returncode == 0
+            return self.encode_audio(input_path, output_path, outputs or [{'format': 'mp3', 'bitrate': bitrate}],
+                                     timeout)
         except Exception as e:
             logger.error(f"MP4 to MP3 conversion error: {e}")
             return False
     
-    def mov_to_mp4(self, input_path: str, output_path: str, quality: str = 'high') -> bool:
-        """Convert MOV to MP4 using FFmpeg"""
+    def streams_output(self, converter_type: str, options: Dict[str, Any]) -> bool:
+        """Whether a job's handler uploads its own output while converting"""
+        return converter_type == 'mov-to-mp4' and (options.get('container') or MP4_CONTAINER) == 'fragmented'
+    
+    def stream_to_storage(self, cmd: list, output_key: str, timeout: int) -> bool:
+        """Run an FFmpeg command writing to stdout and upload its output as it is produced"""
+        upload = self.storage.open_upload(output_key)
         try:
-            if quality == 'high':
-                cmd = [
-                    'ffmpeg',
-                    '-i', input_path,
-                    '-c:v', 'libx264',
-                    '-crf', '18',
-                    '-c:a', 'aac',
-                    '-b:a', '128k',
-                    '-y',
-                    output_path
-                ]
-            else:
-                cmd = [
-                    'ffmpeg',
-                    '-i', input_path,
-                    '-c:v', 'libx264',
-                    '-crf', '23',
-                    '-c:a', 'aac',
-                    '-b:a', '96k',
-                    '-y',
-                    output_path
-                ]
-            result = subprocess.run(cmd, capture_output=True, text=True, timeout=300)
-            return result.returncode == 0
-        except Exception as e:
-            logger.error(f"MOV to MP4 conversion error: {e}")
-            return False
+            with span('upload', key=output_key, streamed=True) as upload_span:
+                result = run_command(cmd, timeout=timeout, stdout_sink=upload.write)
+                if result.returncode != 0:
+                    upload.abort()
+                    return False
+                upload.commit()
+                upload_span.set('size', upload.size)
+            logger.info(f"Streamed {upload.size} bytes to {output_key}")
+            return True
+        except Exception:
+            upload.abort()
+            raise
     
-    def wav_to_mp3(self, input_path: str, output_path: str, bitrate: str = '192k') -> bool:
-        """Convert WAV to MP3 using FFmpeg"""
+    @converter('mov-to-mp4', quality='high', container=MP4_CONTAINER)
+    def mov_to_mp4(self, input_path: str, output_path: str, quality: str = 'high', container: str = MP4_CONTAINER,
+                   output_key: str = None, timeout: int = 300) -> bool:
+        """
+        Convert MOV to MP4 using FFmpeg. Given an output key, the fragmented
+        container is piped into storage while encoding; otherwise the file
+        gets +faststart, which moves the index to the front in place.
+        """
         try:
+            crf, audio_bitrate = ('18', '128k') if quality == 'high' else ('23', '96k')
             cmd = [
                 'ffmpeg',
                 '-i', input_path,
-                '-acodec', 'mp3',
-                '-ab', bitrate,
-                '-ar', '44100',
-                '-y',
-                output_path
+                '-c:v', 'libx264',
+                '-crf', crf,
+                '-c:a', 'aac',
+                '-b:a', audio_bitrate,
+                *ffmpeg_threads()
             ]
-            result = subprocess.run(cmd, capture_output=True, text=True, timeout=300)
+            if output_key and container == 'fragmented':
+                return self.stream_to_storage(cmd + ['-movflags', FRAGMENTED_MOVFLAGS, '-f', 'mp4', 'pipe:1'],
+                                              output_key, timeout)
+            cmd += ['-movflags', '+faststart', '-f', 'mp4', '-y', output_path]
+            result = run_command(cmd, timeout=timeout, text=True)
             return result.returncode == 0
+        except Exception as e:
+            logger.error(f"MOV to MP4 conversion error: {e}")
+            return False
+    
+    @converter('wav-to-mp3', bitrate='192k', outputs=None)
+    def wav_to_mp3(self, input_path: str, output_path: str, bitrate: str = '192k',
+                   outputs: List[Dict[str, Any]] = None, timeout: int = 300) -> bool:
+        """Convert WAV to MP3 (or the listed outputs) using FFmpeg"""
+        try:
+            return self.encode_audio(input_path, output_path, outputs or [{'format': 'mp3', 'bitrate': bitrate}],
+                                     timeout)
         except Exception as e:
             logger.error(f"WAV to MP3 conversion error: {e}")
             return False
     
+    def srt_to_vtt_text(self, srt_content: str) -> str:
+        """Convert SRT subtitle text to VTT format"""
+        vtt_content = "WEBVTT\n\n"
+        
+        # Split by double newlines to get subtitle blocks
+        blocks = srt_content.strip().split('\n\n')
+        
+        for block in blocks:
+            lines = block.strip().split('\n')
+            if len(lines) >= 3:
+                # Skip subtitle number
+                time_line = lines[1]
+                text_lines = lines[2:]
+                
+                # Convert time format from SRT to VTT
+                # SRT: 00:00:01,000 --> 00:00:03,000
+                # VTT: 00:00:01.000 --> 00:00:03.000
+                vtt_time = time_line.replace(',', '.')
+                
+                vtt_content += f"{vtt_time}\n"
+                vtt_content += '\n'.join(text_lines)
+                vtt_content += "\n\n"
+        
+        return vtt_content
+    
+    @converter('srt-to-vtt')
     def srt_to_vtt(self, input_path: str, output_path: str) -> bool:
         """Convert SRT subtitle to VTT format"""
         try:
             with open(input_path, 'r', encoding='utf-8') as f:
                 srt_content = f.read()
             
-            # Convert SRT to VTT format
-            vtt_content = "WEBVTT\n\n"
-            
-            # Split by double newlines to get subtitle blocks
-            blocks = srt_content.strip().split('\n\n')
-            
-            for block in blocks:
-                lines = block.strip().split('\n')
-                if len(lines) >= 3:
-                    # Skip subtitle number
-                    time_line = lines[1]
-                    text_lines = lines[2:]
-                    
-                    # Convert time format from SRT to VTT
-                    # SRT: 00:00:01,000 --> 00:00:03,000
-                    # VTT: 00:00:01.000 --> 00:00:03.000
-                    vtt_time = time_line.replace(',', '.')
-                    
-                    vtt_content += f"{vtt_time}\n"
-                    vtt_content += '\n'.join(text_lines)
-                    vtt_content += "\n\n"
-            
             with open(output_path, 'w', encoding='utf-8') as f:
-                f.write(vtt_content)
+                f.write(self.srt_to_vtt_text(srt_content))
             
             return True
-            
+        
         except Exception as e:
             logger.error(f"SRT to VTT conversion error: {e}")
             return False
     
+    def convert_in_memory(self, converter_type: str, data: bytes, options: Dict[str, Any],
+                          timeout: int = 300) -> Optional[bytes]:
+        """Convert a small input entirely in memory using FFmpeg pipes or pure Python"""
+        try:
+            if converter_type == 'srt-to-vtt':
+                return self.srt_to_vtt_text(data.decode('utf-8')).encode('utf-8')
+            
+            if converter_type == 'wav-to-mp3':
+                bitrate = options.get('bitrate', '192k')
+                cmd = [
+                    'ffmpeg',
+                    '-i', 'pipe:0',
+                    '-acodec', 'mp3',
+                    '-ab', bitrate,
+                    '-ar', '44100',
+                    '-f', 'mp3',
+                    *ffmpeg_threads(),
+                    'pipe:1'
+                ]
+                result = run_command(cmd, timeout=timeout, input=data)
+                return result.stdout if result.returncode == 0 and result.stdout else None
+            
+            return None
+        except Exception as e:
+            logger.error(f"In-memory {converter_type} conversion error: {e}")
+            return None
+    
+    def measure_input(self, converter_type: str, input_path: str) -> Optional[float]:
+        """Media duration in seconds for the duration model, via ffprobe"""
+        if converter_type == 'srt-to-vtt':
+            return None
+        try:
+            cmd = [
+                'ffprobe',
+                '-v', 'error',
+                '-show_entries', 'format=duration',
+                '-of', 'default=noprint_wrappers=1:nokey=1',
+                input_path
+            ]
+            result = run_command(cmd, timeout=15, text=True)
+            return float(result.stdout.strip()) if result.returncode == 0 else None
+        except Exception:
+            return None
+    
+    def upload_outputs(self, job_id: str, uploads: List[tuple]) -> bool:
+        """
+        Upload the (local path, key) outputs of a job side by side. Each one
+        is counted in the job's outputsReady as soon as it lands.
+        """
+        if len(uploads) == 1:
+            return self.upload_file(*uploads[0])
+        with ThreadPoolExecutor(max_workers=len(uploads)) as pool:
+            futures = [pool.submit(self.upload_file, path, key) for path, key in uploads]
+            ok = True
+            for future in as_completed(futures):
+                if future.result():
+                    self.redis_client.hincrby(f"job:{job_id}", 'outputsReady', 1)
+                else:
+                    ok = False
+        return ok
+    
     def process_job(self, job_data: Dict[str, Any]):
         """Process a conversion job"""
         job_id = job_data['id']
@@ -173,17 +310,36 @@ class AudioVideoWorker:
         input_key = job_data['inputKey']
         output_key = job_data['outputKey']
         options = job_data.get('options', {})
+        outputs = options.get('outputs') or []
         
         logger.info(f"Processing job {job_id}: {converter_type}")
         
+        # Jobs with an output list always take the disk path
+        if not outputs and self.in_memory.qualifies(job_data):
+            def convert(data: bytes, timeout: int) -> Optional[bytes]:
+                return self.convert_in_memory(converter_type, data, options, timeout)
+            
+            if self.in_memory.run(job_data, convert):
+                logger.info(f"Job {job_id} completed successfully in memory")
+                return
+            logger.info(f"In-memory pipeline failed for job {job_id}, falling back to disk")
+        
         # Create temporary files
         with tempfile.NamedTemporaryFile(delete=False) as input_file:
             input_path = input_file.name
         
         with tempfile.NamedTemporaryFile(delete=False) as output_file:
             output_path = output_file.name
+        uploads = [(output_path, output_key)]
+        streamed = self.streams_output(converter_type, options)
         
         try:
+            # Outputs after the first are written next to the output file and go to the keys the web tier assigned
+            for path, output in zip(self.audio_output_paths(output_path, outputs)[1:], outputs[1:]):
+                if not output.get('key'):
+                    raise Exception("Audio output has no storage key")
+                uploads.append((path, output['key']))
+            
             # Download input file
             self.update_job_status(job_id, 'downloading', 10)
             if not self.download_file(input_key, input_path):
@@ -192,67 +348,57 @@ class AudioVideoWorker:
             # Process conversion
             self.update_job_status(job_id, 'processing', 30)
             
-            success = False
-            if converter_type == 'mp4-to-mp3':
-                bitrate = options.get('bitrate', '192k')
-                success = self.mp4_to_mp3(input_path, output_path, bitrate)
-            elif converter_type == 'mov-to-mp4':
-                quality = options.get('quality', 'high')
-                success = self.mov_to_mp4(input_path, output_path, quality)
-            elif converter_type == 'wav-to-mp3':
-                bitrate = options.get('bitrate', '192k')
-                success = self.wav_to_mp3(input_path, output_path, bitrate)
-            elif converter_type == 'srt-to-vtt':
-                success = self.srt_to_vtt(input_path, output_path)
-            else:
-                raise Exception(f"Unknown converter type: {converter_type}")
+            input_size = os.path.getsize(input_path)
+            # The core's header probe spares a second look at the file
+            units = probed_units(job_data)
+            if units is None:
+                units = self.measure_input(converter_type, input_path)
+            timeout = self.durations.timeout_for(
+                converter_type, input_size, units, self.timeouts.get(converter_type, self.timeouts['default'])
+            )
+            expected = self.durations.estimate(converter_type, input_size, units)
+            budget = f"expected {expected:.1f}s" if expected is not None else "no duration model yet"
+            logger.info(f"Job {job_id} budget: timeout {timeout}s, {budget}")
+            
+            def report_progress(progress: int, eta: Optional[float]):
+                self.update_job_status(job_id, 'processing', progress, eta=eta)
+            
+            convert_start = time.time()
+            with span('convert', tool=converter_type, size=input_size, units=units, timeout=timeout), \
+                    self.durations.track(expected, timeout, report_progress):
+                success = dispatch(self, converter_type, input_path, output_path, options, timeout=timeout,
+                                   output_key=output_key if streamed else None)
             
             if not success:
                 raise Exception("Conversion failed")
+            self.durations.record(converter_type, input_size, units, time.time() - convert_start)
             
-            # Upload output file
-            self.update_job_status(job_id, 'uploading', 80)
-            if not self.upload_file(output_path, output_key):
-                raise Exception("Failed to upload output file")
+            # Upload output files (a streamed output is already in storage)
+            if not streamed:
+                self.update_job_status(job_id, 'uploading', 80)
+                if not self.upload_outputs(job_id, uploads):
+                    raise Exception("Failed to upload output file")
             
             # Mark as completed
             self.update_job_status(job_id, 'completed', 100)
             logger.info(f"Job {job_id} completed successfully")
-            
+        
         except Exception as e:
             logger.error(f"Job {job_id} failed: {e}")
             self.update_job_status(job_id, 'failed', 0, str(e))
         
         finally:
             # Cleanup temporary files
-            try:
-                os.unlink(input_path)
-                os.unlink(output_path)
-            except:
-                pass
+            for path in [input_path] + [path for path, _ in uploads]:
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
     
     def run(self):
         """Main worker loop"""
         logger.info("Audio/Video worker started")
-        
-        while True:
-            try:
-                # Get job from queue
-                job_data = self.redis_client.blpop('av_queue', timeout=10)
-                if job_data:
-                    job_json = job_data[1].decode('utf-8')
-                    job_data = json.loads(job_json)
-                    self.process_job(job_data)
-                else:
-                    logger.debug("No jobs in queue, waiting...")
-                    
-            except KeyboardInterrupt:
-                logger.info("Worker shutting down...")
-                break
-            except Exception as e:
-                logger.error(f"Worker error: {e}")
-                continue
+        AsyncWorkerCore(self, 'av_queue').run()
 
 if __name__ == "__main__":
-    worker = AudioVideoWorker()
-    worker.run()
+    serve(AudioVideoWorker, 'av_queue')
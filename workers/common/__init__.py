@@ -0,0 +1,3 @@
+"""
+Shared runtime for the conversion workers
+"""
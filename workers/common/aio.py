@@ -0,0 +1,556 @@
+"""
+asyncio worker core
+Runs queue pops, status writes and storage transfers concurrently while
+keeping the synchronous process_job(job_data) contract of each worker.
+The core also takes jobs from peer queues it can serve and runs pipeline
+jobs (common.pipeline). Each job's input is sniffed (common.sniff) and its
+memory admitted (common.memory) before it starts; afterwards its usage,
+wait estimates (common.eta) and any sampled profile (common.profiling)
+are recorded. Converter subprocesses are reaped by the wait4 supervisor
+and get a share of the container's CPUs (common.threads).
+"""
+
+import os
+import json
+import time
+import random
+import signal
+import socket
+import asyncio
+import logging
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import redis.asyncio as aioredis
+
+from common.eta import PUBLISH_INTERVAL, WaitEstimator, adverts_key, queue_wait_seconds
+from common.memory import MemoryAdmission, estimate_job_mb
+from common.pipeline import PipelineError, PipelineRunner
+from common.profiling import FLAG_KEY, FLAG_REFRESH_SECONDS, JobProfiler
+from common.registry import CONVERTERS, PIPELINE, Peer, capabilities, handler_options, handlers
+from common.sniff import SNIFF_MODE, InputRejected, Probe, check, probe_object
+from common.supervisor import JobAccounting, SupervisedResult, supervise
+from common.threads import ThreadBudget, available_cpus
+from common.tracing import job_trace, span
+
+logger = logging.getLogger(__name__)
+
+# Core driving the current process, used by run_command from job threads
+_active_core: Optional['AsyncWorkerCore'] = None
+
+# Take the first of the oldest ARGV[1] jobs in a queue whose converter is one
+# of ARGV[2..]. Jobs are pushed on the left, so the oldest sit at the right end.
+STEAL_SCRIPT = """
+local items = redis.call('LRANGE', KEYS[1], -tonumber(ARGV[1]), -1)
+for i = #items, 1, -1 do
+    local ok, job = pcall(cjson.decode, items[i])
+    if ok and type(job) == 'table' then
+        for j = 2, #ARGV do
+            if job['converter'] == ARGV[j] then
+                redis.call('LREM', KEYS[1], -1, items[i])
+                return items[i]
+            end
+        end
+    end
+end
+return false
+"""
+
+
+class AsyncWorkerCore:
+    def __init__(self, worker: Any, queue_name: str, max_jobs: int = None, cpu_slots: int = None,
+                 job_limit: int = 0, peers: Dict[str, Peer] = None):
+        self.worker = worker
+        self.queue_name = queue_name
+        self.redis_url = os.getenv('REDIS_URL', 'redis://localhost:6379')
+        
+        # Workers of other queues hosted in this process, with the converters we may take
+        self.peers = peers or {}
+        self.steal_window = int(os.getenv('WORKER_STEAL_WINDOW') or 50)
+        self.depths: Dict[str, int] = {}
+        self.depths_at = 0.0
+        self.advert_key = f"worker:{socket.gethostname()}:{os.getpid()}"
+        # Which hosted worker runs each converter, for the steps of pipeline jobs
+        self.executors = {name: worker for name in handlers(type(worker))}
+        for peer in self.peers.values():
+            for name in peer.converters:
+                self.executors.setdefault(name, peer.worker)
+        
+        # Jobs in flight (mostly I/O) vs. converter subprocesses running at once (CPU)
+        self.max_jobs = max_jobs or int(os.getenv('WORKER_CONCURRENCY') or 1)
+        self.cpu_slots = cpu_slots or int(os.getenv('WORKER_CPU_SLOTS') or max(round(available_cpus()), 1))
+        self.threads = ThreadBudget(self.cpu_slots)
+        # Stop popping after this many jobs (0 = never), used for process recycling
+        self.job_limit = job_limit
+        self.jobs_started = 0
+        self.memory = MemoryAdmission()
+        self.memory_freed: Optional[asyncio.Event] = None
+        self.profiler = JobProfiler()
+        
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.loop_thread_id: Optional[int] = None
+        self.job_slots: Optional[asyncio.Semaphore] = None
+        self.cpu_semaphore: Optional[asyncio.Semaphore] = None
+        self.tasks = set()
+        self.pop_task: Optional[asyncio.Task] = None
+        self.stopping = False
+    
+    async def run_subprocess(self, cmd: list, timeout: float, input: bytes = None,
+                             progress: Callable[[float], None] = None,
+                             stdout_sink: Callable[[bytes], None] = None) -> SupervisedResult:
+        """Run a converter subprocess under the CPU semaphore via the wait4 supervisor"""
+        async with self.cpu_semaphore:
+            ticker = None
+            if progress:
+                ticker = asyncio.create_task(self._tick_progress(progress, self.loop.time()))
+            cpus = self.threads.acquire_cpus()
+            try:
+                return await asyncio.to_thread(supervise, cmd, timeout, input, self.threads.env(), cpus, stdout_sink)
+            finally:
+                self.threads.release_cpus(cpus)
+                if ticker:
+                    ticker.cancel()
+    
+    async def _tick_progress(self, progress: Callable[[float], None], start_time: float):
+        """Report elapsed time once a second while a subprocess runs"""
+        while True:
+            await asyncio.sleep(1)
+            try:
+                await asyncio.to_thread(progress, self.loop.time() - start_time)
+            except Exception as e:
+                logger.warning(f"Progress callback failed: {e}")
+    
+    def run_command(self, cmd: list, timeout: float, input: bytes = None,
+                    progress: Callable[[float], None] = None,
+                    stdout_sink: Callable[[bytes], None] = None) -> SupervisedResult:
+        """Blocking bridge used from job threads"""
+        future = asyncio.run_coroutine_threadsafe(
+            self.run_subprocess(cmd, timeout, input, progress, stdout_sink), self.loop
+        )
+        return future.result()
+    
+    async def _promote_retries(self, retry_queue: Any):
+        """Move due delayed retries onto the queue about once a second"""
+        while not self.stopping:
+            try:
+                await asyncio.to_thread(retry_queue.promote_due)
+            except Exception as e:
+                logger.error(f"Retry mover error: {e}")
+            await asyncio.sleep(1)
+    
+    async def _advertise(self, client: Any):
+        """Publish what this process can run so operators can see where capacity sits"""
+        converters = capabilities(type(self.worker))
+        for peer in self.peers.values():
+            converters.extend(sorted(peer.converters))
+        started_at = time.time()
+        while True:
+            info = {
+                'queue': self.queue_name,
+                'queues': [self.queue_name] + list(self.peers),
+                'converters': converters,
+                'maxJobs': self.max_jobs,
+                'cpuSlots': self.cpu_slots,
+                'threadsPerJob': self.threads.threads,
+                'activeJobs': len(self.tasks),
+                'jobsStarted': self.jobs_started,
+                'memoryBudgetMb': round(self.memory.budget_mb),
+                'memoryReservedMb': round(self.memory.reserved_mb),
+                'deferredJobs': len(self.memory.deferred),
+                'startedAt': started_at
+            }
+            try:
+                pipe = client.pipeline(transaction=False)
+                pipe.set(self.advert_key, json.dumps(info), ex=45)
+                pipe.sadd(adverts_key(self.queue_name), self.advert_key)
+                await pipe.execute()
+            except Exception as e:
+                logger.warning(f"Could not advertise capabilities: {e}")
+            await asyncio.sleep(15)
+    
+    async def _publish_estimates(self, estimator: WaitEstimator):
+        """Keep the home queue's wait estimate fresh for the web tier"""
+        while True:
+            try:
+                await estimator.publish(self.queue_name)
+            except Exception as e:
+                logger.warning(f"Could not publish queue estimate: {e}")
+            await asyncio.sleep(PUBLISH_INTERVAL)
+    
+    async def _watch_profiling(self, client: Any):
+        """Follow the Redis profiling flag so sampling can be switched without a restart"""
+        while True:
+            try:
+                self.profiler.configure(await client.get(FLAG_KEY))
+            except Exception as e:
+                logger.warning(f"Could not read profiling flag: {e}")
+            await asyncio.sleep(FLAG_REFRESH_SECONDS)
+    
+    async def _queue_depths(self, client: Any) -> Dict[str, int]:
+        """Lengths of every served queue, cached for a second"""
+        if self.loop.time() - self.depths_at >= 1:
+            pipe = client.pipeline(transaction=False)
+            queues = [self.queue_name] + list(self.peers)
+            for queue in queues:
+                pipe.llen(queue)
+            self.depths = dict(zip(queues, await pipe.execute()))
+            self.depths_at = self.loop.time()
+        return self.depths
+    
+    def _weighted_order(self, depths: Dict[str, int]) -> List[str]:
+        """Non-empty queues in random order, each drawn with probability proportional to its depth"""
+        remaining = {queue: depth for queue, depth in depths.items() if depth > 0}
+        order = []
+        while remaining:
+            queue = random.choices(list(remaining), weights=list(remaining.values()))[0]
+            order.append(queue)
+            del remaining[queue]
+        return order
+    
+    async def _pop(self, client: Any, steal: Any, idle_wait: int = None) -> Optional[Tuple[str, bytes]]:
+        """Take the next job from the served queues, or None after an idle wait"""
+        if self.peers:
+            for queue in self._weighted_order(await self._queue_depths(client)):
+                if queue == self.queue_name:
+                    raw = await client.lpop(queue)
+                else:
+                    # Other queues may hold converters we can't run; take only ours
+                    converters = sorted(self.peers[queue].converters)
+                    raw = await steal(keys=[queue], args=[self.steal_window] + converters)
+                if raw:
+                    self.depths[queue] = max(self.depths.get(queue, 1) - 1, 0)
+                    return queue, raw
+        
+        # Nothing to take: block on our own queue, waking up to rescan the others
+        item = await client.blpop(self.queue_name, timeout=idle_wait or (2 if self.peers else 10))
+        return (self.queue_name, item[1]) if item else None
+    
+    def _worker_for(self, queue: str, job_data: dict) -> Any:
+        """Worker instance (or pipeline runner) that handles a job from a queue"""
+        worker = self.peers[queue].worker if queue in self.peers else self.worker
+        if job_data.get('converter') == PIPELINE:
+            return PipelineRunner(worker, self.executors)
+        return worker
+    
+    def _estimate_memory(self, job_data: dict, queue: str) -> float:
+        """Expected peak memory of a job in MB, 0 when it can't be estimated"""
+        worker = self.peers[queue].worker if queue in self.peers else self.worker
+        name = job_data.get('converter')
+        try:
+            if name == PIPELINE:
+                steps = PipelineRunner(worker, self.executors).plan(job_data)
+            else:
+                steps = [(name, job_data.get('options') or {})]
+            steps = [(step, dict(handler_options(self.executors.get(step), step), **options))
+                     for step, options in steps]
+            return estimate_job_mb(worker.storage, job_data['inputKey'], steps, Probe.from_job(job_data))
+        except (PipelineError, KeyError) as e:
+            logger.debug(f"No memory estimate for job {job_data.get('id')}: {e}")
+        except Exception as e:
+            # A missing input fails the job properly once it runs
+            logger.warning(f"Could not estimate memory of job {job_data.get('id')}: {e}")
+        return 0.0
+    
+    def _probe_input(self, job_data: dict, queue: str) -> Optional[str]:
+        """
+        Probe a job's input and attach the probe to the job. Returns why the
+        input can't be converted, or None when the job may run.
+        """
+        worker = self.peers[queue].worker if queue in self.peers else self.worker
+        name = job_data.get('converter')
+        try:
+            probe = probe_object(worker.storage, job_data['inputKey'])
+        except Exception as e:
+            # A missing input fails the job properly once it runs
+            logger.warning(f"Could not probe input of job {job_data.get('id')}: {e}")
+            return None
+        job_data['probe'] = probe._asdict()
+        
+        if name == PIPELINE:
+            options = job_data.get('options') or {}
+            # Plan target-only pipelines from what the input really is rather than its extension
+            if not options.get('steps') and not options.get('source') and \
+                    any(probe.format in spec.inputs for spec in CONVERTERS.values()):
+                job_data['options'] = dict(options, source=probe.format)
+            try:
+                name = PipelineRunner(worker, self.executors).plan(job_data)[0][0]
+            except (PipelineError, IndexError):
+                # The runner reports unplannable pipelines itself
+                return None
+        spec = CONVERTERS.get(name)
+        if not spec:
+            return None
+        try:
+            check(probe, name, spec.inputs)
+        except InputRejected as e:
+            return str(e)
+        return None
+    
+    async def _sniff(self, job_data: dict, client: Any, queue: str) -> bool:
+        """Probe a freshly popped job's input; False when the job was failed over it"""
+        if SNIFF_MODE == 'off':
+            return True
+        job_id = job_data.get('id')
+        started = self.loop.time()
+        rejection = await asyncio.to_thread(self._probe_input, job_data, queue)
+        elapsed_ms = (self.loop.time() - started) * 1000
+        probe = Probe.from_job(job_data)
+        try:
+            if probe:
+                await client.hset(f"job:{job_id}", mapping=probe.fields())
+            if rejection:
+                await client.hincrby('sniff:rejected', job_data.get('converter') or 'unknown', 1)
+        except Exception as e:
+            logger.warning(f"Could not record input probe of job {job_id}: {e}")
+        if not rejection:
+            return True
+        if SNIFF_MODE != 'enforce':
+            logger.warning(f"Job {job_id} ({job_data.get('converter')}) has a bad input, running anyway: {rejection}")
+            return True
+        
+        logger.info(f"Rejected job {job_id} ({job_data.get('converter')}) after {elapsed_ms:.0f} ms: {rejection}")
+        worker = self.peers[queue].worker if queue in self.peers else self.worker
+        try:
+            await asyncio.to_thread(worker.update_job_status, job_id, 'failed', 0, rejection)
+        except Exception as e:
+            logger.error(f"Could not fail job {job_id}: {e}")
+        return False
+    
+    async def _admit(self, job_data: dict, queue: str) -> Optional[float]:
+        """Reserve memory for a freshly popped job, or defer it and return None"""
+        if not self.memory.enabled:
+            self.memory.reserve(0.0)
+            return 0.0
+        estimate = await asyncio.to_thread(self._estimate_memory, job_data, queue)
+        if not self.memory.fits(estimate):
+            self.memory.defer(queue, job_data, estimate)
+            logger.info(f"Deferring job {job_data.get('id')} ({job_data.get('converter')}): needs ~{estimate:.0f} MB, "
+                        f"{self.memory.budget_mb - self.memory.reserved_mb:.0f} MB free")
+            return None
+        self.memory.reserve(estimate)
+        return estimate
+    
+    async def _wait_for_memory(self):
+        """Sleep until a job finishes, or a second at most"""
+        self.memory_freed.clear()
+        try:
+            await asyncio.wait_for(self.memory_freed.wait(), timeout=1)
+        except asyncio.TimeoutError:
+            pass
+    
+    async def _requeue_deferred(self, client: Any):
+        """Hand jobs still waiting for memory back to their queues on shutdown"""
+        for _, _, queue, job_data in self.memory.deferred:
+            try:
+                # Back at the head so they are the next to run elsewhere
+                await client.lpush(queue, json.dumps(job_data))
+            except Exception as e:
+                logger.error(f"Could not requeue deferred job {job_data.get('id')}: {e}")
+        self.memory.deferred.clear()
+    
+    def _process_with_accounting(self, job_data: dict, queue: str) -> dict:
+        """Run process_job, collecting resource usage of its subprocesses"""
+        with job_trace(job_data, queue) as root:
+            with JobAccounting() as accounting, self.profiler.profile(job_data) as profile:
+                self._worker_for(queue, job_data).process_job(job_data)
+            root.set('usage', accounting.totals)
+        if profile and profile.path:
+            return dict(accounting.totals, profilePath=profile.path)
+        return accounting.totals
+    
+    async def _run_job(self, job_data: dict, client: Any, queue: str, estimator: WaitEstimator,
+                       memory_mb: float = 0.0):
+        """Run the owning worker's synchronous process_job in a thread"""
+        job_id = job_data.get('id')
+        if queue != self.queue_name:
+            logger.info(f"Took job {job_id} ({job_data.get('converter')}) from {queue}")
+        picked_at = time.time()
+        try:
+            usage = await asyncio.to_thread(self._process_with_accounting, job_data, queue)
+            if self.memory.enabled:
+                # Kept next to peakRssKb to calibrate the converter estimates
+                usage['memoryEstimateMb'] = round(memory_mb)
+            await client.hset(f"job:{job_id}", mapping=usage)
+            await estimator.record(job_data.get('converter'), queue, time.time() - picked_at,
+                                   queue_wait_seconds(job_data, picked_at))
+            logger.info(
+                f"Job {job_id} resources: cpu {usage['cpuUserSeconds']}s user / "
+                f"{usage['cpuSystemSeconds']}s sys, peak RSS {usage['peakRssKb']} KB, "
+                f"{usage['subprocessCount']} subprocesses",
+                extra={'jobId': job_id, 'tool': job_data.get('converter'), 'usage': usage}
+            )
+        except Exception as e:
+            logger.error(f"Job {job_id} crashed: {e}")
+        finally:
+            self.memory.release(memory_mb)
+            self.memory_freed.set()
+            self.job_slots.release()
+    
+    def _start_job(self, job_data: dict, client: Any, queue: str, estimator: WaitEstimator, memory_mb: float):
+        """Run an admitted job in the background; its slot and memory are released when it ends"""
+        task = asyncio.create_task(self._run_job(job_data, client, queue, estimator, memory_mb))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        
+        self.jobs_started += 1
+        if self.job_limit and self.jobs_started >= self.job_limit:
+            logger.info(f"Reached job limit of {self.job_limit}, recycling")
+            self.stopping = True
+    
+    async def serve(self):
+        """Pop jobs while slots are free and run them concurrently"""
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread_id = threading.get_ident()
+        # Each job holds a thread; leave room for transfers and progress callbacks
+        self.loop.set_default_executor(ThreadPoolExecutor(max_workers=self.max_jobs * 2 + 4))
+        self.job_slots = asyncio.Semaphore(self.max_jobs)
+        self.cpu_semaphore = asyncio.Semaphore(self.cpu_slots)
+        self.memory_freed = asyncio.Event()
+        
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            self.loop.add_signal_handler(sig, self.stop)
+        
+        client = aioredis.from_url(self.redis_url)
+        steal = client.register_script(STEAL_SCRIPT)
+        retry_queue = getattr(self.worker, 'retry_queue', None)
+        mover = asyncio.create_task(self._promote_retries(retry_queue)) if retry_queue else None
+        advertiser = asyncio.create_task(self._advertise(client))
+        estimator = WaitEstimator(client)
+        publisher = asyncio.create_task(self._publish_estimates(estimator))
+        profiling = asyncio.create_task(self._watch_profiling(client))
+        served = ', '.join([self.queue_name] + list(self.peers))
+        budget = f", {self.memory.budget_mb:.0f} MB memory budget" if self.memory.enabled else ""
+        logger.info(f"Async core serving {served} "
+                    f"({self.max_jobs} jobs, {self.cpu_slots} CPU slots of {self.threads.threads} "
+                    f"threads on {self.threads.cpus:g} CPUs{budget})")
+        
+        try:
+            while not self.stopping:
+                # Only pop when a slot is free so queued jobs stay visible to other workers
+                await self.job_slots.acquire()
+                if self.stopping:
+                    self.job_slots.release()
+                    break
+                
+                # Deferred jobs that fit now go first, smallest first
+                deferred = self.memory.next_deferred()
+                if deferred:
+                    queue, job_data, memory_mb = deferred
+                    self.memory.reserve(memory_mb)
+                    self._start_job(job_data, client, queue, estimator, memory_mb)
+                    continue
+                if not self.memory.accepting():
+                    self.job_slots.release()
+                    await self._wait_for_memory()
+                    continue
+                
+                try:
+                    # Don't block long on an empty queue while deferred jobs wait for memory
+                    idle_wait = 1 if self.memory.deferred else None
+                    self.pop_task = asyncio.ensure_future(self._pop(client, steal, idle_wait))
+                    item = await self.pop_task
+                except asyncio.CancelledError:
+                    self.job_slots.release()
+                    break
+                except Exception as e:
+                    self.job_slots.release()
+                    logger.error(f"Worker error: {e}")
+                    await asyncio.sleep(1)
+                    continue
+                
+                if not item:
+                    self.job_slots.release()
+                    logger.debug("No jobs in queue, waiting...")
+                    continue
+                
+                queue, raw = item
+                try:
+                    job_data = json.loads(raw.decode('utf-8'))
+                except ValueError as e:
+                    self.job_slots.release()
+                    logger.error(f"Dropping malformed job: {e}")
+                    continue
+                
+                if not await self._sniff(job_data, client, queue):
+                    self.job_slots.release()
+                    continue
+                memory_mb = await self._admit(job_data, queue)
+                if memory_mb is None:
+                    self.job_slots.release()
+                    continue
+                self._start_job(job_data, client, queue, estimator, memory_mb)
+            
+            await self._requeue_deferred(client)
+            if self.tasks:
+                logger.info(f"Draining {len(self.tasks)} in-flight jobs...")
+                await asyncio.gather(*self.tasks, return_exceptions=True)
+        finally:
+            if mover:
+                mover.cancel()
+            advertiser.cancel()
+            publisher.cancel()
+            profiling.cancel()
+            try:
+                pipe = client.pipeline(transaction=False)
+                pipe.delete(self.advert_key)
+                pipe.srem(adverts_key(self.queue_name), self.advert_key)
+                await pipe.execute()
+            except Exception:
+                pass
+            await client.aclose()
+    
+    def stop(self):
+        """Stop popping new jobs; in-flight jobs are allowed to finish"""
+        if not self.stopping:
+            logger.info("Worker shutting down...")
+        self.stopping = True
+        if self.pop_task and not self.pop_task.done():
+            self.pop_task.cancel()
+    
+    def run(self):
+        """Run the core until SIGINT/SIGTERM"""
+        global _active_core
+        _active_core = self
+        self.threads.activate()
+        try:
+            asyncio.run(self.serve())
+        finally:
+            _active_core = None
+
+
+def run_command(cmd: list, timeout: float, input: bytes = None, text: bool = False,
+                progress: Callable[[float], None] = None,
+                stdout_sink: Callable[[bytes], None] = None) -> subprocess.CompletedProcess:
+    """
+    Run a converter command and capture its output, like subprocess.run.
+    Under the async core the child counts against the CPU semaphore. Its
+    resource usage is added to the calling job's accounting. stdout_sink
+    receives stdout as it is produced instead (stdout is then empty).
+    Raises subprocess.TimeoutExpired on timeout.
+    """
+    if text and input is not None:
+        input = input.encode('utf-8')
+    
+    with span('exec', tool=os.path.basename(cmd[0]), timeout=timeout) as exec_span:
+        core = _active_core
+        if core and core.loop and threading.get_ident() != core.loop_thread_id:
+            result = core.run_command(cmd, timeout, input, progress, stdout_sink)
+        else:
+            result = supervise(cmd, timeout, input, stdout_sink=stdout_sink)
+        exec_span.set('exitCode', result.returncode)
+        exec_span.set('timedOut', result.timed_out)
+        exec_span.set('usage', result.usage)
+    
+    accounting = JobAccounting.current()
+    if accounting:
+        accounting.add(result.usage)
+    if result.timed_out:
+        raise subprocess.TimeoutExpired(cmd, timeout)
+    
+    stdout, stderr = result.stdout, result.stderr
+    if text:
+        stdout = stdout.decode('utf-8', errors='replace')
+        stderr = stderr.decode('utf-8', errors='replace')
+    return subprocess.CompletedProcess(cmd, result.returncode, stdout, stderr)
@@ -0,0 +1,200 @@
+"""
+Queue-depth autoscaling
+With WORKER_AUTOSCALE=1 the pre-fork master sizes its pool of worker
+processes from its queue instead of keeping WORKER_PROCESSES fixed. Every
+few seconds it reads the queue's length and how long its oldest jobs have
+waited, and picks a process count between WORKER_MIN_PROCESSES and
+WORKER_MAX_PROCESSES. Scaling up happens at once. Scaling down needs the
+queue to stay well below the scale-up threshold for a while and goes one
+process at a time, so the pool doesn't flap around a threshold. Retired
+processes drain their in-flight jobs before they exit. Every evaluation is
+published to Redis (autoscale:{queue}) and every change is logged to
+autoscale:{queue}:events.
+"""
+
+import os
+import json
+import math
+import time
+import socket
+import logging
+from typing import Any, Dict, List, NamedTuple, Optional
+
+import redis
+
+from common.eta import queue_wait_seconds
+
+logger = logging.getLogger(__name__)
+
+# Jobs read from the old end of a queue to find how long it has been waiting
+AGE_SAMPLE = 10
+# Change events kept per queue
+EVENTS_MAXLEN = 200
+
+
+def autoscale_enabled() -> bool:
+    return os.getenv('WORKER_AUTOSCALE') == '1'
+
+
+def pool_size() -> int:
+    """
+    Most worker processes a container runs at once: WORKER_MAX_PROCESSES
+    when autoscaling, else WORKER_PROCESSES. Per-process shares of the
+    container's CPUs and memory are sized for this many.
+    """
+    if autoscale_enabled():
+        return max(int(os.getenv('WORKER_MAX_PROCESSES') or 4), 1)
+    return max(int(os.getenv('WORKER_PROCESSES') or 1), 1)
+
+
+class QueueLoad(NamedTuple):
+    depth: int
+    # Seconds the longest-waiting queued job has waited, 0 when unknown or empty
+    oldest_age: float
+
+
+class Decision(NamedTuple):
+    target: int
+    # 'up', 'down' or 'hold'
+    action: str
+    reason: str
+
+
+def read_load(client: Any, queue: str) -> QueueLoad:
+    """Length of a queue and the wait of its oldest jobs (retries, which carry no wait, are skipped)"""
+    pipe = client.pipeline(transaction=False)
+    pipe.llen(queue)
+    # Jobs are pushed on the left, so the oldest sit at the right end
+    pipe.lrange(queue, -AGE_SAMPLE, -1)
+    depth, oldest = pipe.execute()
+    now = time.time()
+    age = 0.0
+    for raw in oldest:
+        try:
+            age = max(age, queue_wait_seconds(json.loads(raw), now))
+        except (ValueError, AttributeError):
+            continue
+    return QueueLoad(int(depth), age)
+
+
+class Autoscaler:
+    """
+    Picks the process count of one queue's pool. Up: one process per
+    AUTOSCALE_JOBS_PER_PROCESS queued jobs, or one more when the oldest job
+    has waited past AUTOSCALE_MAX_WAIT_SECONDS. Down: one process fewer once
+    the queue has fit in half the remaining processes' share for
+    AUTOSCALE_SCALE_DOWN_DELAY_SECONDS, and no sooner than
+    AUTOSCALE_COOLDOWN_SECONDS after the last change.
+    """
+
+    def __init__(self, queue: str, client: Any = None, min_processes: int = None, max_processes: int = None):
+        self.queue = queue
+        self.client = client or redis.Redis.from_url(os.getenv('REDIS_URL', 'redis://localhost:6379'))
+        self.min_processes = max(min_processes or int(os.getenv('WORKER_MIN_PROCESSES') or 1), 1)
+        self.max_processes = max(max_processes or pool_size(), self.min_processes)
+        self.interval = float(os.getenv('AUTOSCALE_INTERVAL_SECONDS') or 5)
+        self.jobs_per_process = float(os.getenv('AUTOSCALE_JOBS_PER_PROCESS') or 4)
+        self.max_wait = float(os.getenv('AUTOSCALE_MAX_WAIT_SECONDS') or 30)
+        # Scale down only below this share of the scale-up threshold
+        self.down_ratio = float(os.getenv('AUTOSCALE_SCALE_DOWN_RATIO') or 0.5)
+        self.down_delay = float(os.getenv('AUTOSCALE_SCALE_DOWN_DELAY_SECONDS') or 120)
+        self.cooldown = float(os.getenv('AUTOSCALE_COOLDOWN_SECONDS') or 60)
+
+        self.instance = f"{socket.gethostname()}:{os.getpid()}"
+        self.quiet_since: Optional[float] = None
+        self.changed_at = 0.0
+        self.counts = {'up': 0, 'down': 0}
+        self.last_change: Optional[Dict[str, Any]] = None
+
+    def decide(self, current: int, load: QueueLoad, now: float) -> Decision:
+        """Process count for the pool given how many processes it runs and its queue's load"""
+        if current < self.min_processes:
+            return Decision(self.min_processes, 'up', f"below minimum of {self.min_processes}")
+        if current > self.max_processes:
+            return Decision(self.max_processes, 'down', f"above maximum of {self.max_processes}")
+
+        wanted = math.ceil(load.depth / self.jobs_per_process)
+        stale = load.oldest_age > self.max_wait
+        if wanted > current or stale:
+            self.quiet_since = None
+            target = min(max(wanted, current + 1 if stale else current), self.max_processes)
+            if target == current:
+                return Decision(current, 'hold', f"at maximum of {self.max_processes}")
+            reason = (f"oldest job waited {load.oldest_age:.0f}s" if stale and wanted <= current
+                      else f"{load.depth} jobs queued")
+            return Decision(target, 'up', reason)
+
+        quiet = (load.depth <= self.jobs_per_process * (current - 1) * self.down_ratio and
+                 load.oldest_age <= self.max_wait / 2)
+        if current <= self.min_processes or not quiet:
+            self.quiet_since = None
+            return Decision(current, 'hold', 'steady')
+        if self.quiet_since is None:
+            self.quiet_since = now
+        if now - self.quiet_since < self.down_delay or now - self.changed_at < self.cooldown:
+            return Decision(current, 'hold', 'waiting to scale down')
+        # Each further step down waits out the delay again
+        self.quiet_since = now
+        return Decision(current - 1, 'down', f"queue short for {self.down_delay:.0f}s ({load.depth} jobs)")
+
+    def evaluate(self, current: int) -> Decision:
+        """Read the queue, decide, and publish the decision"""
+        now = time.time()
+        load = read_load(self.client, self.queue)
+        decision = self.decide(current, load, now)
+        if decision.action != 'hold':
+            self.changed_at = now
+            self.counts[decision.action] += 1
+            self.last_change = {'action': decision.action, 'from': current, 'to': decision.target,
+                                'reason': decision.reason, 'at': int(now)}
+            logger.info(f"Autoscaling {self.queue} from {current} to {decision.target} processes: {decision.reason}")
+        self.publish(current, load, decision, now)
+        return decision
+
+    def publish(self, current: int, load: QueueLoad, decision: Decision, now: float):
+        """Record the pool's state under autoscale:{queue}, and changes in autoscale:{queue}:events"""
+        status = {
+            'queue': self.queue,
+            'processes': current,
+            'target': decision.target,
+            'minProcesses': self.min_processes,
+            'maxProcesses': self.max_processes,
+            'depth': load.depth,
+            'oldestWaitSeconds': round(load.oldest_age, 1),
+            'action': decision.action,
+            'reason': decision.reason,
+            'scaleUps': self.counts['up'],
+            'scaleDowns': self.counts['down'],
+            'lastChange': self.last_change,
+            'updatedAt': int(now)
+        }
+        key = f"autoscale:{self.queue}"
+        try:
+            pipe = self.client.pipeline(transaction=False)
+            pipe.hset(key, self.instance, json.dumps(status))
+            # Masters that stop reporting drop out once the whole hash goes quiet
+            pipe.expire(key, int(self.interval * 12))
+            if decision.action != 'hold':
+                pipe.lpush(f"{key}:events", json.dumps(dict(self.last_change, instance=self.instance)))
+                pipe.ltrim(f"{key}:events", 0, EVENTS_MAXLEN - 1)
+            pipe.execute()
+        except Exception as e:
+            logger.warning(f"Could not publish autoscaler state for {self.queue}: {e}")
+
+    def least_busy(self, pids: List[int], count: int) -> List[int]:
+        """The children to retire: fewest jobs in flight per their worker adverts, newest first on ties"""
+        if count <= 0:
+            return []
+        host = socket.gethostname()
+        try:
+            adverts = self.client.mget([f"worker:{host}:{pid}" for pid in pids])
+        except Exception as e:
+            logger.warning(f"Could not read worker adverts: {e}")
+            adverts = [None] * len(pids)
+        active = {}
+        for pid, raw in zip(pids, adverts):
+            try:
+                active[pid] = int(json.loads(raw).get('activeJobs') or 0) if raw else 0
+            except (ValueError, AttributeError):
+                active[pid] = 0
+        return sorted(pids, key=lambda pid: (active[pid], -pids.index(pid)))[:count]
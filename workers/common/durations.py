@@ -0,0 +1,171 @@
+"""
+Per-converter duration model
+Workers record (converter, input size, work units, wall time) samples in
+Redis. Units are pages, media seconds or megapixels when the worker can
+measure them. A per-converter least-squares fit then drives timeouts and
+progress/ETA estimates instead of fixed numbers.
+"""
+
+import os
+import json
+import time
+import logging
+import threading
+import contextvars
+from typing import Any, Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class DurationModel:
+    def __init__(self, redis_client: Any):
+        self.redis_client = redis_client
+        self.max_samples = int(os.getenv('DURATION_MAX_SAMPLES') or 200)
+        self.min_samples = int(os.getenv('DURATION_MIN_SAMPLES') or 10)
+        self.min_timeout = int(os.getenv('JOB_MIN_TIMEOUT_SECONDS') or 15)
+        self.max_timeout = int(os.getenv('JOB_MAX_TIMEOUT_SECONDS') or 1800)
+        self.safety_factor = float(os.getenv('JOB_TIMEOUT_SAFETY_FACTOR') or 2.0)
+        self.cache_seconds = 60
+        self._fits: Dict[str, tuple] = {}  # converter -> (fitted_at, fit)
+        self._lock = threading.Lock()
+    
+    def record(self, converter: str, input_size: int, units: Optional[float], wall_time: float):
+        """Store one successful conversion sample"""
+        sample = json.dumps({
+            'size': input_size,
+            'units': units,
+            'wall': round(wall_time, 3),
+            'at': int(time.time())
+        })
+        key = f"durations:{converter}"
+        try:
+            pipe = self.redis_client.pipeline()
+            pipe.lpush(key, sample)
+            pipe.ltrim(key, 0, self.max_samples - 1)
+            pipe.execute()
+        except Exception as e:
+            logger.warning(f"Failed to record duration sample for {converter}: {e}")
+    
+    def load_samples(self, converter: str) -> List[dict]:
+        """Read recent samples for a converter"""
+        try:
+            raw = self.redis_client.lrange(f"durations:{converter}", 0, self.max_samples - 1)
+            return [json.loads(item) for item in raw]
+        except Exception as e:
+            logger.warning(f"Failed to load duration samples for {converter}: {e}")
+            return []
+    
+    @staticmethod
+    def feature(sample_size: int, units: Optional[float], use_units: bool) -> float:
+        """Work measure the model regresses on: units if known, else MB"""
+        if use_units:
+            return float(units)
+        return sample_size / (1024 * 1024)
+    
+    def fit(self, converter: str) -> Optional[dict]:
+        """Fit wall = intercept + slope * x, cached for a minute"""
+        with self._lock:
+            cached = self._fits.get(converter)
+            if cached and time.time() - cached[0] < self.cache_seconds:
+                return cached[1]
+        
+        samples = self.load_samples(converter)
+        fit = None
+        if len(samples) >= self.min_samples:
+            use_units = all(s.get('units') is not None for s in samples)
+            xs = [self.feature(s['size'], s.get('units'), use_units) for s in samples]
+            ys = [s['wall'] for s in samples]
+            n = len(xs)
+            mean_x = sum(xs) / n
+            mean_y = sum(ys) / n
+            var_x = sum((x - mean_x) ** 2 for x in xs)
+            slope = sum((x - mean_x) * (y - mean_y) for x, y in zip(xs, ys)) / var_x if var_x else 0.0
+            slope = max(slope, 0.0)
+            intercept = max(mean_y - slope * mean_x, 0.1)
+            
+            # How far actual runs land above the line; scales the timeout
+            ratios = sorted(y / (intercept + slope * x) for x, y in zip(xs, ys))
+            p95_ratio = max(ratios[min(n - 1, int(n * 0.95))], 1.0)
+            
+            fit = {
+                'intercept': intercept,
+                'slope': slope,
+                'use_units': use_units,
+                'p95_ratio': p95_ratio,
+                'samples': n
+            }
+        
+        with self._lock:
+            self._fits[converter] = (time.time(), fit)
+        return fit
+    
+    def estimate(self, converter: str, input_size: int, units: Optional[float] = None) -> Optional[float]:
+        """Expected wall time in seconds, None until enough samples exist"""
+        fit = self.fit(converter)
+        if not fit:
+            return None
+        if fit['use_units'] and units is None:
+            return None
+        x = self.feature(input_size, units, fit['use_units'])
+        return fit['intercept'] + fit['slope'] * x
+    
+    def timeout_for(self, converter: str, input_size: int, units: Optional[float] = None,
+                    default: int = 120) -> int:
+        """Timeout scaled to the expected duration, falling back to the default"""
+        fit = self.fit(converter)
+        expected = self.estimate(converter, input_size, units)
+        if fit is None or expected is None:
+            return default
+        timeout = expected * fit['p95_ratio'] * self.safety_factor
+        return int(min(max(timeout, self.min_timeout), self.max_timeout))
+    
+    def track(self, expected: Optional[float], timeout: float, update: Callable[[int, Optional[float]], None],
+              start_progress: int = 30, end_progress: int = 75) -> 'ProgressTracker':
+        """
+        Start reporting progress and ETA against the expected duration.
+        Without an estimate progress runs against the timeout and no ETA is reported.
+        """
+        tracker = ProgressTracker(expected or timeout, update, start_progress, end_progress,
+                                  report_eta=expected is not None)
+        tracker.start()
+        return tracker
+
+
+class ProgressTracker(threading.Thread):
+    """Reports progress and remaining seconds every couple of seconds until stopped"""
+    
+    def __init__(self, expected: float, update: Callable[[int, Optional[float]], None],
+                 start_progress: int, end_progress: int, report_eta: bool = True, interval: float = 2.0):
+        super().__init__(daemon=True)
+        self.expected = max(expected, 0.1)
+        self.update = update
+        self.start_progress = start_progress
+        self.end_progress = end_progress
+        self.report_eta = report_eta
+        self.interval = interval
+        self.started_at = time.time()
+        self.finished = threading.Event()
+        # Run updates in the job's context so they join its trace
+        self.context = contextvars.copy_context()
+    
+    def run(self):
+        while not self.finished.wait(self.interval):
+            elapsed = time.time() - self.started_at
+            # Never claim completion on the estimate alone
+            fraction = min(elapsed / self.expected, 0.95)
+            progress = int(self.start_progress + (self.end_progress - self.start_progress) * fraction)
+            try:
+                eta = max(self.expected - elapsed, 0.0) if self.report_eta else None
+                self.context.run(self.update, progress, eta)
+            except Exception as e:
+                logger.warning(f"Progress update failed: {e}")
+    
+    def stop(self):
+        self.finished.set()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc):
+        self.stop()
+        return False
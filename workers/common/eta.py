@@ -0,0 +1,201 @@
+"""
+Queue wait estimates
+Workers keep moving averages of service time and queue wait per converter
+in Redis (stats:{converter}) and count completions in per-minute buckets.
+One worker per queue periodically turns the queue's contents into an
+expected wait. It publishes that to eta:{queue} together with per-converter
+ETAs. The web tier reads it to show ETAs and to turn uploads away while a
+queue is past its latency budget.
+"""
+
+import json
+import time
+import logging
+from datetime import datetime
+from typing import Any, Dict, Optional
+
+from common.registry import CONVERTERS, PIPELINE
+
+logger = logging.getLogger(__name__)
+
+# Weight of the newest sample in the moving averages
+EWMA_ALPHA = 0.2
+# Completion counters are kept per minute for this long
+THROUGHPUT_WINDOW_MINUTES = 5
+# Queue items inspected to learn the converter mix of a long queue
+SAMPLE_SIZE = 1000
+# Seconds between estimates, and how long a published estimate stays valid
+PUBLISH_INTERVAL = 5
+ESTIMATE_TTL = 30
+# Service time assumed for converters without samples yet
+DEFAULT_SERVICE_SECONDS = {'light': 5.0, 'medium': 30.0, 'heavy': 90.0}
+
+# Fold one finished job into stats:{converter} (KEYS[1]) and bump the
+# throughput buckets in KEYS[2..]. A negative wait (retried job) is skipped.
+RECORD_SCRIPT = """
+local alpha = tonumber(ARGV[1])
+local service = tonumber(ARGV[2])
+local wait = tonumber(ARGV[3])
+local old = redis.call('HMGET', KEYS[1], 'ewmaSeconds', 'ewmaWaitSeconds')
+if old[1] then service = alpha * service + (1 - alpha) * tonumber(old[1]) end
+redis.call('HSET', KEYS[1], 'ewmaSeconds', tostring(service), 'updatedAt', ARGV[4])
+if wait >= 0 then
+    if old[2] then wait = alpha * wait + (1 - alpha) * tonumber(old[2]) end
+    redis.call('HSET', KEYS[1], 'ewmaWaitSeconds', tostring(wait))
+end
+redis.call('HINCRBY', KEYS[1], 'completed', 1)
+for i = 2, #KEYS do
+    redis.call('INCR', KEYS[i])
+    redis.call('EXPIRE', KEYS[i], tonumber(ARGV[5]))
+end
+return 1
+"""
+
+
+def adverts_key(queue: str) -> str:
+    """Set of the advert keys (worker:{host}:{pid}) of the workers whose home is a queue"""
+    return f"workers:{queue}"
+
+
+def queue_wait_seconds(job_data: Dict[str, Any], picked_at: float) -> float:
+    """Seconds a job spent queued before it was picked up, -1 for retries or unknown"""
+    if job_data.get('retryCount'):
+        return -1.0
+    try:
+        created = datetime.fromisoformat(job_data['createdAt'].replace('Z', '+00:00'))
+        return max(picked_at - created.timestamp(), 0.0)
+    except (KeyError, AttributeError, ValueError):
+        return -1.0
+
+
+class WaitEstimator:
+    def __init__(self, client: Any):
+        self.client = client
+        self._record = client.register_script(RECORD_SCRIPT)
+    
+    async def record(self, converter: str, queue: str, service_seconds: float, wait_seconds: float):
+        """Update the moving averages and throughput counters after a job"""
+        minute = int(time.time() // 60)
+        ttl = (THROUGHPUT_WINDOW_MINUTES + 1) * 60
+        try:
+            await self._record(
+                keys=[f"stats:{converter}", f"throughput:{converter}:{minute}", f"throughput:{queue}:{minute}"],
+                args=[EWMA_ALPHA, round(service_seconds, 3), round(wait_seconds, 3), int(time.time()), ttl]
+            )
+        except Exception as e:
+            logger.warning(f"Failed to record queue stats for {converter}: {e}")
+    
+    async def service_times(self, queue: str) -> Dict[str, float]:
+        """Moving average service time of every converter routed to a queue"""
+        names = [name for name, spec in CONVERTERS.items() if spec.queue == queue] + [PIPELINE]
+        pipe = self.client.pipeline(transaction=False)
+        for name in names:
+            pipe.hget(f"stats:{name}", 'ewmaSeconds')
+        averages = await pipe.execute()
+        
+        known = [float(value) for value in averages if value]
+        times = {}
+        for name, value in zip(names, averages):
+            if value:
+                times[name] = float(value)
+            elif name in CONVERTERS:
+                times[name] = DEFAULT_SERVICE_SECONDS[CONVERTERS[name].cost]
+            else:
+                # Pipelines run at least one step; assume an average one
+                times[name] = sum(known) / len(known) if known else DEFAULT_SERVICE_SECONDS['medium']
+        return times
+    
+    async def capacity(self, queue: str) -> tuple:
+        """
+        Concurrent job slots and jobs in flight of the workers whose home is
+        a queue. Stealing workers serve it only when they have nothing
+        better, so they are not counted.
+        """
+        key = adverts_key(queue)
+        names = sorted(await self.client.smembers(key))
+        if not names:
+            return 0, 0
+        adverts = await self.client.mget(names)
+        slots = 0
+        active = 0
+        expired = []
+        for name, raw in zip(names, adverts):
+            if not raw:
+                expired.append(name)
+                continue
+            try:
+                advert = json.loads(raw)
+            except ValueError:
+                continue
+            slots += int(advert.get('maxJobs') or 1)
+            active += int(advert.get('activeJobs') or 0)
+        if expired:
+            # Workers that died without deregistering
+            await self.client.srem(key, *expired)
+        return slots, active
+    
+    async def throughput(self, name: str) -> float:
+        """Completions per minute over the recent window"""
+        minute = int(time.time() // 60)
+        # The current minute is still filling up, so average over the full ones before it
+        keys = [f"throughput:{name}:{minute - offset}" for offset in range(1, THROUGHPUT_WINDOW_MINUTES + 1)]
+        counts = await self.client.mget(keys)
+        return sum(int(count) for count in counts if count) / THROUGHPUT_WINDOW_MINUTES
+    
+    async def estimate(self, queue: str) -> Dict[str, Any]:
+        """
+        Expected wait for a queue: the work ahead (queued jobs weighted by
+        their converter's service time, delayed retries and half of what is in
+        flight) spread over the job slots of the workers serving it.
+        """
+        pipe = self.client.pipeline(transaction=False)
+        pipe.llen(queue)
+        pipe.zcard(f"{queue}:delayed")
+        pipe.lrange(queue, 0, SAMPLE_SIZE - 1)
+        depth, delayed, sample = await pipe.execute()
+        
+        service = await self.service_times(queue)
+        counts: Dict[str, int] = {}
+        for raw in sample:
+            try:
+                name = json.loads(raw).get('converter')
+            except ValueError:
+                continue
+            if name in service:
+                counts[name] = counts.get(name, 0) + 1
+        
+        sampled = sum(counts.values())
+        # Average service time of what is queued, or of the queue's converters when empty
+        mean_service = (sum(service[name] * n for name, n in counts.items()) / sampled if sampled
+                        else sum(service.values()) / len(service))
+        queued_work = mean_service * depth
+        slots, active = await self.capacity(queue)
+        work = queued_work + mean_service * delayed + mean_service * active / 2
+        wait = work / slots if slots else None
+        
+        converters = {}
+        for name, seconds in service.items():
+            converters[name] = {
+                'serviceSeconds': round(seconds, 1),
+                'etaSeconds': round(wait + seconds, 1) if wait is not None else None
+            }
+        return {
+            'queue': queue,
+            'depth': depth,
+            'delayed': delayed,
+            'activeJobs': active,
+            'slots': slots,
+            'waitSeconds': round(wait, 1) if wait is not None else None,
+            'throughputPerMinute': round(await self.throughput(queue), 2),
+            'converters': converters,
+            'updatedAt': int(time.time())
+        }
+    
+    async def publish(self, queue: str) -> Optional[Dict[str, Any]]:
+        """Publish a fresh estimate unless another worker of the queue just did"""
+        claimed = await self.client.set(f"eta:{queue}:lock", 1, nx=True, px=PUBLISH_INTERVAL * 1000 - 100)
+        if not claimed:
+            return None
+        estimate = await self.estimate(queue)
+        await self.client.set(f"eta:{queue}", json.dumps(estimate), ex=ESTIMATE_TTL)
+        return estimate
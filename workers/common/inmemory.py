@@ -0,0 +1,112 @@
+"""
+In-memory pipeline
+Inputs no larger than IN_MEMORY_MAX_MB, for the converters a worker lists,
+never touch the filesystem: they are downloaded into a buffer, converted
+through pipes or in-process libraries, and uploaded from memory. A job
+that fails on this path falls back to the worker's disk pipeline.
+"""
+
+import io
+import os
+import time
+import logging
+from typing import Any, Callable, Dict, Iterable, Optional
+
+from common.sniff import Probe, probed_units
+from common.tracing import span
+
+logger = logging.getLogger(__name__)
+
+
+class InMemoryPipeline:
+    """
+    Zero-disk path of a worker. The worker provides storage, durations,
+    timeouts and update_job_status; they are looked up on each job, so a
+    swapped storage backend is picked up.
+    """
+
+    def __init__(self, worker: Any, converters: Iterable[str]):
+        self.worker = worker
+        self.converters = frozenset(converters)
+        # Inputs up to this size qualify; 0 turns the path off
+        self.threshold = int(float(os.getenv('IN_MEMORY_MAX_MB', '8')) * 1024 * 1024)
+
+    def download(self, key: str) -> Optional[bytes]:
+        """Download file from storage into memory"""
+        try:
+            buffer = io.BytesIO()
+            with span('download', key=key, inMemory=True) as download_span:
+                self.worker.storage.download_fileobj(key, buffer)
+                download_span.set('size', buffer.tell())
+            logger.info(f"Downloaded {key} into memory ({buffer.tell()} bytes)")
+            return buffer.getvalue()
+        except Exception as e:
+            logger.error(f"Failed to download {key}: {e}")
+            return None
+
+    def upload(self, data: bytes, key: str) -> bool:
+        """Upload in-memory data to storage"""
+        try:
+            with span('upload', key=key, size=len(data), inMemory=True):
+                self.worker.storage.upload_fileobj(io.BytesIO(data), key)
+            logger.info(f"Uploaded {len(data)} bytes from memory to {key}")
+            return True
+        except Exception as e:
+            logger.error(f"Failed to upload to {key}: {e}")
+            return False
+
+    def qualifies(self, job_data: Dict[str, Any]) -> bool:
+        """
+        Check whether a job qualifies for the zero-disk pipeline, by the
+        input size the core's probe attached, or a HEAD request without one
+        """
+        if self.threshold <= 0 or job_data['converter'] not in self.converters:
+            return False
+        probe = Probe.from_job(job_data)
+        if probe:
+            return probe.size <= self.threshold
+        input_key = job_data['inputKey']
+        try:
+            return self.worker.storage.head(input_key).size <= self.threshold
+        except Exception as e:
+            logger.warning(f"Could not stat {input_key}, using disk pipeline: {e}")
+            return False
+
+    def run(self, job_data: Dict[str, Any], convert: Callable[[bytes, int], Optional[bytes]],
+            converted: Callable[[bytes, bytes, float], None] = None) -> bool:
+        """
+        Run a small job without touching the filesystem; False means fall
+        back to disk. convert(data, timeout) returns the output or None,
+        and converted(data, output, seconds) is told about a conversion
+        before its upload.
+        """
+        worker = self.worker
+        job_id = job_data['id']
+        converter_type = job_data['converter']
+
+        worker.update_job_status(job_id, 'downloading', 10)
+        data = self.download(job_data['inputKey'])
+        if data is None:
+            return False
+
+        worker.update_job_status(job_id, 'processing', 30)
+        units = probed_units(job_data)
+        timeout = worker.durations.timeout_for(
+            converter_type, len(data), units, worker.timeouts.get(converter_type, worker.timeouts['default'])
+        )
+        convert_start = time.time()
+        with span('convert', tool=converter_type, size=len(data), inMemory=True):
+            output = convert(data, timeout)
+        if output is None:
+            return False
+        convert_seconds = time.time() - convert_start
+        worker.durations.record(converter_type, len(data), units, convert_seconds)
+        if converted:
+            converted(data, output, convert_seconds)
+
+        worker.update_job_status(job_id, 'uploading', 80)
+        if not self.upload(output, job_data['outputKey']):
+            return False
+
+        worker.update_job_status(job_id, 'completed', 100)
+        return True
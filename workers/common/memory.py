@@ -0,0 +1,169 @@
+"""
+Memory-aware admission
+Every worker process gets a memory budget (WORKER_MEMORY_BUDGET_MB, by
+default a share of the container's cgroup limit). Before a job starts,
+the async core estimates its peak memory from the converter's declared
+baseline, the input size and, for raster images, the pixel count read
+from the file header (the input probe of common.sniff when the job has
+one). Jobs that would push the process past its budget wait in a small
+local backlog, and the smallest one that fits runs first.
+"""
+
+import io
+import os
+import time
+import logging
+from typing import Any, Dict, List, Optional, Tuple
+
+from common.autoscale import pool_size
+from common.registry import CONVERTERS
+
+logger = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+# Share of the cgroup limit handed out to jobs; the rest covers the worker itself
+BUDGET_FRACTION = 0.8
+# Bytes fetched from the start of an image to read its dimensions
+HEADER_BYTES = 64 * 1024
+# Compressed bytes per pixel assumed when an image's dimensions can't be read
+ASSUMED_BYTES_PER_PIXEL = 0.5
+
+CGROUP_LIMIT_PATHS = ('/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory/memory.limit_in_bytes')
+
+
+def cgroup_memory_limit() -> Optional[int]:
+    """Memory limit of the container in bytes, None when unlimited or unknown"""
+    for path in CGROUP_LIMIT_PATHS:
+        try:
+            with open(path) as f:
+                raw = f.read().strip()
+        except OSError:
+            continue
+        if raw == 'max':
+            return None
+        try:
+            limit = int(raw)
+        except ValueError:
+            continue
+        # cgroup v1 reports a huge number rather than 'max' when unlimited
+        return limit if limit < 1 << 60 else None
+    return None
+
+
+def default_budget_mb() -> float:
+    """
+    WORKER_MEMORY_BUDGET_MB, or a share of the cgroup limit split between
+    the worker processes of the container (WORKER_PROCESSES, or
+    WORKER_MAX_PROCESSES when autoscaling). 0 turns admission control off.
+    """
+    configured = os.getenv('WORKER_MEMORY_BUDGET_MB')
+    if configured:
+        return float(configured)
+    limit = cgroup_memory_limit()
+    if not limit:
+        return 0.0
+    return limit / MB * BUDGET_FRACTION / pool_size()
+
+
+def image_megapixels(header: bytes) -> Optional[float]:
+    """Pixel count of an image in millions from its first bytes, None if unreadable"""
+    try:
+        from PIL import Image
+    except ImportError:
+        return None
+    try:
+        # Opening only parses the header; nothing is decoded
+        with Image.open(io.BytesIO(header)) as image:
+            width, height = image.size
+    except Exception:
+        return None
+    return width * height / 1e6
+
+
+def estimate_peak_mb(converter_type: str, size: int, options: Dict[str, Any],
+                     megapixels: Optional[float] = None) -> float:
+    """Expected peak memory of one converter run in MB"""
+    spec = CONVERTERS.get(converter_type)
+    if not spec:
+        return 0.0
+    estimate = spec.memory_mb + spec.memory_per_mb * size / MB
+    if spec.memory_per_megapixel:
+        if megapixels is None:
+            megapixels = size / ASSUMED_BYTES_PER_PIXEL / 1e6
+        # Upscaling holds the enlarged image as well
+        scale = float(options.get('scale') or 1)
+        estimate += spec.memory_per_megapixel * megapixels * max(scale, 1) ** 2
+    return estimate
+
+
+def estimate_job_mb(storage: Any, input_key: str, steps: List[Tuple[str, Dict[str, Any]]],
+                    probe: Any = None) -> float:
+    """
+    Peak memory of a job running the given (converter, options) steps on
+    an input, the largest over its steps since they run one at a time.
+    A probe of the input saves fetching its size and header again.
+    """
+    size = probe.size if probe else storage.head(input_key).size
+    megapixels = None
+    if any(CONVERTERS[name].memory_per_megapixel for name, _ in steps if name in CONVERTERS):
+        if probe:
+            megapixels = probe.megapixels
+        else:
+            megapixels = image_megapixels(storage.read_range(input_key, 0, HEADER_BYTES))
+    return max((estimate_peak_mb(name, size, options, megapixels) for name, options in steps), default=0.0)
+
+
+class MemoryAdmission:
+    """
+    Memory reserved by the jobs running in one process, and the jobs
+    deferred because they did not fit. A job always runs when nothing else
+    does, so one larger than the whole budget still gets its turn alone.
+    """
+    
+    def __init__(self, budget_mb: float = None, max_deferred: int = None, max_wait: float = None):
+        self.budget_mb = default_budget_mb() if budget_mb is None else budget_mb
+        self.max_deferred = max_deferred or int(os.getenv('WORKER_MEMORY_MAX_DEFERRED') or 8)
+        # A deferred job older than this blocks new work until it fits
+        self.max_wait = max_wait or float(os.getenv('WORKER_MEMORY_MAX_WAIT_SECONDS') or 120)
+        self.reserved_mb = 0.0
+        self.running = 0
+        self.deferred: List[Tuple[float, float, str, Dict[str, Any]]] = []  # (estimate, deferred_at, queue, job)
+    
+    @property
+    def enabled(self) -> bool:
+        return self.budget_mb > 0
+    
+    def fits(self, estimate: float) -> bool:
+        return not self.enabled or self.running == 0 or self.reserved_mb + estimate <= self.budget_mb
+    
+    def reserve(self, estimate: float):
+        self.reserved_mb += estimate
+        self.running += 1
+    
+    def release(self, estimate: float):
+        self.reserved_mb = max(self.reserved_mb - estimate, 0.0)
+        self.running -= 1
+    
+    def defer(self, queue: str, job_data: Dict[str, Any], estimate: float):
+        self.deferred.append((estimate, time.monotonic(), queue, job_data))
+    
+    def _oldest(self) -> Optional[Tuple[float, float, str, Dict[str, Any]]]:
+        """The longest-waiting deferred job once it has waited past max_wait"""
+        if not self.deferred:
+            return None
+        oldest = min(self.deferred, key=lambda entry: entry[1])
+        return oldest if time.monotonic() - oldest[1] > self.max_wait else None
+    
+    def accepting(self) -> bool:
+        """Whether new jobs may be taken from the queues"""
+        return len(self.deferred) < self.max_deferred and self._oldest() is None
+    
+    def next_deferred(self) -> Optional[Tuple[str, Dict[str, Any], float]]:
+        """The smallest deferred job that fits now, or the starving one once it fits, as (queue, job, estimate)"""
+        starving = self._oldest()
+        candidates = [starving] if starving else sorted(self.deferred, key=lambda entry: entry[0])
+        for entry in candidates:
+            if self.fits(entry[0]):
+                self.deferred.remove(entry)
+                return entry[2], entry[3], entry[0]
+        return None
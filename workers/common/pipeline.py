@@ -0,0 +1,153 @@
+"""
+Pipeline jobs
+A pipeline job (converter 'pipeline') lists converter steps, or only a
+target format, in its options. The runner plans the chain over the
+converters this process can run, executes the steps back-to-back on local
+scratch files and uploads only the final artifact, so intermediate results
+never make a storage round-trip or wait in a queue again.
+"""
+
+import os
+import time
+import shutil
+import logging
+import tempfile
+from typing import Any, Dict, List, Tuple
+
+from common.registry import CONVERTERS, dispatch, normalize_format, plan_chain
+from common.tracing import span
+
+logger = logging.getLogger(__name__)
+
+# Upper bound on explicitly listed steps
+MAX_STEPS = 8
+
+
+class PipelineError(Exception):
+    """A pipeline that cannot be planned or run here; retrying will not help"""
+
+
+class PipelineRunner:
+    def __init__(self, host: Any, executors: Dict[str, Any]):
+        # The worker the job was popped for does transfers and status writes
+        self.host = host
+        # Converter name -> worker instance in this process that runs it
+        self.executors = executors
+
+    def source_format(self, job_data: Dict[str, Any]) -> str:
+        """Input format, from the options or the input key's extension"""
+        source = (job_data.get('options') or {}).get('source') or os.path.splitext(job_data['inputKey'])[1]
+        return normalize_format(source)
+
+    def plan(self, job_data: Dict[str, Any]) -> List[Tuple[str, Dict[str, Any]]]:
+        """
+        Resolve the steps of a pipeline job as (converter, options) pairs.
+        Options outside steps/target/source apply to every step; a step's own
+        options override them.
+        """
+        options = dict(job_data.get('options') or {})
+        steps = options.pop('steps', None)
+        target = options.pop('target', None)
+        options.pop('source', None)
+        # A pipeline uploads a single final artifact
+        options.pop('outputs', None)
+        fmt = self.source_format(job_data)
+
+        if steps:
+            if len(steps) > MAX_STEPS:
+                raise PipelineError(f"Pipeline has {len(steps)} steps, at most {MAX_STEPS} are allowed")
+            plan = []
+            for step in steps:
+                if isinstance(step, str):
+                    step = {'converter': step}
+                name = step.get('converter')
+                spec = CONVERTERS.get(name)
+                if not spec:
+                    raise PipelineError(f"Unknown converter in pipeline: {name}")
+                if name not in self.executors:
+                    raise PipelineError(f"Converter {name} is not available on this worker")
+                if spec.inputs and fmt not in spec.inputs:
+                    raise PipelineError(f"{name} does not accept {fmt or 'unknown'} input")
+                fmt = spec.output_format(fmt)
+                plan.append((name, dict(options, **(step.get('options') or {}))))
+            if target and normalize_format(target) != fmt:
+                raise PipelineError(f"Pipeline ends in {fmt}, not {normalize_format(target)}")
+            return plan
+
+        if not target:
+            raise PipelineError("Pipeline needs a list of steps or a target format")
+        chain = plan_chain(fmt, target, self.executors)
+        if not chain:
+            raise PipelineError(f"No conversion path from {fmt or 'unknown'} to {normalize_format(target)}")
+        return [(name, dict(options)) for name in chain]
+
+    def run_step(self, job_id: str, index: int, total: int, name: str, options: Dict[str, Any],
+                 input_path: str, output_path: str):
+        """Run one step on scratch files, reporting progress within its share of the job"""
+        worker = self.executors[name]
+        start_progress = 10 + 70 * index // total
+        end_progress = 10 + 70 * (index + 1) // total
+
+        self.host.redis_client.hset(f"job:{job_id}", mapping={
+            'currentStep': index + 1,
+            'totalSteps': total,
+            'stepConverter': name
+        })
+        self.host.update_job_status(job_id, 'processing', start_progress)
+
+        input_size = os.path.getsize(input_path)
+        units = worker.measure_input(name, input_path)
+        timeout = worker.durations.timeout_for(
+            name, input_size, units, worker.timeouts.get(name, worker.timeouts['default'])
+        )
+        expected = worker.durations.estimate(name, input_size, units)
+
+        def report_progress(progress: int, eta):
+            self.host.update_job_status(job_id, 'processing', progress, eta=eta)
+
+        step_start = time.time()
+        with span('pipeline.step', tool=name, index=index + 1, size=input_size, units=units, timeout=timeout), \
+                worker.durations.track(expected, timeout, report_progress, start_progress, end_progress):
+            success = dispatch(worker, name, input_path, output_path, options, timeout=timeout, job_id=job_id)
+
+        if not success or not os.path.exists(output_path):
+            raise Exception(f"Step {index + 1}/{total} ({name}) failed")
+        worker.durations.record(name, input_size, units, time.time() - step_start)
+
+    def process_job(self, job_data: Dict[str, Any]):
+        """Plan and run a pipeline job"""
+        job_id = job_data['id']
+        scratch = tempfile.mkdtemp(prefix=f"pipeline-{job_id}-")
+
+        try:
+            plan = self.plan(job_data)
+            logger.info(f"Pipeline job {job_id}: {' → '.join(name for name, _ in plan)}")
+
+            fmt = self.source_format(job_data)
+            current = os.path.join(scratch, f"input.{fmt or 'bin'}")
+            self.host.update_job_status(job_id, 'downloading', 5)
+            if not self.host.download_file(job_data['inputKey'], current):
+                raise Exception("Failed to download input file")
+
+            for index, (name, options) in enumerate(plan):
+                fmt = CONVERTERS[name].output_format(fmt)
+                # Tools such as heif-convert pick the output type from the extension
+                output = os.path.join(scratch, f"step{index + 1}.{fmt or 'bin'}")
+                self.run_step(job_id, index, len(plan), name, options, current, output)
+                # Drop intermediates as soon as the next step has its input
+                os.unlink(current)
+                current = output
+
+            self.host.update_job_status(job_id, 'uploading', 85)
+            if not self.host.upload_file(current, job_data['outputKey']):
+                raise Exception("Failed to upload output file")
+
+            self.host.update_job_status(job_id, 'completed', 100)
+            logger.info(f"Pipeline job {job_id} completed successfully")
+
+        except Exception as e:
+            logger.error(f"Pipeline job {job_id} failed: {e}")
+            self.host.update_job_status(job_id, 'failed', 0, str(e))
+
+        finally:
+            shutil.rmtree(scratch, ignore_errors=True)
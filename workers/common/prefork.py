@@ -0,0 +1,225 @@
+"""
+Pre-fork worker master
+Imports modules and builds the worker (boto3/redis clients, config) once,
+then forks children that share that memory copy-on-write. Children are
+recycled after a number of jobs or when their RSS grows past a limit, and
+SIGHUP rolls all children onto freshly loaded configuration. Peer workers
+for work-stealing are built alongside the main one. With autoscaling on
+(common.autoscale) the number of children follows the queue's depth.
+"""
+
+import gc
+import os
+import time
+import signal
+import logging
+from typing import Any, Callable, Dict
+
+from common.aio import AsyncWorkerCore
+from common.autoscale import Autoscaler, autoscale_enabled
+from common.registry import load_peers
+
+logger = logging.getLogger(__name__)
+
+
+def read_rss_mb(pid: int) -> float:
+    """Current resident set size of a process in MB, 0 if unknown"""
+    try:
+        with open(f'/proc/{pid}/statm') as f:
+            resident_pages = int(f.read().split()[1])
+        return resident_pages * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
+    except (OSError, ValueError, IndexError):
+        return 0.0
+
+
+def load_env_file(path: str):
+    """Load KEY=VALUE lines into the environment"""
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#') or '=' not in line:
+                continue
+            key, value = line.split('=', 1)
+            os.environ[key.strip()] = value.strip().strip('"').strip("'")
+
+
+class PreforkMaster:
+    def __init__(self, worker_factory: Callable[[], Any], queue_name: str, processes: int = None):
+        self.worker_factory = worker_factory
+        self.queue_name = queue_name
+        self.processes = processes or int(os.getenv('WORKER_PROCESSES') or 1)
+        self.max_jobs_per_child = int(os.getenv('WORKER_MAX_JOBS_PER_CHILD') or 500)
+        self.max_rss_mb = float(os.getenv('WORKER_MAX_RSS_MB') or 0)
+        self.graceful_timeout = int(os.getenv('WORKER_GRACEFUL_TIMEOUT') or 600)
+        self.env_file = os.getenv('WORKER_ENV_FILE')
+        self.autoscaler = Autoscaler(queue_name) if autoscale_enabled() else None
+        self.next_scale_at = 0.0
+        if self.autoscaler:
+            self.processes = min(max(self.processes, self.autoscaler.min_processes), self.autoscaler.max_processes)
+        
+        self.worker = None
+        self.peers = {}
+        self.generation = 0
+        self.children: Dict[int, int] = {}  # pid -> generation
+        self.retiring = set()
+        self.stopping = False
+        self.reload_requested = False
+    
+    def load(self):
+        """Build the shared worker instance in the master before forking"""
+        if self.env_file:
+            load_env_file(self.env_file)
+        self.worker = self.worker_factory()
+        self.peers = load_peers(self.queue_name)
+        self.generation += 1
+        # Move everything allocated so far out of the collector's reach so
+        # the children's GC passes don't dirty the shared pages
+        gc.collect()
+        gc.freeze()
+    
+    def spawn(self):
+        """Fork one child running the async core"""
+        pid = os.fork()
+        if pid == 0:
+            exit_code = 0
+            try:
+                # Reloads are the master's business; the core installs its own
+                # SIGINT/SIGTERM handlers for draining
+                signal.signal(signal.SIGHUP, signal.SIG_IGN)
+                signal.signal(signal.SIGINT, signal.SIG_DFL)
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                AsyncWorkerCore(self.worker, self.queue_name, job_limit=self.max_jobs_per_child,
+                                peers=self.peers).run()
+            except Exception as e:
+                logger.error(f"Worker child {os.getpid()} crashed: {e}")
+                exit_code = 1
+            finally:
+                os._exit(exit_code)
+        
+        self.children[pid] = self.generation
+        logger.info(f"Spawned worker child {pid} (generation {self.generation})")
+    
+    def retire(self, pid: int, reason: str):
+        """Ask a child to drain its in-flight jobs and exit"""
+        if pid in self.retiring:
+            return
+        logger.info(f"Retiring worker child {pid}: {reason}")
+        self.retiring.add(pid)
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+    
+    def reap(self):
+        """Collect exited children"""
+        while self.children:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if pid == 0:
+                break
+            self.children.pop(pid, None)
+            self.retiring.discard(pid)
+            code = os.waitstatus_to_exitcode(status)
+            level = logging.INFO if code == 0 else logging.WARNING
+            logger.log(level, f"Worker child {pid} exited with code {code}")
+    
+    def check_memory(self):
+        """Recycle children whose RSS has grown past the limit"""
+        if self.max_rss_mb <= 0:
+            return
+        for pid in list(self.children):
+            rss = read_rss_mb(pid)
+            if rss > self.max_rss_mb:
+                self.retire(pid, f"RSS {rss:.0f} MB over {self.max_rss_mb:.0f} MB limit")
+    
+    def autoscale(self):
+        """Resize the pool to the autoscaler's target, retiring the least busy children first"""
+        if not self.autoscaler or time.time() < self.next_scale_at:
+            return
+        self.next_scale_at = time.time() + self.autoscaler.interval
+        try:
+            decision = self.autoscaler.evaluate(self.processes)
+        except Exception as e:
+            logger.warning(f"Autoscaler could not read {self.queue_name}: {e}")
+            return
+        self.processes = decision.target
+        serving = [pid for pid in self.children if pid not in self.retiring]
+        for pid in self.autoscaler.least_busy(serving, len(serving) - self.processes):
+            self.retire(pid, f"autoscaler: {decision.reason}")
+    
+    def reload(self):
+        """Reload configuration and roll every child onto it"""
+        logger.info("Reloading worker configuration...")
+        self.reload_requested = False
+        gc.unfreeze()
+        try:
+            self.load()
+        except Exception as e:
+            logger.error(f"Reload failed, keeping current children: {e}")
+            return
+        for pid, generation in list(self.children.items()):
+            if generation < self.generation:
+                self.retire(pid, "configuration reloaded")
+    
+    def handle_signal(self, signum, frame):
+        if signum == signal.SIGHUP:
+            self.reload_requested = True
+        else:
+            self.stopping = True
+    
+    def shutdown(self):
+        """Drain all children, killing any that outlive the graceful timeout"""
+        logger.info(f"Stopping {len(self.children)} worker children...")
+        for pid in list(self.children):
+            self.retire(pid, "master shutting down")
+        
+        deadline = time.time() + self.graceful_timeout
+        while self.children and time.time() < deadline:
+            self.reap()
+            time.sleep(0.5)
+        
+        for pid in list(self.children):
+            logger.warning(f"Killing worker child {pid} after graceful timeout")
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+        while self.children:
+            self.reap()
+            time.sleep(0.1)
+    
+    def run(self):
+        """Supervise children until SIGINT/SIGTERM"""
+        for sig in (signal.SIGHUP, signal.SIGINT, signal.SIGTERM):
+            signal.signal(sig, self.handle_signal)
+        
+        self.load()
+        scaling = (f", autoscaling {self.autoscaler.min_processes}-{self.autoscaler.max_processes}"
+                   if self.autoscaler else "")
+        logger.info(f"Prefork master {os.getpid()} serving {self.queue_name} "
+                    f"with {self.processes} children{scaling}")
+        
+        while not self.stopping:
+            if self.reload_requested:
+                self.reload()
+            self.reap()
+            self.check_memory()
+            self.autoscale()
+            # Retiring children are draining and no longer pop jobs, so
+            # replace them right away to keep the slot count steady
+            while len(self.children) - len(self.retiring) < self.processes and not self.stopping:
+                self.spawn()
+            time.sleep(1)
+        
+        self.shutdown()
+
+
+def serve(worker_factory: Callable[[], Any], queue_name: str):
+    """Run a worker in-process, or under a pre-fork master when WORKER_PROCESSES > 1 or autoscaling"""
+    if int(os.getenv('WORKER_PROCESSES') or 1) > 1 or autoscale_enabled():
+        PreforkMaster(worker_factory, queue_name).run()
+    else:
+        worker = worker_factory()
+        AsyncWorkerCore(worker, queue_name, peers=load_peers(queue_name)).run()
@@ -0,0 +1,204 @@
+"""
+Job profiling
+Profiles a sample of the jobs a worker runs, for when a converter path
+gets slow in production and the time goes to Python rather than to the
+tool. That can be JSON handling, Pillow work, SRT parsing or retry loops.
+Off unless PROFILE_SAMPLE_RATE (or the Redis key 'profiling', which
+switches it on and off without a restart) picks a job. A picked job's
+thread is profiled in one of two modes:
+- cprofile: deterministic cProfile, written as a .pstats file;
+- sample: a timer thread walks the job thread's stack, written as
+  collapsed stacks (.collapsed) for flame graph tools.
+Files land in PROFILE_DIR/{converter}/ named after the time and job ID.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import cProfile
+import logging
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from typing import Any, Dict, FrozenSet, Iterator, NamedTuple, Optional
+
+logger = logging.getLogger(__name__)
+
+# Redis key read every few seconds; its JSON overrides the environment while it exists
+FLAG_KEY = 'profiling'
+FLAG_REFRESH_SECONDS = 5
+MODES = ('cprofile', 'sample')
+
+
+class ProfileSettings(NamedTuple):
+    rate: float = 0.0
+    mode: str = 'cprofile'
+    # Only these converters are sampled; None means all
+    converters: Optional[FrozenSet[str]] = None
+
+
+def env_settings() -> ProfileSettings:
+    """Settings from PROFILE_SAMPLE_RATE, PROFILE_MODE and PROFILE_CONVERTERS"""
+    names = [name.strip() for name in (os.getenv('PROFILE_CONVERTERS') or '').split(',') if name.strip()]
+    mode = os.getenv('PROFILE_MODE') or 'cprofile'
+    return ProfileSettings(
+        rate=float(os.getenv('PROFILE_SAMPLE_RATE') or 0),
+        mode=mode if mode in MODES else 'cprofile',
+        converters=frozenset(names) or None
+    )
+
+
+def parse_flag(raw: Any, defaults: ProfileSettings) -> ProfileSettings:
+    """
+    Settings from the Redis flag: a bare rate ("0.1") or JSON such as
+    {"rate": 0.1, "mode": "sample", "converters": ["pdf-to-docx"]}.
+    Missing fields keep their defaults.
+    """
+    if isinstance(raw, bytes):
+        raw = raw.decode('utf-8', errors='replace')
+    value = json.loads(raw)
+    if not isinstance(value, dict):
+        value = {'rate': value}
+    mode = value.get('mode', defaults.mode)
+    converters = defaults.converters
+    if 'converters' in value:
+        converters = frozenset(value['converters']) if value['converters'] else None
+    return ProfileSettings(
+        rate=min(max(float(value.get('rate', defaults.rate)), 0.0), 1.0),
+        mode=mode if mode in MODES else defaults.mode,
+        converters=converters
+    )
+
+
+class ProfileRun:
+    """One profiled job; path is set once its profile is written"""
+
+    def __init__(self, converter: str, job_id: str, mode: str):
+        self.converter = converter
+        self.job_id = job_id
+        self.mode = mode
+        self.path: Optional[str] = None
+
+
+class StackSampler(threading.Thread):
+    """Counts the stacks of one thread every interval, root frame first"""
+
+    def __init__(self, thread_id: int, interval: float, root: str):
+        super().__init__(daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.root = root
+        self.stacks: Counter = Counter()
+        self.finished = threading.Event()
+
+    def run(self):
+        while not self.finished.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            names = []
+            while frame is not None:
+                code = frame.f_code
+                names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if names:
+                names.append(self.root)
+                self.stacks[';'.join(reversed(names))] += 1
+
+    def stop(self):
+        self.finished.set()
+        self.join()
+
+
+class JobProfiler:
+    def __init__(self, directory: str = None):
+        self.directory = directory or os.getenv('PROFILE_DIR') or '/tmp/worker-profiles'
+        self.interval = float(os.getenv('PROFILE_SAMPLE_INTERVAL_MS') or 10) / 1000
+        # Profiles kept per converter; older ones are deleted as new ones arrive
+        self.keep = int(os.getenv('PROFILE_KEEP') or 200)
+        self.defaults = env_settings()
+        self.settings = self.defaults
+
+    def configure(self, raw: Any):
+        """Apply the Redis flag's value, or fall back to the environment when it is gone"""
+        try:
+            settings = parse_flag(raw, self.defaults) if raw is not None else self.defaults
+        except (ValueError, TypeError) as e:
+            logger.warning(f"Ignoring malformed {FLAG_KEY} flag: {e}")
+            return
+        if settings != self.settings:
+            logger.info(f"Job profiling: {settings.rate:.0%} of "
+                        f"{', '.join(sorted(settings.converters)) if settings.converters else 'all'} jobs "
+                        f"({settings.mode})")
+        self.settings = settings
+
+    def picks(self, converter: str) -> bool:
+        settings = self.settings
+        if settings.rate <= 0 or (settings.converters and converter not in settings.converters):
+            return False
+        return random.random() < settings.rate
+
+    def _output_path(self, run: ProfileRun, extension: str) -> str:
+        directory = os.path.join(self.directory, run.converter)
+        os.makedirs(directory, exist_ok=True)
+        stamp = time.strftime('%Y%m%dT%H%M%S', time.gmtime())
+        return os.path.join(directory, f"{stamp}-{run.job_id}.{extension}")
+
+    def _prune(self, directory: str):
+        """Delete the oldest profiles of a converter beyond the ones kept"""
+        try:
+            names = sorted(os.listdir(directory))
+        except OSError:
+            return
+        for name in names[:max(len(names) - self.keep, 0)]:
+            try:
+                os.unlink(os.path.join(directory, name))
+            except OSError:
+                pass
+
+    def _write(self, run: ProfileRun, profile: Optional[cProfile.Profile], sampler: Optional[StackSampler]):
+        if profile:
+            path = self._output_path(run, 'pstats')
+            profile.dump_stats(path)
+        else:
+            path = self._output_path(run, 'collapsed')
+            with open(path, 'w') as f:
+                for stack, count in sampler.stacks.most_common():
+                    f.write(f"{stack} {count}\n")
+        run.path = path
+        self._prune(os.path.dirname(path))
+        logger.info(f"Wrote {run.mode} profile of job {run.job_id} ({run.converter}) to {path}")
+
+    @contextmanager
+    def profile(self, job_data: Dict[str, Any]) -> Iterator[Optional[ProfileRun]]:
+        """Profile the calling thread while a job runs if the sample picks it; yields None otherwise"""
+        converter = job_data.get('converter') or 'unknown'
+        if not self.picks(converter):
+            yield None
+            return
+
+        run = ProfileRun(converter, str(job_data.get('id')), self.settings.mode)
+        profile, sampler = None, None
+        if run.mode == 'cprofile':
+            profile = cProfile.Profile()
+            try:
+                profile.enable()
+            except ValueError as e:
+                # Another profiler holds the interpreter (Python 3.12+ allows only one)
+                logger.info(f"Not profiling job {run.job_id}: {e}")
+                yield None
+                return
+        else:
+            sampler = StackSampler(threading.get_ident(), self.interval, converter)
+            sampler.start()
+        try:
+            yield run
+        finally:
+            if profile:
+                profile.disable()
+            else:
+                sampler.stop()
+            try:
+                self._write(run, profile, sampler)
+            except OSError as e:
+                logger.warning(f"Could not write profile of job {run.job_id}: {e}")
@@ -0,0 +1,41 @@
+"""
+Job progress events
+Every status update goes to the job hash and, in the same transaction, to
+a per-job Redis Stream (job-events:{id}) as a compact event. Stream IDs
+keep events in order, MAXLEN bounds the stream and a TTL lets it expire on
+its own. The web tier relays these events to browsers over SSE, so open
+tabs no longer poll /api/status; a reconnecting client resumes after the
+last event ID it saw.
+"""
+
+import os
+from typing import Any, Dict
+
+# Events kept per job (approximate trimming), and seconds a quiet stream lives on
+EVENTS_MAXLEN = int(os.getenv('JOB_EVENTS_MAXLEN') or 100)
+EVENTS_TTL = int(os.getenv('JOB_EVENTS_TTL_SECONDS') or 3600)
+
+
+def events_key(job_id: str) -> str:
+    """Stream of a job's progress events; kept outside job:* so hash scans skip it"""
+    return f"job-events:{job_id}"
+
+
+def progress_event(fields: Dict[str, Any]) -> Dict[str, Any]:
+    """The fields of a status update clients need, without empty ones"""
+    event = {'status': fields['status'], 'progress': fields.get('progress', 0)}
+    if fields.get('estimatedTimeRemaining') is not None:
+        event['eta'] = fields['estimatedTimeRemaining']
+    if fields.get('error'):
+        event['error'] = fields['error']
+    return event
+
+
+def write_job_status(client: Any, job_id: str, fields: Dict[str, Any]):
+    """Update the job hash and append the matching progress event atomically"""
+    key = events_key(job_id)
+    pipe = client.pipeline()
+    pipe.hset(f"job:{job_id}", mapping=fields)
+    pipe.xadd(key, progress_event(fields), maxlen=EVENTS_MAXLEN, approximate=True)
+    pipe.expire(key, EVENTS_TTL)
+    pipe.execute()
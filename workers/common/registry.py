@@ -0,0 +1,242 @@
+"""
+Converter registry
+Every converter is declared once in converters.json with its input and
+output formats, its queue, the external tools it needs, a cost class and a
+memory estimate (a baseline plus optional terms per MB of input or per
+megapixel). The web tier routes jobs from the same file. Workers mark
+their handler methods with @converter and dispatch through the registry,
+and a process can host the workers of other queues when the tools for
+some of their converters are installed.
+"""
+
+import os
+import json
+import shutil
+import inspect
+import logging
+import heapq
+import importlib
+from functools import lru_cache
+from typing import Any, Callable, Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+REGISTRY_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'converters.json')
+
+# Cost classes in increasing order; WORKER_STEAL_MAX_COST caps what a worker takes from other queues
+COST_CLASSES = ('light', 'medium', 'heavy')
+# Relative weight of each cost class when planning a chain of steps
+COST_WEIGHTS = {'light': 1, 'medium': 2, 'heavy': 4}
+
+# Job converter name for multi-step conversions
+PIPELINE = 'pipeline'
+
+
+class UnknownConverterError(Exception):
+    """No handler is registered for a converter"""
+
+
+class ConverterSpec(NamedTuple):
+    name: str
+    queue: str
+    tools: Tuple[str, ...]
+    cost: str
+    memory_mb: int
+    inputs: Tuple[str, ...] = ()
+    # None keeps the input format (e.g. upscaling)
+    output: Optional[str] = None
+    # Changes content rather than format, so never picked by the planner
+    transform: bool = False
+    # Extra peak memory per MB of input and per megapixel of a raster input
+    memory_per_mb: float = 0.0
+    memory_per_megapixel: float = 0.0
+
+    def output_format(self, input_format: str) -> str:
+        """Format produced from an input of the given format"""
+        return self.output or input_format
+
+
+class Peer(NamedTuple):
+    worker: Any
+    converters: frozenset
+
+
+def load_registry(path: str = REGISTRY_PATH) -> Tuple[Dict[str, Dict[str, str]], Dict[str, ConverterSpec],
+                                                      Dict[str, str]]:
+    """Read queue, converter and format alias declarations"""
+    with open(path) as f:
+        raw = json.load(f)
+
+    converters = {}
+    for name, entry in raw['converters'].items():
+        cost = entry.get('cost', 'medium')
+        if cost not in COST_CLASSES:
+            raise ValueError(f"Converter {name} has unknown cost class {cost}")
+        converters[name] = ConverterSpec(
+            name=name,
+            queue=entry['queue'],
+            tools=tuple(entry.get('tools', [])),
+            cost=cost,
+            memory_mb=int(entry.get('memoryMb', 0)),
+            inputs=tuple(entry.get('from', [])),
+            output=entry.get('to'),
+            transform=bool(entry.get('transform', False)),
+            memory_per_mb=float(entry.get('memoryPerMb', 0)),
+            memory_per_megapixel=float(entry.get('memoryPerMegapixel', 0))
+        )
+    return raw['queues'], converters, raw.get('formatAliases', {})
+
+
+QUEUES, CONVERTERS, FORMAT_ALIASES = load_registry()
+
+
+def converter(name: str, **options: Any) -> Callable:
+    """
+    Mark a worker method as the handler of a registered converter.
+    Keyword arguments name job options passed to the handler, with their
+    defaults. The handler also receives timeout and job_id when its
+    signature accepts them.
+    """
+    if name not in CONVERTERS:
+        raise ValueError(f"Converter {name} is not declared in {REGISTRY_PATH}")
+
+    def decorate(method: Callable) -> Callable:
+        method.converter_name = name
+        method.converter_options = options
+        method.converter_params = set(inspect.signature(method).parameters)
+        return method
+    return decorate
+
+
+@lru_cache(maxsize=None)
+def handlers(worker_class: type) -> Dict[str, str]:
+    """Converter name -> handler method name for a worker class"""
+    found = {}
+    for attr in dir(worker_class):
+        name = getattr(getattr(worker_class, attr, None), 'converter_name', None)
+        if name:
+            found[name] = attr
+    return found
+
+
+def handler_options(worker: Any, converter_type: str) -> Dict[str, Any]:
+    """Job options a worker's handler for a converter accepts, with their defaults"""
+    method_name = handlers(type(worker)).get(converter_type)
+    if not method_name:
+        return {}
+    return dict(getattr(worker, method_name).converter_options)
+
+
+def tools_available(spec: ConverterSpec) -> bool:
+    """Whether every external tool of a converter is on PATH"""
+    return all(shutil.which(tool) for tool in spec.tools)
+
+
+def capabilities(worker_class: type, max_cost: str = 'heavy') -> List[str]:
+    """Converters a worker class can run on this machine, up to a cost class"""
+    limit = COST_CLASSES.index(max_cost)
+    return sorted(
+        name for name in handlers(worker_class)
+        if tools_available(CONVERTERS[name]) and COST_CLASSES.index(CONVERTERS[name].cost) <= limit
+    )
+
+
+def dispatch(worker: Any, converter_type: str, input_path: str, output_path: str,
+             options: Dict[str, Any], timeout: int = None, job_id: str = None, output_key: str = None) -> bool:
+    """
+    Run the handler registered for a converter. Handlers that take an
+    output_key and get one upload their output themselves.
+    """
+    method_name = handlers(type(worker)).get(converter_type)
+    if not method_name:
+        raise UnknownConverterError(f"Unknown converter type: {converter_type}")
+    method = getattr(worker, method_name)
+
+    options = options or {}
+    kwargs = {key: options.get(key, default) for key, default in method.converter_options.items()}
+    if timeout is not None and 'timeout' in method.converter_params:
+        kwargs['timeout'] = timeout
+    if 'job_id' in method.converter_params:
+        kwargs['job_id'] = job_id
+    if 'output_key' in method.converter_params:
+        kwargs['output_key'] = output_key
+    return method(input_path, output_path, **kwargs)
+
+
+def load_peers(home_queue: str, max_cost: str = None) -> Dict[str, Peer]:
+    """
+    Build the workers of other queues that have at least one converter this
+    machine can run, keyed by queue. Modules that fail to import (missing
+    Python dependencies in this image) are skipped. WORKER_STEAL=0 turns
+    work-stealing off.
+    """
+    if (os.getenv('WORKER_STEAL') or '1') == '0':
+        return {}
+    max_cost = max_cost or os.getenv('WORKER_STEAL_MAX_COST') or 'heavy'
+    peers = {}
+    for queue, entry in QUEUES.items():
+        if queue == home_queue:
+            continue
+        try:
+            worker_class = getattr(importlib.import_module(entry['module']), entry['worker'])
+        except Exception as e:
+            logger.debug(f"Worker for {queue} not available here: {e}")
+            continue
+
+        runnable = capabilities(worker_class, max_cost)
+        if not runnable:
+            continue
+        try:
+            peers[queue] = Peer(worker_class(), frozenset(runnable))
+        except Exception as e:
+            logger.warning(f"Could not start worker for {queue}: {e}")
+            continue
+        logger.info(f"Can also serve {queue}: {', '.join(runnable)}")
+    return peers
+
+
+def normalize_format(name: str) -> str:
+    """Canonical lower-case format name for a file extension"""
+    name = name.lower().lstrip('.')
+    return FORMAT_ALIASES.get(name, name)
+
+
+def plan_chain(source: str, target: str, available: Iterable[str]) -> Optional[List[str]]:
+    """
+    Cheapest chain of available converters turning one format into another,
+    weighting each step by its cost class. None if there is no path.
+    """
+    source, target = normalize_format(source), normalize_format(target)
+    if source == target:
+        return []
+
+    edges: Dict[str, List[ConverterSpec]] = {}
+    for name in available:
+        spec = CONVERTERS[name]
+        if spec.transform or not spec.output:
+            continue
+        for fmt in spec.inputs:
+            edges.setdefault(fmt, []).append(spec)
+
+    # Dijkstra over formats; the counter keeps heap entries comparable
+    queue = [(0, 0, source, [])]
+    settled = set()
+    counter = 0
+    while queue:
+        cost, _, fmt, path = heapq.heappop(queue)
+        if fmt == target:
+            return path
+        if fmt in settled:
+            continue
+        settled.add(fmt)
+        for spec in edges.get(fmt, []):
+            if spec.output not in settled:
+                counter += 1
+                heapq.heappush(queue, (cost + COST_WEIGHTS[spec.cost], counter, spec.output, path + [spec.name]))
+    return None
+
+
+def queue_for(converter_type: str) -> Optional[str]:
+    """Queue a converter is routed to"""
+    spec = CONVERTERS.get(converter_type)
+    return spec.queue if spec else None
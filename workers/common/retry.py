@@ -0,0 +1,83 @@
+"""
+Delayed retry queue
+Failed jobs wait in a Redis sorted set scored by their next attempt time
+instead of sleeping in the worker or jumping back to the head of the queue.
+A mover promotes due jobs to the tail of the work queue; jobs that run out
+of attempts go to a dead-letter list.
+"""
+
+import os
+import json
+import time
+import random
+import logging
+from datetime import datetime, timezone
+from typing import Any, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+# Atomically move up to ARGV[2] jobs due by ARGV[1] from the delayed set to the queue tail
+PROMOTE_SCRIPT = """
+local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, tonumber(ARGV[2]))
+for _, job in ipairs(due) do
+    redis.call('ZREM', KEYS[1], job)
+    redis.call('RPUSH', KEYS[2], job)
+end
+return #due
+"""
+
+
+class PermanentJobError(Exception):
+    """A failure that retrying cannot fix, such as an unknown converter"""
+
+
+class RetryQueue:
+    def __init__(self, redis_client: Any, queue_name: str, max_retries: int = 2):
+        self.redis_client = redis_client
+        self.queue_name = queue_name
+        self.delayed_key = f"{queue_name}:delayed"
+        self.dead_letter_key = f"{queue_name}:failed"
+        self.max_retries = max_retries
+        self.base_delay = float(os.getenv('RETRY_BASE_DELAY_SECONDS') or 5)
+        self.max_delay = float(os.getenv('RETRY_MAX_DELAY_SECONDS') or 300)
+        self._promote = self.redis_client.register_script(PROMOTE_SCRIPT)
+    
+    def backoff(self, attempt: int) -> float:
+        """Exponential backoff with equal jitter so retries of a burst spread out"""
+        delay = min(self.max_delay, self.base_delay * (2 ** (attempt - 1)))
+        return delay / 2 + random.uniform(0, delay / 2)
+    
+    def schedule(self, job_data: Dict[str, Any], error: str) -> Optional[float]:
+        """
+        Schedule the next attempt of a failed job.
+        Returns the delay in seconds, or None if the job was dead-lettered.
+        """
+        attempt = job_data.get('retryCount', 0) + 1
+        job_id = job_data['id']
+        
+        if attempt > self.max_retries:
+            entry = dict(job_data, error=error, failedAt=datetime.now(timezone.utc).isoformat())
+            self.redis_client.lpush(self.dead_letter_key, json.dumps(entry))
+            logger.warning(f"Job {job_id} dead-lettered after {attempt - 1} retries")
+            return None
+        
+        delay = self.backoff(attempt)
+        due_at = time.time() + delay
+        retry_job = dict(job_data, retryCount=attempt)
+        
+        pipe = self.redis_client.pipeline()
+        pipe.zadd(self.delayed_key, {json.dumps(retry_job): due_at})
+        pipe.hset(f"job:{job_id}", mapping={
+            'retryAttempt': attempt,
+            'maxRetries': self.max_retries,
+            'nextRetryAt': datetime.fromtimestamp(due_at, timezone.utc).isoformat()
+        })
+        pipe.execute()
+        return delay
+    
+    def promote_due(self, limit: int = 100) -> int:
+        """Move jobs whose retry time has come back onto the work queue"""
+        moved = self._promote(keys=[self.delayed_key, self.queue_name], args=[time.time(), limit])
+        if moved:
+            logger.info(f"Promoted {moved} delayed jobs to {self.queue_name}")
+        return moved
@@ -0,0 +1,547 @@
+"""
+Input sniffing
+Before a job is admitted the async core reads the first (and for some
+containers the last) bytes of its input with ranged GETs, identifies the
+container from its magic bytes and pulls header metadata without decoding
+anything: image dimensions, PDF page counts, media durations. Inputs that
+are empty, truncated, of another format than the converter takes or past
+the size limits fail in milliseconds instead of after a converter
+timeout. The probe travels with the job, where it stands in for the
+memory estimate's header read and for the workers' own measure_input.
+"""
+
+import os
+import re
+import struct
+import logging
+from typing import Any, Callable, Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# enforce fails bad inputs, observe only records and logs them, off skips sniffing
+SNIFF_MODE = (os.getenv('INPUT_SNIFF') or 'enforce').lower()
+# Bytes fetched from the start and end of an input, and per extra ranged read
+HEAD_BYTES = 64 * 1024
+TAIL_BYTES = 64 * 1024
+WINDOW_BYTES = 64 * 1024
+# Ranged reads one probe may make after the first, e.g. to find an MP4's moov box
+MAX_READS = 6
+# Largest inputs accepted (0 = no limit)
+MAX_MEGAPIXELS = float(os.getenv('INPUT_MAX_MEGAPIXELS') or 150)
+MAX_PAGES = int(os.getenv('INPUT_MAX_PAGES') or 2000)
+MAX_DURATION = float(os.getenv('INPUT_MAX_DURATION_SECONDS') or 4 * 3600)
+
+# Formats a converter input also takes: ffmpeg opens any ISO-BMFF file, text converters any text
+ACCEPTS = {
+    'mp4': {'mp4', 'mov', 'm4a'},
+    'mov': {'mov', 'mp4', 'm4a'},
+    'txt': {'txt', 'srt', 'vtt', 'svg', 'html', 'rtf'},
+}
+
+# ftyp brands of HEIF/AVIF still images and QuickTime movies
+HEIF_BRANDS = {b'heic', b'heix', b'heim', b'heis', b'hevc', b'hevx', b'mif1', b'msf1'}
+AVIF_BRANDS = {b'avif', b'avis'}
+QUICKTIME_BRANDS = {b'qt  '}
+AUDIO_BRANDS = {b'M4A ', b'M4B '}
+# Top-level boxes a QuickTime file without ftyp may start with
+QUICKTIME_BOXES = {b'moov', b'mdat', b'wide', b'free', b'skip', b'pnot'}
+
+SRT_CUE = re.compile(r'^\s*\d+\s*\r?\n\d{1,2}:\d{2}:\d{2}[,.]\d{1,3}\s*-->', re.MULTILINE)
+PDF_PAGES = re.compile(rb'/Type\s*/Pages(?![a-zA-Z])')
+PDF_COUNT = re.compile(rb'/Count\s+(\d+)')
+PDF_LINEARIZED = re.compile(rb'/Linearized[^>]*?/N\s+(\d+)', re.DOTALL)
+
+
+class InputRejected(Exception):
+    """An input that no converter run can succeed on; the job fails without retries"""
+
+
+class Probe(NamedTuple):
+    format: Optional[str]
+    size: int
+    width: Optional[int] = None
+    height: Optional[int] = None
+    pages: Optional[int] = None
+    duration: Optional[float] = None
+    # Why the input is unusable even though its format was recognized (e.g. truncated)
+    problem: Optional[str] = None
+    
+    @property
+    def megapixels(self) -> Optional[float]:
+        if self.width and self.height:
+            return self.width * self.height / 1e6
+        return None
+    
+    @property
+    def units(self) -> Optional[float]:
+        """Work units for the duration model: pages, media seconds or megapixels"""
+        if self.pages is not None:
+            return float(self.pages)
+        if self.duration is not None:
+            return self.duration
+        return self.megapixels
+    
+    def fields(self) -> Dict[str, Any]:
+        """Job hash fields describing the input"""
+        fields = {'inputFormat': self.format or 'unknown', 'inputWidth': self.width, 'inputHeight': self.height,
+                  'inputPages': self.pages,
+                  'inputDuration': round(self.duration, 3) if self.duration is not None else None}
+        return {key: value for key, value in fields.items() if value is not None}
+    
+    @classmethod
+    def from_job(cls, job_data: Dict[str, Any]) -> Optional['Probe']:
+        """The probe the core attached to a job, if any"""
+        raw = job_data.get('probe')
+        if not isinstance(raw, dict):
+            return None
+        try:
+            return cls(**raw)
+        except TypeError:
+            return None
+
+
+def probed_units(job_data: Dict[str, Any]) -> Optional[float]:
+    """Duration model units of a job's input from its probe, None when not probed"""
+    probe = Probe.from_job(job_data)
+    return probe.units if probe else None
+
+
+class RangeReader:
+    """
+    Byte ranges of an object of known size, served from the chunks fetched
+    so far. Each miss costs one ranged read of at least WINDOW_BYTES, and
+    once MAX_READS are spent further misses come back empty.
+    """
+    
+    def __init__(self, read: Callable[[int, int], bytes], size: int, max_reads: int = MAX_READS):
+        self.read = read
+        self.size = size
+        self.reads_left = max_reads
+        self.chunks: List[Tuple[int, bytes]] = []
+        self.head = self._fetch(0, HEAD_BYTES)
+    
+    def _fetch(self, offset: int, length: int) -> bytes:
+        length = min(length, self.size - offset)
+        if length <= 0:
+            return b''
+        data = self.read(offset, length)
+        self.chunks.append((offset, data))
+        return data
+    
+    def at(self, offset: int, length: int) -> bytes:
+        """Up to length bytes from an offset (fewer at the end of the object or when out of reads)"""
+        if offset < 0 or offset >= self.size:
+            return b''
+        for start, data in self.chunks:
+            if start <= offset and offset + length <= start + len(data):
+                return data[offset - start:offset - start + length]
+        if self.reads_left <= 0:
+            return b''
+        self.reads_left -= 1
+        return self._fetch(offset, max(length, WINDOW_BYTES))[:length]
+    
+    def tail(self, length: int = TAIL_BYTES) -> bytes:
+        """The last length bytes of the object"""
+        return self.at(max(self.size - length, 0), min(length, self.size))
+
+
+def _u16be(data: bytes, offset: int) -> int:
+    return struct.unpack_from('>H', data, offset)[0]
+
+
+def _u32be(data: bytes, offset: int) -> int:
+    return struct.unpack_from('>I', data, offset)[0]
+
+
+def _png(reader: RangeReader) -> Dict[str, Any]:
+    head = reader.head
+    meta = {}
+    if head[12:16] == b'IHDR':
+        meta['width'], meta['height'] = _u32be(head, 16), _u32be(head, 20)
+    if b'IEND' not in reader.tail(64):
+        meta['problem'] = "PNG is truncated (no IEND chunk)"
+    return meta
+
+
+def _jpeg(reader: RangeReader) -> Dict[str, Any]:
+    """Dimensions from the first SOF segment, walking segment headers (EXIF may push it past the head)"""
+    offset = 2
+    for _ in range(64):
+        marker = reader.at(offset, 4)
+        if len(marker) < 4 or marker[0] != 0xFF:
+            break
+        kind = marker[1]
+        if kind == 0xFF:
+            # Fill byte before the marker
+            offset += 1
+            continue
+        if kind == 0x01 or 0xD0 <= kind <= 0xD8:
+            offset += 2
+            continue
+        if 0xC0 <= kind <= 0xCF and kind not in (0xC4, 0xC8, 0xCC):
+            frame = reader.at(offset + 5, 4)
+            if len(frame) == 4:
+                return {'height': _u16be(frame, 0), 'width': _u16be(frame, 2)}
+            break
+        if kind in (0xD9, 0xDA):
+            break
+        offset += 2 + _u16be(marker, 2)
+    return {}
+
+
+def _gif(reader: RangeReader) -> Dict[str, Any]:
+    width, height = struct.unpack_from('<HH', reader.head, 6)
+    return {'width': width, 'height': height}
+
+
+def _bmp(reader: RangeReader) -> Dict[str, Any]:
+    width, height = struct.unpack_from('<ii', reader.head, 18)
+    return {'width': abs(width), 'height': abs(height)}
+
+
+def _webp(reader: RangeReader) -> Dict[str, Any]:
+    head = reader.head
+    chunk = head[12:16]
+    if chunk == b'VP8 ' and len(head) >= 30:
+        width, height = struct.unpack_from('<HH', head, 26)
+        return {'width': width & 0x3FFF, 'height': height & 0x3FFF}
+    if chunk == b'VP8L' and len(head) >= 25:
+        bits = struct.unpack_from('<I', head, 21)[0]
+        return {'width': (bits & 0x3FFF) + 1, 'height': ((bits >> 14) & 0x3FFF) + 1}
+    if chunk == b'VP8X' and len(head) >= 30:
+        return {'width': int.from_bytes(head[24:27], 'little') + 1,
+                'height': int.from_bytes(head[27:30], 'little') + 1}
+    return {}
+
+
+def _wav(reader: RangeReader) -> Dict[str, Any]:
+    """Duration from the fmt chunk's byte rate and the data chunk's length"""
+    offset, byte_rate = 12, None
+    for _ in range(32):
+        header = reader.at(offset, 8)
+        if len(header) < 8:
+            break
+        chunk, length = header[:4], struct.unpack_from('<I', header, 4)[0]
+        if chunk == b'fmt ':
+            fmt = reader.at(offset + 8, 16)
+            if len(fmt) >= 12:
+                byte_rate = struct.unpack_from('<I', fmt, 8)[0]
+        elif chunk == b'data':
+            # Streamed WAVs leave the length at 0 or 0xFFFFFFFF
+            available = reader.size - offset - 8
+            if length == 0 or length > available:
+                length = available
+            return {'duration': length / byte_rate} if byte_rate else {}
+        offset += 8 + length + (length & 1)
+    return {}
+
+
+def _boxes(reader: RangeReader, start: int, end: int) -> Iterator[Tuple[bytes, int, int, int]]:
+    """(type, offset, header length, size) of the ISO-BMFF boxes between two offsets"""
+    offset = start
+    for _ in range(256):
+        if offset + 8 > end:
+            return
+        header = reader.at(offset, 16)
+        if len(header) < 8:
+            return
+        size, kind = _u32be(header, 0), header[4:8]
+        header_length = 8
+        if size == 1 and len(header) >= 16:
+            size, header_length = struct.unpack_from('>Q', header, 8)[0], 16
+        elif size == 0:
+            size = end - offset
+        if size < header_length:
+            return
+        yield kind, offset, header_length, size
+        offset += size
+
+
+def _child(reader: RangeReader, parent: Tuple[bytes, int, int, int], kind: bytes,
+           skip: int = 0) -> Optional[Tuple[bytes, int, int, int]]:
+    """First box of a type inside another (skip jumps over full-box fields before the children)"""
+    _, offset, header_length, size = parent
+    for box in _boxes(reader, offset + header_length + skip, offset + size):
+        if box[0] == kind:
+            return box
+    return None
+
+
+def _movie(reader: RangeReader, moov: Tuple[bytes, int, int, int]) -> Dict[str, Any]:
+    """Duration from mvhd (or mehd for fragmented files) and the frame size of the first visual track"""
+    meta = {}
+    mvhd = _child(reader, moov, b'mvhd')
+    if mvhd:
+        body = reader.at(mvhd[1] + mvhd[2], 32)
+        if body[:1] == b'\x01' and len(body) >= 32:
+            timescale, duration = _u32be(body, 20), struct.unpack_from('>Q', body, 24)[0]
+        elif len(body) >= 20:
+            timescale, duration = _u32be(body, 12), _u32be(body, 16)
+        else:
+            timescale, duration = 0, 0
+        if timescale and duration and duration != 0xFFFFFFFF:
+            meta['duration'] = duration / timescale
+        if timescale and 'duration' not in meta:
+            mvex = _child(reader, moov, b'mvex')
+            mehd = _child(reader, mvex, b'mehd') if mvex else None
+            if mehd:
+                body = reader.at(mehd[1] + mehd[2], 12)
+                fragments = struct.unpack_from('>Q', body, 4)[0] if body[:1] == b'\x01' and len(body) >= 12 \
+                    else _u32be(body, 4) if len(body) >= 8 else 0
+                if fragments:
+                    meta['duration'] = fragments / timescale
+    for trak in _boxes(reader, moov[1] + moov[2], moov[1] + moov[3]):
+        if trak[0] != b'trak':
+            continue
+        tkhd = _child(reader, trak, b'tkhd')
+        if not tkhd:
+            continue
+        body = reader.at(tkhd[1] + tkhd[2], 92)
+        # 16.16 fixed-point size at the end of the box; audio tracks leave it at zero
+        size_at = 84 if body[:1] == b'\x01' else 76
+        if len(body) >= size_at + 8:
+            width, height = _u32be(body, size_at) >> 16, _u32be(body, size_at + 4) >> 16
+            if width and height:
+                meta['width'], meta['height'] = width, height
+                break
+    return meta
+
+
+def _heif_size(data: bytes) -> Dict[str, Any]:
+    """Largest image spatial extent (ispe) in a HEIF meta box; thumbnails have their own smaller ones"""
+    best = (0, 0)
+    for match in re.finditer(rb'ispe', data):
+        at = match.end() + 4
+        if at + 8 <= len(data):
+            width, height = _u32be(data, at), _u32be(data, at + 4)
+            if width * height > best[0] * best[1]:
+                best = (width, height)
+    return {'width': best[0], 'height': best[1]} if best[0] else {}
+
+
+def _isobmff(reader: RangeReader) -> Tuple[Optional[str], Dict[str, Any]]:
+    """Classify an ISO-BMFF file by its ftyp brands and walk its top-level boxes"""
+    head = reader.head
+    fmt = None
+    if head[4:8] == b'ftyp':
+        length = min(_u32be(head, 0), len(head))
+        brands = {head[8:12]} | {head[i:i + 4] for i in range(16, length - 3, 4)}
+        if head[8:12] in HEIF_BRANDS or (brands & HEIF_BRANDS and not brands & AVIF_BRANDS and
+                                        head[8:12] not in (b'isom', b'mp41', b'mp42')):
+            return 'heic', _heif_size(head)
+        if brands & AVIF_BRANDS:
+            return 'avif', _heif_size(head)
+        if head[8:12] in QUICKTIME_BRANDS:
+            fmt = 'mov'
+        elif head[8:12] in AUDIO_BRANDS:
+            fmt = 'm4a'
+        else:
+            fmt = 'mp4'
+    elif head[4:8] in QUICKTIME_BOXES:
+        fmt = 'mov'
+    else:
+        return None, {}
+
+    moov, fragmented = None, False
+    for box in _boxes(reader, 0, reader.size):
+        if box[0] == b'moov':
+            moov = box
+        elif box[0] == b'moof':
+            fragmented = True
+        if moov and (fragmented or box[0] == b'mdat'):
+            break
+    if not moov:
+        # Out of reads rather than missing: leave the verdict to ffmpeg
+        if reader.reads_left <= 0:
+            return fmt, {}
+        return fmt, {'problem': f"{fmt.upper()} has no moov box (truncated upload?)"}
+    return fmt, _movie(reader, moov)
+
+
+def _pdf(reader: RangeReader) -> Dict[str, Any]:
+    """Page count from the linearization dictionary, or the page tree roots found near either end"""
+    meta = {}
+    head, tail = reader.head, reader.tail()
+    linearized = PDF_LINEARIZED.search(head[:2048])
+    if linearized:
+        meta['pages'] = int(linearized.group(1))
+    else:
+        counts = []
+        for data in (head, tail):
+            for match in PDF_PAGES.finditer(data):
+                # The /Count of a page tree node sits in the same dictionary, before or after /Type
+                window = data[max(match.start() - 512, 0):match.end() + 512]
+                counts.extend(int(count) for count in PDF_COUNT.findall(window))
+        if counts:
+            meta['pages'] = max(counts)
+    if b'%%EOF' not in tail:
+        meta['problem'] = "PDF is truncated (no %%EOF marker)"
+    return meta
+
+
+def _zip_names(reader: RangeReader) -> Optional[List[str]]:
+    """Member names from the central directory at the end of a zip, None if it can't be found"""
+    tail = reader.tail(TAIL_BYTES)
+    end = tail.rfind(b'PK\x05\x06')
+    if end < 0 or end + 22 > len(tail):
+        return None
+    directory_size, directory_offset = struct.unpack_from('<II', tail, end + 12)
+    if directory_offset == 0xFFFFFFFF:
+        # Zip64 directories are not read; the caller falls back to the local headers
+        return []
+    directory = reader.at(directory_offset, min(directory_size, 4 * WINDOW_BYTES))
+    names, offset = [], 0
+    while offset + 46 <= len(directory) and directory[offset:offset + 4] == b'PK\x01\x02':
+        name_length, extra_length, comment_length = struct.unpack_from('<HHH', directory, offset + 28)
+        names.append(directory[offset + 46:offset + 46 + name_length].decode('utf-8', errors='replace'))
+        offset += 46 + name_length + extra_length + comment_length
+    return names
+
+
+def _zip(reader: RangeReader) -> Tuple[str, Dict[str, Any]]:
+    """Tell OOXML and EPUB containers from plain zips by their member names"""
+    head = reader.head
+    if head[30:38] == b'mimetype' and b'application/epub+zip' in head[38:80]:
+        return 'epub', {}
+    names = _zip_names(reader)
+    if names is None:
+        return 'zip', {'problem': "Zip container is truncated (no central directory)"}
+    if not names:
+        # Fall back to the local file headers in the head
+        for match in re.finditer(rb'PK\x03\x04', head):
+            start = match.start() + 30
+            if start <= len(head):
+                length = struct.unpack_from('<H', head, match.start() + 26)[0]
+                names.append(head[start:start + length].decode('utf-8', errors='replace'))
+    markers = {'word/document.xml': 'docx', 'ppt/presentation.xml': 'pptx', 'xl/workbook.xml': 'xlsx'}
+    for name in names:
+        if name in markers:
+            return markers[name], {}
+    return 'zip', {}
+
+
+def _pdf_header(head: bytes) -> bool:
+    """
+    Whether a head starts a PDF: the signature at offset 0, or at a line
+    start in the first KB after binary junk, which readers skip too
+    """
+    if head.startswith(b'%PDF-'):
+        return True
+    offset = head.find(b'%PDF-', 0, 1024)
+    if offset <= 0 or head[offset - 1] not in b'\r\n':
+        return False
+    # Text before the signature is a text file that mentions one
+    return _text(head[:offset]) is None
+
+
+def _text(head: bytes) -> Optional[str]:
+    """Text format of a head that looks like text, None for binary data"""
+    if head.startswith((b'\xff\xfe', b'\xfe\xff')):
+        return 'txt'
+    if b'\x00' in head:
+        return None
+    controls = sum(head.count(bytes([c])) for c in range(32) if c not in (9, 10, 12, 13, 27))
+    if controls > len(head) // 100:
+        return None
+    text = head.decode('utf-8', errors='replace').lstrip('﻿ \t\r\n')
+    lower = text[:4096].lower()
+    if text.startswith('WEBVTT'):
+        return 'vtt'
+    if text.startswith('{\\rtf'):
+        return 'rtf'
+    if SRT_CUE.search(text[:4096]):
+        return 'srt'
+    if text.startswith('<') and '<svg' in lower:
+        return 'svg'
+    if lower.startswith(('<!doctype html', '<html')):
+        return 'html'
+    return 'txt'
+
+
+def detect(reader: RangeReader) -> Tuple[Optional[str], Dict[str, Any]]:
+    """Format of an input and whatever header metadata its container carries"""
+    head = reader.head
+    if head.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'png', _png(reader)
+    if head.startswith(b'\xff\xd8\xff'):
+        return 'jpg', _jpeg(reader)
+    if head.startswith((b'GIF87a', b'GIF89a')):
+        return 'gif', _gif(reader)
+    if head.startswith(b'RIFF') and head[8:12] == b'WEBP':
+        return 'webp', _webp(reader)
+    if head.startswith(b'RIFF') and head[8:12] == b'WAVE':
+        return 'wav', _wav(reader)
+    if head.startswith(b'RIFF') and head[8:12] == b'AVI ':
+        return 'avi', {}
+    if _pdf_header(head):
+        return 'pdf', _pdf(reader)
+    if head.startswith((b'PK\x03\x04', b'PK\x05\x06')):
+        return _zip(reader)
+    if head.startswith(b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1'):
+        return 'doc', {}
+    # Text such as "Let free ..." has a QuickTime box name at 4; a real first box also has a sane size
+    if head[4:8] == b'ftyp' or (head[4:8] in QUICKTIME_BOXES and 8 <= _u32be(head, 0) <= reader.size):
+        return _isobmff(reader)
+    if head.startswith((b'II*\x00', b'MM\x00*')):
+        return 'tiff', {}
+    if head.startswith(b'BM') and len(head) >= 26 and struct.unpack_from('<I', head, 2)[0] == reader.size:
+        return 'bmp', _bmp(reader)
+    if head.startswith(b'\x1a\x45\xdf\xa3'):
+        return 'webm', {}
+    if head.startswith(b'fLaC'):
+        return 'flac', {}
+    if head.startswith(b'OggS'):
+        return 'ogg', {}
+    if head.startswith(b'\x1f\x8b'):
+        return 'gz', {}
+    # A UTF-16LE BOM (FF FE) would otherwise pass for an MP3 frame sync
+    if head.startswith((b'\xff\xfe', b'\xfe\xff')):
+        return 'txt', {}
+    if head.startswith(b'ID3') or (len(head) > 1 and head[0] == 0xFF and head[1] & 0xE0 == 0xE0):
+        return 'mp3', {}
+    return _text(head), {}
+
+
+def probe(read: Callable[[int, int], bytes], size: int) -> Probe:
+    """Identify an input of a given size through a read(offset, length) callable"""
+    if size <= 0:
+        return Probe(None, 0)
+    reader = RangeReader(read, size)
+    try:
+        fmt, meta = detect(reader)
+    except struct.error:
+        # A header cut short; what was recognized still counts
+        fmt, meta = None, {}
+    return Probe(fmt, size, **meta)
+
+
+def probe_object(storage: Any, key: str) -> Probe:
+    """Probe a stored input with ranged reads instead of a full download"""
+    size = storage.head(key).size
+    return probe(lambda offset, length: storage.read_range(key, offset, length), size)
+
+
+def accepts(inputs: Iterable[str], fmt: Optional[str]) -> bool:
+    """Whether a detected format is one a converter with the given input formats can take"""
+    return any(fmt == name or fmt in ACCEPTS.get(name, ()) for name in inputs)
+
+
+def check(probe: Probe, converter: str, inputs: Iterable[str]):
+    """Raise InputRejected when an input can't be converted by a converter taking the given formats"""
+    inputs = list(inputs)
+    if probe.size == 0:
+        raise InputRejected("Input file is empty")
+    if inputs and not accepts(inputs, probe.format):
+        expected = ' or '.join(inputs)
+        found = probe.format or 'unrecognized or corrupt data'
+        raise InputRejected(f"{converter} expects {expected} input, got {found}")
+    if probe.problem:
+        raise InputRejected(probe.problem)
+    if MAX_MEGAPIXELS and probe.megapixels and probe.megapixels > MAX_MEGAPIXELS:
+        raise InputRejected(f"Image is {probe.width}x{probe.height} ({probe.megapixels:.0f} MP), "
+                            f"the limit is {MAX_MEGAPIXELS:g} MP")
+    if MAX_PAGES and probe.pages and probe.pages > MAX_PAGES:
+        raise InputRejected(f"Document has {probe.pages} pages, the limit is {MAX_PAGES}")
+    if MAX_DURATION and probe.duration and probe.duration > MAX_DURATION:
+        raise InputRejected(f"Media runs {probe.duration / 60:.0f} minutes, "
+                            f"the limit is {MAX_DURATION / 60:.0f} minutes")
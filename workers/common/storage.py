@@ -0,0 +1,528 @@
+"""
+Storage backends
+Workers reach stored objects through download_file/upload_file and
+friends on a backend: S3Storage (R2 through boto3) or LocalStorage (a
+directory shared with the web tier on a single host). LocalStorage hands
+files over with hardlinks and os.replace instead of copying.
+STORAGE_BACKEND picks the default backend and LOCAL_STORAGE_PREFIXES
+routes keys with those prefixes to the local volume regardless. Downloads
+from R2 go through CachedStorage, a bounded on-disk LRU of inputs keyed by
+object key and ETag, so retries and repeated conversions skip the transfer.
+Only file downloads fill it; in-memory downloads just read existing entries.
+open_upload() returns a writer for output that is produced as a stream; on
+R2 its parts are multipart-uploaded while later bytes are still coming.
+"""
+
+import os
+import errno
+import fcntl
+import shutil
+import hashlib
+import logging
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Any, BinaryIO, Callable, Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+from common.tracing import span
+
+logger = logging.getLogger(__name__)
+
+# Size of every multipart part but the last (R2 wants equal parts of at least 5 MiB)
+MULTIPART_PART_SIZE = 8 * 1024 * 1024
+# Parts buffered or in flight at once; a writer blocks beyond this
+MULTIPART_MAX_PENDING = 2
+
+
+class ObjectInfo(NamedTuple):
+    key: str
+    size: int
+    etag: str
+    last_modified: datetime
+
+
+class MultipartUpload:
+    """
+    Writer that stores an object as an S3 multipart upload. Full parts go
+    up on background threads while the producer keeps writing; nothing is
+    visible until commit(), and abort() discards the parts.
+    """
+    
+    def __init__(self, client: Any, bucket: str, key: str, part_size: int = MULTIPART_PART_SIZE,
+                 max_pending: int = MULTIPART_MAX_PENDING):
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.part_size = part_size
+        self.size = 0
+        self._buffer = bytearray()
+        self._futures = []
+        self._slots = threading.Semaphore(max_pending)
+        self._pool = ThreadPoolExecutor(max_workers=max_pending)
+        self._upload_id = client.create_multipart_upload(Bucket=bucket, Key=key)['UploadId']
+    
+    def _upload_part(self, number: int, body: bytes) -> Dict[str, Any]:
+        try:
+            response = self.client.upload_part(Bucket=self.bucket, Key=self.key, UploadId=self._upload_id,
+                                               PartNumber=number, Body=body)
+            return {'PartNumber': number, 'ETag': response['ETag']}
+        finally:
+            self._slots.release()
+    
+    def _submit(self, body: bytes):
+        # A failed part fails the writer now rather than at commit
+        for future in self._futures:
+            if future.done() and future.exception():
+                raise future.exception()
+        self._slots.acquire()
+        self._futures.append(self._pool.submit(self._upload_part, len(self._futures) + 1, body))
+    
+    def write(self, data: bytes):
+        self._buffer += data
+        self.size += len(data)
+        while len(self._buffer) >= self.part_size:
+            self._submit(bytes(self._buffer[:self.part_size]))
+            del self._buffer[:self.part_size]
+    
+    def commit(self):
+        if self._buffer or not self._futures:
+            self._submit(bytes(self._buffer))
+            self._buffer.clear()
+        try:
+            parts = [future.result() for future in self._futures]
+            self.client.complete_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self._upload_id,
+                                                  MultipartUpload={'Parts': parts})
+        finally:
+            self._pool.shutdown()
+    
+    def abort(self):
+        self._pool.shutdown(cancel_futures=True)
+        try:
+            self.client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self._upload_id)
+        except Exception as e:
+            logger.warning(f"Could not abort multipart upload of {self.key}: {e}")
+
+
+class FileUpload:
+    """Writer that streams into a staging file and replaces the object on commit()"""
+    
+    def __init__(self, staging: str, path: str):
+        self.staging = staging
+        self.path = path
+        self.size = 0
+        self._file = open(staging, 'wb')
+    
+    def write(self, data: bytes):
+        self._file.write(data)
+        self.size += len(data)
+    
+    def commit(self):
+        self._file.close()
+        os.replace(self.staging, self.path)
+    
+    def abort(self):
+        self._file.close()
+        if os.path.lexists(self.staging):
+            os.unlink(self.staging)
+
+
+class S3Storage:
+    name = 's3'
+    
+    def __init__(self, client: Any = None, bucket: str = None):
+        if client is None:
+            import boto3
+            client = boto3.client(
+                's3',
+                endpoint_url=os.getenv('R2_PUBLIC_URL') or None,
+                aws_access_key_id=os.getenv('R2_ACCESS_KEY_ID'),
+                aws_secret_access_key=os.getenv('R2_SECRET_ACCESS_KEY'),
+                region_name='auto'
+            )
+        self.client = client
+        self.bucket = bucket or os.getenv('R2_BUCKET_NAME', 'aic-files')
+    
+    def download_file(self, key: str, local_path: str):
+        self.client.download_file(self.bucket, key, local_path)
+    
+    def upload_file(self, local_path: str, key: str):
+        self.client.upload_file(local_path, self.bucket, key)
+    
+    def download_fileobj(self, key: str, fileobj: BinaryIO):
+        self.client.download_fileobj(self.bucket, key, fileobj)
+    
+    def upload_fileobj(self, fileobj: BinaryIO, key: str):
+        self.client.upload_fileobj(fileobj, self.bucket, key)
+    
+    def open_upload(self, key: str) -> MultipartUpload:
+        return MultipartUpload(self.client, self.bucket, key)
+    
+    def head(self, key: str) -> ObjectInfo:
+        response = self.client.head_object(Bucket=self.bucket, Key=key)
+        return ObjectInfo(key, response['ContentLength'], response.get('ETag', '').strip('"'),
+                          response.get('LastModified'))
+    
+    def read_range(self, key: str, start: int, length: int) -> bytes:
+        """Up to length bytes of an object from an offset, without fetching the rest"""
+        response = self.client.get_object(Bucket=self.bucket, Key=key, Range=f"bytes={start}-{start + length - 1}")
+        return response['Body'].read()
+    
+    def delete(self, key: str):
+        self.client.delete_object(Bucket=self.bucket, Key=key)
+    
+    def list(self, prefix: str = '') -> Iterator[ObjectInfo]:
+        """Every object under a prefix, following continuation tokens"""
+        kwargs = {'Bucket': self.bucket, 'Prefix': prefix}
+        while True:
+            response = self.client.list_objects_v2(**kwargs)
+            for obj in response.get('Contents', []):
+                yield ObjectInfo(obj['Key'], obj.get('Size', 0), obj.get('ETag', '').strip('"'),
+                                 obj['LastModified'])
+            if not response.get('IsTruncated'):
+                return
+            kwargs['ContinuationToken'] = response['NextContinuationToken']
+
+
+class LocalStorage:
+    name = 'local'
+    
+    def __init__(self, root: str = None):
+        self.root = os.path.abspath(root or os.getenv('LOCAL_STORAGE_ROOT') or '/data/storage')
+        self._warned_copy = False
+    
+    def path(self, key: str) -> str:
+        """Filesystem path of a key; keys may not leave the storage root"""
+        path = os.path.abspath(os.path.join(self.root, key))
+        if not path.startswith(self.root + os.sep):
+            raise ValueError(f"Key escapes storage root: {key}")
+        return path
+    
+    def _link_or_copy(self, source: str, target: str):
+        """Hardlink source to target, copying only across filesystems"""
+        try:
+            os.link(source, target)
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                raise
+            if not self._warned_copy:
+                # Happens when TMPDIR is not on the storage volume
+                logger.warning(f"Cannot hardlink into {os.path.dirname(target)} ({e.strerror}), copying instead")
+                self._warned_copy = True
+            shutil.copyfile(source, target)
+    
+    def _staging_path(self, key: str) -> str:
+        """Unused temporary name next to the final path, so os.replace stays atomic"""
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, staging = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.', suffix='.part')
+        os.close(fd)
+        os.unlink(staging)
+        return staging
+    
+    def download_file(self, key: str, local_path: str):
+        source = self.path(key)
+        if not os.path.exists(source):
+            raise FileNotFoundError(f"No such object: {key}")
+        # The caller usually pre-creates the target (NamedTemporaryFile)
+        if os.path.lexists(local_path):
+            os.unlink(local_path)
+        self._link_or_copy(source, local_path)
+    
+    def upload_file(self, local_path: str, key: str):
+        # Readers see either the old object or the complete new one
+        staging = self._staging_path(key)
+        try:
+            self._link_or_copy(local_path, staging)
+            os.replace(staging, self.path(key))
+        except Exception:
+            if os.path.lexists(staging):
+                os.unlink(staging)
+            raise
+    
+    def download_fileobj(self, key: str, fileobj: BinaryIO):
+        with open(self.path(key), 'rb') as f:
+            shutil.copyfileobj(f, fileobj)
+    
+    def upload_fileobj(self, fileobj: BinaryIO, key: str):
+        staging = self._staging_path(key)
+        try:
+            with open(staging, 'wb') as f:
+                shutil.copyfileobj(fileobj, f)
+            os.replace(staging, self.path(key))
+        except Exception:
+            if os.path.lexists(staging):
+                os.unlink(staging)
+            raise
+    
+    def open_upload(self, key: str) -> FileUpload:
+        return FileUpload(self._staging_path(key), self.path(key))
+    
+    def _info(self, key: str, path: str) -> ObjectInfo:
+        stat = os.stat(path)
+        # Changes whenever the object is replaced, like an S3 ETag
+        etag = f"{stat.st_ino:x}-{stat.st_size:x}-{stat.st_mtime_ns:x}"
+        return ObjectInfo(key, stat.st_size, etag, datetime.fromtimestamp(stat.st_mtime, timezone.utc))
+    
+    def head(self, key: str) -> ObjectInfo:
+        path = self.path(key)
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"No such object: {key}")
+        return self._info(key, path)
+    
+    def read_range(self, key: str, start: int, length: int) -> bytes:
+        with open(self.path(key), 'rb') as f:
+            f.seek(start)
+            return f.read(length)
+    
+    def delete(self, key: str):
+        try:
+            os.unlink(self.path(key))
+        except FileNotFoundError:
+            pass
+    
+    def list(self, prefix: str = '') -> Iterator[ObjectInfo]:
+        for directory, _, files in os.walk(self.root):
+            for name in files:
+                if name.endswith('.part'):
+                    continue
+                path = os.path.join(directory, name)
+                key = os.path.relpath(path, self.root).replace(os.sep, '/')
+                if key.startswith(prefix):
+                    yield self._info(key, path)
+
+
+class RoutedStorage:
+    """Default backend plus key prefixes served by other backends"""
+    
+    def __init__(self, default: Any, routes: List[Tuple[str, Any]] = None):
+        self.default = default
+        # Longest prefix wins
+        self.routes = sorted(routes or [], key=lambda route: len(route[0]), reverse=True)
+        self.name = '+'.join([default.name] + [f"{backend.name}:{prefix}" for prefix, backend in self.routes])
+    
+    def backend_for(self, key: str) -> Any:
+        for prefix, backend in self.routes:
+            if key.startswith(prefix):
+                return backend
+        return self.default
+    
+    def download_file(self, key: str, local_path: str):
+        self.backend_for(key).download_file(key, local_path)
+    
+    def upload_file(self, local_path: str, key: str):
+        self.backend_for(key).upload_file(local_path, key)
+    
+    def download_fileobj(self, key: str, fileobj: BinaryIO):
+        self.backend_for(key).download_fileobj(key, fileobj)
+    
+    def upload_fileobj(self, fileobj: BinaryIO, key: str):
+        self.backend_for(key).upload_fileobj(fileobj, key)
+    
+    def open_upload(self, key: str) -> Any:
+        return self.backend_for(key).open_upload(key)
+    
+    def head(self, key: str) -> ObjectInfo:
+        return self.backend_for(key).head(key)
+    
+    def read_range(self, key: str, start: int, length: int) -> bytes:
+        return self.backend_for(key).read_range(key, start, length)
+    
+    def delete(self, key: str):
+        self.backend_for(key).delete(key)
+    
+    def list(self, prefix: str = '') -> Iterator[ObjectInfo]:
+        """Objects under a prefix from every backend, each key from the backend that owns it"""
+        backends = [self.default] + [backend for _, backend in self.routes]
+        seen = set()
+        for backend in backends:
+            if id(backend) in seen:
+                continue
+            seen.add(id(backend))
+            for info in backend.list(prefix):
+                if self.backend_for(info.key) is backend:
+                    yield info
+
+
+class CachedStorage:
+    """
+    Keeps downloaded inputs of a remote backend in a size-bounded directory.
+    Entries are named by a hash of key and ETag, so a replaced object is
+    never served stale; a HEAD request validates each lookup. The directory
+    is the index, shared by every worker process on the host. Entries
+    appear atomically and the least recently used go first once the total
+    size passes the limit. Hits are hardlinked to the caller's path when
+    the cache shares its filesystem.
+    """
+    
+    def __init__(self, backend: Any, directory: str, max_bytes: int):
+        self.backend = backend
+        self.name = f"cached-{backend.name}"
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.local = LocalStorage(directory)
+        self.hits = 0
+        self.misses = 0
+        # One download per entry at a time within this process: entry -> (lock, jobs using it)
+        self._locks: Dict[str, Tuple[threading.Lock, int]] = {}
+        self._locks_guard = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+    
+    @contextmanager
+    def _entry_lock(self, entry: str) -> Iterator[None]:
+        """Hold the lock of one entry; other entries' downloads go on meanwhile"""
+        with self._locks_guard:
+            lock, users = self._locks.get(entry) or (threading.Lock(), 0)
+            self._locks[entry] = (lock, users + 1)
+        try:
+            with lock:
+                yield
+        finally:
+            with self._locks_guard:
+                users = self._locks[entry][1] - 1
+                if users:
+                    self._locks[entry] = (lock, users)
+                else:
+                    del self._locks[entry]
+    
+    def _entry_path(self, info: ObjectInfo) -> str:
+        digest = hashlib.sha256(f"{info.key}\0{info.etag}".encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, digest)
+    
+    def _fetch(self, key: str, deliver: Callable[[str], None], fill: bool = True) -> bool:
+        """
+        Hand a cached copy of an object to deliver(), downloading it on a
+        miss. False when the object is too large to cache, or on a miss
+        when fill is False.
+        """
+        info = self.backend.head(key)
+        if info.size > self.max_bytes:
+            return False
+        entry = self._entry_path(info)
+        
+        with span('input.cache', key=key, size=info.size) as cache_span, self._entry_lock(entry):
+            if os.path.exists(entry):
+                try:
+                    # Mark as recently used for eviction
+                    os.utime(entry)
+                    deliver(entry)
+                    self.hits += 1
+                    cache_span.set('hit', True)
+                    return True
+                except FileNotFoundError:
+                    # Evicted by another process in the meantime
+                    pass
+            
+            self.misses += 1
+            cache_span.set('hit', False)
+            if not fill:
+                return False
+            fd, staging = tempfile.mkstemp(dir=self.directory, prefix='.', suffix='.part')
+            os.close(fd)
+            try:
+                self.backend.download_file(key, staging)
+                # Hand over the staging file first: once it is an entry, another process may evict it
+                deliver(staging)
+                os.replace(staging, entry)
+            except Exception:
+                if os.path.lexists(staging):
+                    os.unlink(staging)
+                raise
+        self._evict(keep=entry)
+        return True
+    
+    def _evict(self, keep: str):
+        """Drop least recently used entries until the cache fits its budget"""
+        with open(os.path.join(self.directory, '.lock'), 'w') as lock_file:
+            # Serialize evictions across the processes sharing the directory
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            entries = []
+            total = 0
+            with os.scandir(self.directory) as scan:
+                for item in scan:
+                    if item.name.startswith('.') or not item.is_file():
+                        continue
+                    stat = item.stat()
+                    entries.append((stat.st_mtime, item.path, stat.st_size))
+                    total += stat.st_size
+            entries.sort()
+            for _, path, size in entries:
+                if total <= self.max_bytes:
+                    break
+                if path == keep:
+                    continue
+                try:
+                    # Callers holding a hardlink keep their copy
+                    os.unlink(path)
+                    total -= size
+                except FileNotFoundError:
+                    pass
+    
+    def download_file(self, key: str, local_path: str):
+        def deliver(entry: str):
+            if os.path.lexists(local_path):
+                os.unlink(local_path)
+            self.local._link_or_copy(entry, local_path)
+        
+        if not self._fetch(key, deliver):
+            self.backend.download_file(key, local_path)
+    
+    def download_fileobj(self, key: str, fileobj: BinaryIO):
+        """Serve cache hits; misses stream from the backend without touching the disk"""
+        def deliver(entry: str):
+            with open(entry, 'rb') as f:
+                shutil.copyfileobj(f, fileobj)
+        
+        if not self._fetch(key, deliver, fill=False):
+            self.backend.download_fileobj(key, fileobj)
+    
+    def upload_file(self, local_path: str, key: str):
+        self.backend.upload_file(local_path, key)
+    
+    def upload_fileobj(self, fileobj: BinaryIO, key: str):
+        self.backend.upload_fileobj(fileobj, key)
+    
+    def open_upload(self, key: str) -> Any:
+        return self.backend.open_upload(key)
+    
+    def head(self, key: str) -> ObjectInfo:
+        return self.backend.head(key)
+    
+    def read_range(self, key: str, start: int, length: int) -> bytes:
+        return self.backend.read_range(key, start, length)
+    
+    def delete(self, key: str):
+        self.backend.delete(key)
+    
+    def list(self, prefix: str = '') -> Iterator[ObjectInfo]:
+        return self.backend.list(prefix)
+
+
+def open_input_cache(backend: Any) -> Any:
+    """Wrap a remote backend in the input cache unless INPUT_CACHE_MB is 0"""
+    max_mb = float(os.getenv('INPUT_CACHE_MB') or 1024)
+    if max_mb <= 0:
+        return backend
+    directory = os.getenv('INPUT_CACHE_DIR') or os.path.join(tempfile.gettempdir(), 'input-cache')
+    return CachedStorage(backend, directory, int(max_mb * 1024 * 1024))
+
+
+def open_storage(backend: Optional[str] = None) -> Any:
+    """
+    Storage configured by the environment: STORAGE_BACKEND (s3 or local)
+    and LOCAL_STORAGE_PREFIXES, a comma-separated list of key prefixes kept
+    on the local volume when the default backend is s3.
+    """
+    backend = (backend or os.getenv('STORAGE_BACKEND') or 's3').lower()
+    if backend == 'local':
+        return LocalStorage()
+    if backend != 's3':
+        raise ValueError(f"Unknown STORAGE_BACKEND: {backend}")
+
+    prefixes = [prefix.strip() for prefix in (os.getenv('LOCAL_STORAGE_PREFIXES') or '').split(',') if prefix.strip()]
+    remote = open_input_cache(S3Storage())
+    if not prefixes:
+        return remote
+    local = LocalStorage()
+    return RoutedStorage(remote, [(prefix, local) for prefix in prefixes])
@@ -0,0 +1,190 @@
+"""
+Subprocess supervisor with resource accounting
+Waits on each converter child directly with wait4 so its rusage (CPU
+user/sys time, peak RSS, block I/O, context switches) is captured, and
+kills the whole process group on timeout. Children can be given their own
+environment and CPU affinity, and their stdout can be streamed to a sink
+instead of collected. Safe to call from any thread.
+"""
+
+import os
+import time
+import logging
+import signal
+import resource
+import threading
+import subprocess
+from typing import Callable, Dict, FrozenSet, NamedTuple, Optional
+
+logger = logging.getLogger(__name__)
+
+# rusage block counts are in 512-byte units
+BLOCK_SIZE = 512
+
+
+class SupervisedResult(NamedTuple):
+    returncode: int
+    stdout: bytes
+    stderr: bytes
+    duration: float
+    usage: Dict[str, float]
+    timed_out: bool
+
+
+def usage_from_rusage(rusage) -> Dict[str, float]:
+    """Normalize a struct_rusage into the fields we store per job"""
+    return {
+        'cpuUserSeconds': round(rusage.ru_utime, 3),
+        'cpuSystemSeconds': round(rusage.ru_stime, 3),
+        'peakRssKb': rusage.ru_maxrss,
+        'ioReadBytes': rusage.ru_inblock * BLOCK_SIZE,
+        'ioWriteBytes': rusage.ru_oublock * BLOCK_SIZE,
+        'voluntaryCtxSwitches': rusage.ru_nvcsw,
+        'involuntaryCtxSwitches': rusage.ru_nivcsw
+    }
+
+
+def _drain(stream, write: Callable[[bytes], None]):
+    for chunk in iter(lambda: stream.read(65536), b''):
+        write(chunk)
+    stream.close()
+
+
+def _feed(stream, data: bytes):
+    try:
+        stream.write(data)
+    except BrokenPipeError:
+        pass
+    finally:
+        try:
+            stream.close()
+        except BrokenPipeError:
+            pass
+
+
+def supervise(cmd: list, timeout: float, input: bytes = None, env: Dict[str, str] = None,
+              cpus: FrozenSet[int] = None, stdout_sink: Callable[[bytes], None] = None) -> SupervisedResult:
+    """
+    Run a command in its own process group and reap it with wait4. With a
+    stdout_sink, output chunks go to the sink as they are read; a sink
+    that raises kills the group, so the command exits with an error and
+    the rest of its output is dropped.
+    """
+    start_time = time.monotonic()
+    process = subprocess.Popen(
+        cmd,
+        stdin=subprocess.PIPE if input is not None else subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        start_new_session=True,
+        env=env,
+        # Pinned before exec so every thread the tool starts inherits the mask
+        preexec_fn=(lambda: os.sched_setaffinity(0, cpus)) if cpus else None
+    )
+    
+    lock = threading.Lock()
+    state = {'reaped': False, 'timed_out': False, 'sink_failed': False}
+    
+    def kill_group():
+        with lock:
+            if state['reaped']:
+                return
+            state['timed_out'] = True
+            try:
+                os.killpg(process.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+    
+    timer = threading.Timer(timeout, kill_group)
+    timer.daemon = True
+    timer.start()
+    
+    def sink_or_kill(chunk: bytes):
+        if state['sink_failed']:
+            return
+        try:
+            stdout_sink(chunk)
+        except Exception as e:
+            logger.error(f"Output sink of {os.path.basename(cmd[0])} failed, killing it: {e}")
+            state['sink_failed'] = True
+            try:
+                os.killpg(process.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+    
+    stdout_chunks, stderr_chunks = [], []
+    threads = [
+        threading.Thread(target=_drain, args=(process.stdout, sink_or_kill if stdout_sink else stdout_chunks.append),
+                         daemon=True),
+        threading.Thread(target=_drain, args=(process.stderr, stderr_chunks.append), daemon=True)
+    ]
+    if input is not None:
+        threads.append(threading.Thread(target=_feed, args=(process.stdin, input), daemon=True))
+    for thread in threads:
+        thread.start()
+    
+    try:
+        _, status, rusage = os.wait4(process.pid, 0)
+    finally:
+        with lock:
+            state['reaped'] = True
+        timer.cancel()
+    
+    process.returncode = os.waitstatus_to_exitcode(status)
+    # A detached grandchild can keep the pipes open; don't wait on it forever
+    for thread in threads:
+        thread.join(timeout=5)
+    
+    return SupervisedResult(
+        returncode=process.returncode,
+        stdout=b''.join(stdout_chunks),
+        stderr=b''.join(stderr_chunks),
+        duration=time.monotonic() - start_time,
+        usage=usage_from_rusage(rusage),
+        timed_out=state['timed_out']
+    )
+
+
+class JobAccounting:
+    """Per-job totals of every supervised child plus the job thread's own CPU time"""
+    
+    _local = threading.local()
+    
+    def __init__(self):
+        self.totals: Dict[str, float] = {
+            'cpuUserSeconds': 0.0,
+            'cpuSystemSeconds': 0.0,
+            'peakRssKb': 0,
+            'ioReadBytes': 0,
+            'ioWriteBytes': 0,
+            'voluntaryCtxSwitches': 0,
+            'involuntaryCtxSwitches': 0,
+            'subprocessCount': 0
+        }
+        self._thread_start = None
+    
+    def add(self, usage: Dict[str, float]):
+        for key, value in usage.items():
+            if key == 'peakRssKb':
+                self.totals[key] = max(self.totals[key], value)
+            else:
+                self.totals[key] = round(self.totals[key] + value, 3)
+        self.totals['subprocessCount'] += 1
+    
+    def __enter__(self) -> 'JobAccounting':
+        JobAccounting._local.current = self
+        self._thread_start = resource.getrusage(resource.RUSAGE_THREAD)
+        return self
+    
+    def __exit__(self, *exc):
+        thread_end = resource.getrusage(resource.RUSAGE_THREAD)
+        self.totals['workerCpuSeconds'] = round(
+            (thread_end.ru_utime - self._thread_start.ru_utime)
+            + (thread_end.ru_stime - self._thread_start.ru_stime), 3
+        )
+        JobAccounting._local.current = None
+        return False
+    
+    @classmethod
+    def current(cls) -> Optional['JobAccounting']:
+        return getattr(cls._local, 'current', None)
@@ -0,0 +1,129 @@
+"""
+Thread budget for converter tools
+ffmpeg, ImageMagick, tesseract and LibreOffice size their thread pools by
+the host's core count, so a few concurrent jobs oversubscribe the CPUs and
+throughput drops as slots are added. The async core splits the CPUs the
+container may use (affinity mask and cgroup quota) between its CPU slots
+and caps each tool at one share: thread limits in the environment for
+ImageMagick and OpenMP, -threads for ffmpeg, and optionally a CPU
+affinity set per slot.
+"""
+
+import os
+import logging
+from typing import Dict, FrozenSet, List, Optional
+
+from common.autoscale import pool_size
+
+logger = logging.getLogger(__name__)
+
+CGROUP_V2_CPU_MAX = '/sys/fs/cgroup/cpu.max'
+CGROUP_V1_QUOTA = '/sys/fs/cgroup/cpu/cpu.cfs_quota_us'
+CGROUP_V1_PERIOD = '/sys/fs/cgroup/cpu/cpu.cfs_period_us'
+
+# Budget of the core running in this process, read by ffmpeg_threads()
+_active_budget: Optional['ThreadBudget'] = None
+
+
+def _read(path: str) -> Optional[str]:
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def cgroup_cpu_quota() -> Optional[float]:
+    """CPUs worth of time the cgroup may use per period, None when unlimited or unknown"""
+    cpu_max = _read(CGROUP_V2_CPU_MAX)
+    if cpu_max:
+        quota, _, period = cpu_max.partition(' ')
+        if quota == 'max':
+            return None
+        try:
+            return int(quota) / int(period or 100000)
+        except ValueError:
+            return None
+    quota, period = _read(CGROUP_V1_QUOTA), _read(CGROUP_V1_PERIOD)
+    try:
+        if quota and period and int(quota) > 0:
+            return int(quota) / int(period)
+    except ValueError:
+        pass
+    return None
+
+
+def allowed_cpus() -> List[int]:
+    """CPUs in this process's affinity mask"""
+    try:
+        return sorted(os.sched_getaffinity(0))
+    except AttributeError:
+        return list(range(os.cpu_count() or 1))
+
+
+def available_cpus() -> float:
+    """CPUs this container can actually use: the affinity mask capped by the cgroup quota"""
+    cpus = len(allowed_cpus())
+    quota = cgroup_cpu_quota()
+    return min(cpus, quota) if quota else float(cpus)
+
+
+class ThreadBudget:
+    """
+    Threads per converter subprocess for a core with a number of CPU slots.
+    WORKER_THREADS_PER_JOB overrides the computed share; WORKER_CPU_AFFINITY=1
+    additionally pins every slot to its own set of that many CPUs.
+    """
+    
+    def __init__(self, cpu_slots: int, cpus: float = None, processes: int = None):
+        self.cpus = cpus or available_cpus()
+        # Pre-forked children share the container's CPUs
+        processes = processes or pool_size()
+        configured = int(os.getenv('WORKER_THREADS_PER_JOB') or 0)
+        self.threads = configured or max(1, int(self.cpus // (cpu_slots * processes)))
+        self.pin = os.getenv('WORKER_CPU_AFFINITY') == '1'
+        self._cpu_sets = self._split_cpus() if self.pin else []
+        self._in_use = [0] * len(self._cpu_sets)
+        self._offset = os.getpid() % max(len(self._cpu_sets), 1)
+    
+    def _split_cpus(self) -> List[FrozenSet[int]]:
+        """Disjoint sets of `threads` CPUs from the affinity mask"""
+        cpus = allowed_cpus()
+        size = min(self.threads, len(cpus))
+        return [frozenset(cpus[i:i + size]) for i in range(0, len(cpus) - size + 1, size)]
+    
+    def env(self) -> Dict[str, str]:
+        """Environment of a converter subprocess with its thread pools capped"""
+        env = dict(os.environ)
+        env['MAGICK_THREAD_LIMIT'] = str(self.threads)
+        env['OMP_THREAD_LIMIT'] = str(self.threads)
+        env['OMP_NUM_THREADS'] = str(self.threads)
+        return env
+    
+    def acquire_cpus(self) -> Optional[FrozenSet[int]]:
+        """
+        Least busy CPU set for a starting subprocess when pinning is on.
+        Ties go to the set nearest an offset taken from the PID, which
+        spreads pre-forked children over different sets.
+        """
+        if not self._cpu_sets:
+            return None
+        count = len(self._cpu_sets)
+        index = min(range(count), key=lambda i: (self._in_use[i], (i - self._offset) % count))
+        self._in_use[index] += 1
+        return self._cpu_sets[index]
+    
+    def release_cpus(self, cpu_set: Optional[FrozenSet[int]]):
+        if cpu_set is not None:
+            self._in_use[self._cpu_sets.index(cpu_set)] -= 1
+    
+    def activate(self):
+        """Make this the budget ffmpeg_threads() reports in this process"""
+        global _active_budget
+        _active_budget = self
+
+
+def ffmpeg_threads() -> List[str]:
+    """-threads option for an ffmpeg output under the active budget, empty without one"""
+    budget = _active_budget
+    return ['-threads', str(budget.threads)] if budget else []
@@ -0,0 +1,141 @@
+"""
+Lightweight job tracing
+Each job is a trace (the trace id is the job id, so retries share it) with
+child spans for queue wait, download, conversion, subprocesses, upload and
+status writes. Finished spans are appended as JSON lines to
+TRACE_EXPORT_PATH; tracing is off when it is unset.
+"""
+
+import os
+import json
+import time
+import logging
+import threading
+import contextvars
+from datetime import datetime
+from typing import Any, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+_current_span: contextvars.ContextVar = contextvars.ContextVar('current_span', default=None)
+
+
+class JsonlExporter:
+    """Appends one JSON object per finished span; reopens the file after fork"""
+    
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = None
+        self._pid = None
+    
+    def export(self, record: Dict[str, Any]):
+        line = json.dumps(record, default=str) + '\n'
+        with self._lock:
+            try:
+                if self._file is None or self._pid != os.getpid():
+                    os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+                    self._file = open(self.path, 'a', buffering=1)
+                    self._pid = os.getpid()
+                self._file.write(line)
+            except OSError as e:
+                logger.warning(f"Failed to export span: {e}")
+
+
+_export_path = os.getenv('TRACE_EXPORT_PATH')
+_exporter: Optional[JsonlExporter] = JsonlExporter(_export_path) if _export_path else None
+
+
+class Span:
+    def __init__(self, name: str, trace_id: str, parent: Optional['Span'] = None,
+                 attributes: Dict[str, Any] = None, start_ns: int = None):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent.span_id if parent else None
+        self.attributes = dict(attributes or {})
+        self.start_ns = start_ns or time.time_ns()
+        self.end_ns = None
+        self.status = 'ok'
+        self._token = None
+    
+    def set(self, key: str, value: Any):
+        self.attributes[key] = value
+    
+    def end(self, end_ns: int = None):
+        self.end_ns = end_ns or time.time_ns()
+        if _exporter:
+            _exporter.export({
+                'traceId': self.trace_id,
+                'spanId': self.span_id,
+                'parentSpanId': self.parent_id,
+                'name': self.name,
+                'startTimeUnixNano': self.start_ns,
+                'endTimeUnixNano': self.end_ns,
+                'durationMs': round((self.end_ns - self.start_ns) / 1e6, 3),
+                'status': self.status,
+                'attributes': self.attributes,
+                'pid': os.getpid()
+            })
+    
+    def __enter__(self) -> 'Span':
+        self._token = _current_span.set(self)
+        return self
+    
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.status = 'error'
+            self.attributes['error'] = str(exc)
+        _current_span.reset(self._token)
+        self.end()
+        return False
+
+
+class NoopSpan:
+    """Stand-in used when tracing is off or no job trace is active"""
+    
+    def set(self, key: str, value: Any):
+        pass
+    
+    def __enter__(self) -> 'NoopSpan':
+        return self
+    
+    def __exit__(self, *exc):
+        return False
+
+
+_NOOP = NoopSpan()
+
+
+def span(name: str, **attributes) -> Any:
+    """Start a child span of the current span"""
+    parent = _current_span.get()
+    if _exporter is None or parent is None:
+        return _NOOP
+    return Span(name, parent.trace_id, parent, attributes)
+
+
+def job_trace(job_data: Dict[str, Any], queue_name: str) -> Any:
+    """Start the root span of a job, recording its queue wait since createdAt"""
+    if _exporter is None:
+        return _NOOP
+    
+    job_id = str(job_data.get('id', ''))
+    trace_id = job_id.replace('-', '') or os.urandom(16).hex()
+    root = Span('job', trace_id, attributes={
+        'jobId': job_id,
+        'converter': job_data.get('converter'),
+        'inputKey': job_data.get('inputKey'),
+        'queue': queue_name,
+        'retryCount': job_data.get('retryCount', 0)
+    })
+    
+    created_at = job_data.get('createdAt')
+    if created_at:
+        try:
+            created_ns = int(datetime.fromisoformat(created_at.replace('Z', '+00:00')).timestamp() * 1e9)
+            if created_ns < root.start_ns:
+                Span('queue.wait', trace_id, root, {'queue': queue_name}, start_ns=created_ns).end(root.start_ns)
+        except ValueError:
+            pass
+    return root
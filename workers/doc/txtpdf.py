@@ -0,0 +1,407 @@
+"""
+Streaming TXT → PDF writer
+Lays out plain text into PDF pages while it reads the input, without a
+LibreOffice round trip. Lines are decoded as UTF-8, wrapped to the page
+width and written out one compressed content stream per page, so memory
+stays flat however long the input is; only object offsets and the set of
+glyphs used grow with it. Text is set in an embedded DejaVu TrueType font
+(CID-keyed, Identity-H) with a ToUnicode map, so accented HU/DE/PL text
+renders everywhere and can be copied back out of the PDF.
+"""
+
+import io
+import os
+import zlib
+import struct
+import logging
+from functools import lru_cache
+from typing import BinaryIO, Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+FONT_DIR = os.getenv('TXT_PDF_FONT_DIR') or '/usr/share/fonts/truetype/dejavu'
+FONTS = {
+    'mono': 'DejaVuSansMono.ttf',
+    'sans': 'DejaVuSans.ttf',
+    'serif': 'DejaVuSerif.ttf'
+}
+
+# Portrait page sizes in points
+PAGE_SIZES = {
+    'a3': (841.89, 1190.55),
+    'a4': (595.28, 841.89),
+    'a5': (419.53, 595.28),
+    'letter': (612.0, 792.0),
+    'legal': (612.0, 1008.0)
+}
+
+TAB_SIZE = 8
+LINE_SPACING = 1.2
+# Bytes read from the input at a time
+READ_CHUNK = 64 * 1024
+
+
+class TextPdfError(Exception):
+    """The native writer can't handle this input or setup (e.g. the font is missing)"""
+
+
+class PageLayout(NamedTuple):
+    width: float
+    height: float
+    margin: float
+    font_size: float
+
+    @property
+    def leading(self) -> float:
+        return self.font_size * LINE_SPACING
+
+    @property
+    def lines_per_page(self) -> int:
+        return max(1, int((self.height - 2 * self.margin - self.font_size) / self.leading) + 1)
+
+
+def page_layout(page_size: str = 'a4', landscape: bool = False, font_size: float = 10,
+                margin: float = 50) -> PageLayout:
+    """Validated layout from user-facing options"""
+    if page_size not in PAGE_SIZES:
+        raise TextPdfError(f"Unknown page size: {page_size}")
+    font_size = float(font_size)
+    margin = float(margin)
+    if not 4 <= font_size <= 72:
+        raise TextPdfError(f"Font size must be between 4 and 72, got {font_size}")
+    width, height = PAGE_SIZES[page_size]
+    if landscape:
+        width, height = height, width
+    if not 0 <= margin < min(width, height) / 2 - font_size:
+        raise TextPdfError(f"Margin {margin} leaves no room for text")
+    return PageLayout(width, height, margin, font_size)
+
+
+class TrueTypeFont:
+    """The tables of a TrueType font a PDF writer needs: character map, advance widths and metrics"""
+
+    def __init__(self, path: str):
+        with open(path, 'rb') as f:
+            self.data = f.read()
+        self.name = os.path.splitext(os.path.basename(path))[0].replace(' ', '')
+        self.tables = self._read_directory()
+
+        head = self._table('head')
+        self.units_per_em = struct.unpack_from('>H', head, 18)[0]
+        self.bbox = struct.unpack_from('>hhhh', head, 36)
+
+        hhea = self._table('hhea')
+        self.ascent, self.descent = struct.unpack_from('>hh', hhea, 4)
+        metric_count = struct.unpack_from('>H', hhea, 34)[0]
+
+        hmtx = self._table('hmtx')
+        self.advances = [struct.unpack_from('>H', hmtx, 4 * i)[0] for i in range(metric_count)]
+
+        os2 = self.tables.get('OS/2')
+        version = struct.unpack_from('>H', self._table('OS/2'), 0)[0] if os2 else 0
+        self.cap_height = struct.unpack_from('>h', self._table('OS/2'), 88)[0] if version >= 2 else self.ascent
+        self.fixed_pitch = struct.unpack_from('>I', self._table('post'), 12)[0] != 0 if 'post' in self.tables else False
+
+        self.cmap = self._read_cmap()
+        # Glyph drawn for characters the font lacks
+        self.missing = self.cmap.get(0xFFFD) or self.cmap.get(ord('?'), 0)
+
+    def _read_directory(self) -> Dict[str, Tuple[int, int]]:
+        if self.data[:4] not in (b'\x00\x01\x00\x00', b'true'):
+            raise TextPdfError(f"{self.name} is not a TrueType font")
+        count = struct.unpack_from('>H', self.data, 4)[0]
+        tables = {}
+        for i in range(count):
+            tag, _, offset, length = struct.unpack_from('>4sIII', self.data, 12 + 16 * i)
+            tables[tag.decode('latin-1')] = (offset, length)
+        return tables
+
+    def _table(self, tag: str) -> memoryview:
+        if tag not in self.tables:
+            raise TextPdfError(f"{self.name} has no {tag} table")
+        offset, length = self.tables[tag]
+        return memoryview(self.data)[offset:offset + length]
+
+    def _read_cmap(self) -> Dict[int, int]:
+        """Code point -> glyph ID from the Windows Unicode subtable (full repertoire if present, else BMP)"""
+        cmap = self._table('cmap')
+        count = struct.unpack_from('>H', cmap, 2)[0]
+        subtables = {}
+        for i in range(count):
+            platform, encoding, offset = struct.unpack_from('>HHI', cmap, 4 + 8 * i)
+            subtables[(platform, encoding)] = offset
+        for key in ((3, 10), (0, 4), (3, 1), (0, 3)):
+            if key in subtables:
+                offset = subtables[key]
+                fmt = struct.unpack_from('>H', cmap, offset)[0]
+                if fmt == 12:
+                    return self._cmap_format12(cmap, offset)
+                if fmt == 4:
+                    return self._cmap_format4(cmap, offset)
+        raise TextPdfError(f"{self.name} has no Unicode character map")
+
+    def _cmap_format4(self, cmap: memoryview, offset: int) -> Dict[int, int]:
+        segments = struct.unpack_from('>H', cmap, offset + 6)[0] // 2
+        ends = struct.unpack_from(f'>{segments}H', cmap, offset + 14)
+        starts = struct.unpack_from(f'>{segments}H', cmap, offset + 16 + 2 * segments)
+        deltas = struct.unpack_from(f'>{segments}h', cmap, offset + 16 + 4 * segments)
+        range_base = offset + 16 + 6 * segments
+        range_offsets = struct.unpack_from(f'>{segments}H', cmap, range_base)
+        mapping = {}
+        for i in range(segments):
+            for code in range(starts[i], ends[i] + 1):
+                if code == 0xFFFF:
+                    continue
+                if range_offsets[i] == 0:
+                    glyph = (code + deltas[i]) & 0xFFFF
+                else:
+                    position = range_base + 2 * i + range_offsets[i] + 2 * (code - starts[i])
+                    glyph = struct.unpack_from('>H', cmap, position)[0]
+                    if glyph:
+                        glyph = (glyph + deltas[i]) & 0xFFFF
+                if glyph:
+                    mapping[code] = glyph
+        return mapping
+
+    def _cmap_format12(self, cmap: memoryview, offset: int) -> Dict[int, int]:
+        groups = struct.unpack_from('>I', cmap, offset + 12)[0]
+        mapping = {}
+        for i in range(groups):
+            start, end, glyph = struct.unpack_from('>III', cmap, offset + 16 + 12 * i)
+            for code in range(start, end + 1):
+                mapping[code] = glyph + code - start
+        return mapping
+
+    def advance(self, glyph: int) -> int:
+        """Advance width of a glyph in font units"""
+        return self.advances[glyph] if glyph < len(self.advances) else self.advances[-1]
+
+
+@lru_cache(maxsize=None)
+def load_font(name: str) -> Tuple[TrueTypeFont, bytes]:
+    """Parsed font and its compressed file for embedding, once per process"""
+    if name not in FONTS:
+        raise TextPdfError(f"Unknown font: {name}")
+    path = os.path.join(FONT_DIR, FONTS[name])
+    if not os.path.exists(path):
+        raise TextPdfError(f"Font file not found: {path}")
+    font = TrueTypeFont(path)
+    return font, zlib.compress(font.data, 6)
+
+
+def read_lines(stream: BinaryIO) -> Iterator[str]:
+    """Lines of a UTF-8 text stream (a BOM is skipped, invalid bytes replaced); form feeds become their own line"""
+    text = io.TextIOWrapper(stream, encoding='utf-8-sig', errors='replace', newline=None)
+    for line in text:
+        line = line.rstrip('\n')
+        while '\f' in line:
+            head, _, line = line.partition('\f')
+            if head:
+                yield head
+            yield '\f'
+        yield line
+
+
+class TextPdfWriter:
+    """
+    Writes a PDF to a binary stream one page at a time. Object numbers 1-3
+    (catalog, page tree, font) are fixed up front so pages can point at
+    them before they are written at the end.
+    """
+
+    CATALOG, PAGES, FONT = 1, 2, 3
+
+    def __init__(self, out: BinaryIO, layout: PageLayout, font: TrueTypeFont, font_file: bytes):
+        self.out = out
+        self.layout = layout
+        self.font = font
+        self.font_file = font_file
+        self.position = 0
+        self.offsets: Dict[int, int] = {}
+        self.next_object = 4
+        self.page_objects: List[int] = []
+        # Glyph ID -> code point of every glyph drawn, for widths and ToUnicode
+        self.used: Dict[int, int] = {}
+        # Characters resolved so far, and their str.translate table (code point -> glyph character or None)
+        self.known = set()
+        self.table: Dict[int, Optional[str]] = {}
+        self.widest = 0
+        self.spaces = {chr(glyph) for glyph in (font.cmap.get(32), font.cmap.get(0x3000)) if glyph}
+        self.scale = layout.font_size / font.units_per_em
+        self.max_width = layout.width - 2 * layout.margin
+        self._write(b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n')
+
+    def _write(self, data: bytes):
+        self.out.write(data)
+        self.position += len(data)
+
+    def _allocate(self) -> int:
+        number = self.next_object
+        self.next_object += 1
+        return number
+
+    def _object(self, number: int, body: bytes):
+        self.offsets[number] = self.position
+        self._write(b'%d 0 obj\n' % number + body + b'\nendobj\n')
+
+    def _stream(self, number: int, data: bytes, extra: bytes = b''):
+        compressed = zlib.compress(data, 6)
+        self._object(number, b'<< /Length %d /Filter /FlateDecode%s >>\nstream\n' % (len(compressed), extra)
+                     + compressed + b'\nendstream')
+
+    def glyphs(self, line: str) -> str:
+        """
+        A line as a string of glyph IDs (one character per glyph). Each
+        character is resolved through the font once and then handled by
+        str.translate; control characters are dropped.
+        """
+        for char in set(line).difference(self.known):
+            self.known.add(char)
+            code = ord(char)
+            glyph = self.font.cmap.get(code)
+            if glyph is None:
+                if code < 32 or 0x7F <= code < 0xA0:
+                    self.table[code] = None
+                    continue
+                glyph, code = self.font.missing, 0xFFFD
+            self.used.setdefault(glyph, code)
+            self.table[ord(char)] = chr(glyph)
+            self.widest = max(self.widest, self.font.advance(glyph))
+        return line.translate(self.table)
+
+    def wrap(self, glyphs: str) -> Iterator[str]:
+        """Split a line's glyphs to the text width, at the last space where there is one"""
+        limit = self.max_width / self.scale
+        while glyphs:
+            # Most lines fit even if every glyph were the widest one seen
+            if len(glyphs) * self.widest <= limit:
+                yield glyphs
+                return
+            width, cut, last_space = 0, len(glyphs), None
+            for i, glyph in enumerate(glyphs):
+                width += self.font.advance(ord(glyph))
+                if width > limit and i > 0:
+                    cut = last_space + 1 if last_space is not None else i
+                    break
+                if glyph in self.spaces:
+                    last_space = i
+            yield glyphs[:cut]
+            glyphs = glyphs[cut:]
+
+    def write_page(self, lines: List[str]):
+        layout = self.layout
+        content = [b'BT /F1 %.2f Tf %.2f TL %.2f %.2f Td' % (
+            layout.font_size, layout.leading, layout.margin, layout.height - layout.margin - layout.font_size)]
+        for glyphs in lines:
+            # Two big-endian bytes per glyph ID (Identity-H); surrogatepass keeps IDs in D800-DFFF intact
+            content.append(b'<%s> Tj T*' % glyphs.encode('utf-16-be', 'surrogatepass').hex().encode())
+        content.append(b'ET')
+        contents = self._allocate()
+        self._stream(contents, b'\n'.join(content))
+        page = self._allocate()
+        self._object(page, b'<< /Type /Page /Parent %d 0 R /Contents %d 0 R >>' % (self.PAGES, contents))
+        self.page_objects.append(page)
+
+    def write_text(self, lines: Iterator[str]):
+        """Lay out lines into pages, writing each page as soon as it is full"""
+        per_page = self.layout.lines_per_page
+        page: List[str] = []
+        for line in lines:
+            if line == '\f':
+                self.write_page(page)
+                page = []
+                continue
+            for row in (self.wrap(self.glyphs(line.expandtabs(TAB_SIZE))) if line else ['']):
+                if len(page) == per_page:
+                    self.write_page(page)
+                    page = []
+                page.append(row)
+        if page or not self.page_objects:
+            self.write_page(page)
+
+    def _widths(self) -> bytes:
+        """W array of the glyphs used, in runs of consecutive IDs"""
+        entries, run_start, run = [], None, []
+        for glyph in sorted(self.used):
+            width = b'%d' % round(self.font.advance(glyph) * 1000 / self.font.units_per_em)
+            if run and glyph == run_start + len(run):
+                run.append(width)
+                continue
+            if run:
+                entries.append(b'%d [%s]' % (run_start, b' '.join(run)))
+            run_start, run = glyph, [width]
+        if run:
+            entries.append(b'%d [%s]' % (run_start, b' '.join(run)))
+        return b'[' + b' '.join(entries) + b']'
+
+    def _to_unicode(self) -> bytes:
+        mappings = sorted(self.used.items())
+        lines = [b'/CIDInit /ProcSet findresource begin 12 dict begin begincmap',
+                 b'/CIDSystemInfo << /Registry (Adobe) /Ordering (UCS) /Supplement 0 >> def',
+                 b'/CMapName /Adobe-Identity-UCS def /CMapType 2 def',
+                 b'1 begincodespacerange <0000> <FFFF> endcodespacerange']
+        for i in range(0, len(mappings), 100):
+            chunk = mappings[i:i + 100]
+            lines.append(b'%d beginbfchar' % len(chunk))
+            for glyph, code in chunk:
+                lines.append(b'<%04x> <%s>' % (glyph, chr(code).encode('utf-16-be').hex().encode()))
+            lines.append(b'endbfchar')
+        lines.append(b'endcmap CMapName currentdict /CMap defineresource pop end end')
+        return b'\n'.join(lines)
+
+    def finish(self):
+        """Write the font, page tree, catalog, cross-reference table and trailer"""
+        font = self.font
+        em = 1000 / font.units_per_em
+        name = font.name.encode('ascii', 'replace')
+
+        font_file, descriptor, cid_font, to_unicode = (self._allocate() for _ in range(4))
+        # The font was compressed once per process by load_font
+        self._object(font_file, b'<< /Length %d /Length1 %d /Filter /FlateDecode >>\nstream\n' % (
+            len(self.font_file), len(font.data)) + self.font_file + b'\nendstream')
+        flags = 32 | (1 if font.fixed_pitch else 0)
+        self._object(descriptor, (
+            b'<< /Type /FontDescriptor /FontName /%s /Flags %d /FontBBox [%d %d %d %d] /ItalicAngle 0 '
+            b'/Ascent %d /Descent %d /CapHeight %d /StemV 80 /FontFile2 %d 0 R >>' % (
+                name, flags, *(round(v * em) for v in font.bbox),
+                round(font.ascent * em), round(font.descent * em), round(font.cap_height * em), font_file)))
+        self._object(cid_font, (
+            b'<< /Type /Font /Subtype /CIDFontType2 /BaseFont /%s '
+            b'/CIDSystemInfo << /Registry (Adobe) /Ordering (Identity) /Supplement 0 >> '
+            b'/FontDescriptor %d 0 R /DW %d /W %s /CIDToGIDMap /Identity >>' % (
+                name, descriptor, round(font.advance(0) * em), self._widths())))
+        self._stream(to_unicode, self._to_unicode())
+        self._object(self.FONT, (
+            b'<< /Type /Font /Subtype /Type0 /BaseFont /%s /Encoding /Identity-H '
+            b'/DescendantFonts [%d 0 R] /ToUnicode %d 0 R >>' % (name, cid_font, to_unicode)))
+
+        kids = b' '.join(b'%d 0 R' % page for page in self.page_objects)
+        self._object(self.PAGES, (
+            b'<< /Type /Pages /Kids [%s] /Count %d /MediaBox [0 0 %.2f %.2f] '
+            b'/Resources << /Font << /F1 %d 0 R >> >> >>' % (
+                kids, len(self.page_objects), self.layout.width, self.layout.height, self.FONT)))
+        self._object(self.CATALOG, b'<< /Type /Catalog /Pages %d 0 R >>' % self.PAGES)
+
+        xref = self.position
+        count = self.next_object
+        self._write(b'xref\n0 %d\n0000000000 65535 f \n' % count)
+        for number in range(1, count):
+            self._write(b'%010d 00000 n \n' % self.offsets[number])
+        self._write(b'trailer\n<< /Size %d /Root %d 0 R >>\nstartxref\n%d\n%%%%EOF\n' % (count, self.CATALOG, xref))
+
+
+def write_text_pdf(source: BinaryIO, out: BinaryIO, font: str = 'mono', page_size: str = 'a4',
+                   landscape: bool = False, font_size: float = 10, margin: float = 50) -> int:
+    """Render a UTF-8 text stream as a PDF into out; returns the page count"""
+    layout = page_layout(page_size, landscape, font_size, margin)
+    parsed, font_file = load_font(font)
+    writer = TextPdfWriter(out, layout, parsed, font_file)
+    writer.write_text(read_lines(source))
+    writer.finish()
+    return len(writer.page_objects)
+
+
+def text_file_to_pdf(input_path: str, output_path: str, **options) -> int:
+    """write_text_pdf between two files"""
+    with open(input_path, 'rb', buffering=READ_CHUNK) as source, open(output_path, 'wb', buffering=READ_CHUNK) as out:
+        return write_text_pdf(source, out, **options)
@@ -2,24 +2,37 @@
 """
 Document conversion worker using LibreOffice and Ghostscript
 Handles: PDF ↔ DOCX, PDF ↔ TXT, PPTX → PDF, TXT → PDF
-Enhanced with progress tracking, timeout, and retry policy
+TXT → PDF is rendered in-process (doc.txtpdf), with LibreOffice as fallback
+Enhanced with progress tracking, timeout, and delayed retry policy
 """
 
 import os
 import sys
 import json
 import redis
-import boto3
 import subprocess
 import tempfile
+import re
+import shutil
 import logging
 import time
-import signal
-import threading
+import zipfile
 from pathlib import Path
 from typing import Dict, Any, Optional
 from datetime import datetime
 
+from common.aio import AsyncWorkerCore, run_command
+from common.durations import DurationModel
+from common.inmemory import InMemoryPipeline
+from common.prefork import serve
+from common.progress import write_job_status
+from common.registry import UnknownConverterError, converter, dispatch
+from common.retry import PermanentJobError, RetryQueue
+from common.sniff import probed_units
+from common.storage import open_storage
+from common.tracing import span
+from doc.txtpdf import TextPdfError, text_file_to_pdf
+
 # Configure JSON logging
 class JSONFormatter(logging.Formatter):
     def format(self, record):
@@ -33,31 +46,25 @@ class JSONFormatter(logging.Formatter):
             'inputKey': getattr(record, 'inputKey', None),
             'duration': getattr(record, 'duration', None),
             'size': getattr(record, 'size', None),
-            'exitCode': getattr(record, 'exitCode', None)
+            'exitCode': getattr(record, 'exitCode', None),
+            'usage': getattr(record, 'usage', None)
         }
         return json.dumps(log_entry)
 
-# Configure logging
-logger = logging.getLogger(__name__)
+# Configure logging (on the root logger so the shared runtime logs as JSON too)
 handler = logging.StreamHandler()
 handler.setFormatter(JSONFormatter())
-logger.addHandler(handler)
-logger.setLevel(logging.INFO)
+logging.basicConfig(level=logging.INFO, handlers=[handler])
+logger = logging.getLogger(__name__)
 
 class DocumentWorker:
     def __init__(self):
         self.redis_client = redis.Redis.from_url(os.getenv('REDIS_URL', 'redis://localhost:6379'))
-        self.s3_client = boto3.client(
-            's3',
-            endpoint_url=os.getenv('R2_PUBLIC_URL', '').replace('https://', 'https://'),
-            aws_access_key_id=os.getenv('R2_ACCESS_KEY_ID'),
-            aws_secret_access_key=os.getenv('R2_SECRET_ACCESS_KEY'),
-            region_name='auto'
-        )
-        self.bucket_name = os.getenv('R2_BUCKET_NAME', 'aic-files')
+        self.storage = open_storage()
         
         # Configuration
         self.max_retries = 2
+        # Fallback timeouts until the duration model has enough samples
         self.timeouts = {
             'pdf-to-docx': 300,  # 5 minutes
             'docx-to-pdf': 300,  # 5 minutes
@@ -66,6 +73,11 @@ class DocumentWorker:
             'pptx-to-pdf': 300,  # 5 minutes
             'default': 120       # 2 minutes
         }
+        self.durations = DurationModel(self.redis_client)
+        self.retry_queue = RetryQueue(self.redis_client, 'doc_queue', self.max_retries)
+        
+        # Small inputs of these converters never touch the filesystem
+        self.in_memory = InMemoryPipeline(self, {'pdf-to-txt'})
         
     def log_with_context(self, level: str, message: str, job_id: str = None, tool: str = None, 
                         input_key: str = None, duration: float = None, size: int = None, exit_code: int = None):
@@ -78,7 +90,7 @@ class DocumentWorker:
             'size': size,
             'exitCode': exit_code
         }
-        getattr(logger, level)(message, extra=extra)
+        getattr(logger, level.lower())(message, extra=extra)
     
     def get_file_size(self, file_path: str) -> int:
         """Get file size in bytes"""
@@ -88,60 +100,26 @@ class DocumentWorker:
             return 0
     
     def run_with_timeout(self, cmd: list, timeout: int, job_id: str, tool: str) -> tuple:
-        """Run command with timeout and progress tracking"""
+        """Run command with timeout and structured logging"""
         start_time = time.time()
         
-        def timeout_handler(signum, frame):
-            raise TimeoutError(f"Command timed out after {timeout} seconds")
-        
         try:
-            # Set up timeout signal
-            old_handler = signal.signal(signal.SIGALRM, timeout_handler)
-            signal.alarm(timeout)
-            
-            # Start process
-            process = subprocess.Popen(
-                cmd,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                text=True,
-                preexec_fn=os.setsid
-            )
-            
-            # Monitor progress
-            progress = 0
-            while process.poll() is None:
-                elapsed = time.time() - start_time
-                progress = min(90, int((elapsed / timeout) * 100))
-                self.update_job_status(job_id, 'processing', progress)
-                time.sleep(1)
-            
-            # Get result
-            stdout, stderr = process.communicate()
+            result = run_command(cmd, timeout=timeout, text=True)
             duration = time.time() - start_time
             
-            # Reset signal
-            signal.alarm(0)
-            signal.signal(signal.SIGALRM, old_handler)
-            
             self.log_with_context(
                 'INFO', 
                 f"Command completed: {tool}",
                 job_id=job_id,
                 tool=tool,
                 duration=duration,
-                exit_code=process.returncode
+                exit_code=result.returncode
             )
             
-            return process.returncode, stdout, stderr, duration
-            
-        except TimeoutError:
-            # Kill process group
-            try:
-                os.killpg(os.getpgid(process.pid), signal.SIGKILL)
-            except:
-                pass
+            return result.returncode, result.stdout, result.stderr, duration
             
+        except subprocess.TimeoutExpired:
+            # The process group has already been killed
             duration = time.time() - start_time
             self.log_with_context(
                 'ERROR',
@@ -152,10 +130,6 @@ class DocumentWorker:
                 exit_code=-1
             )
             
-            # Reset signal
-            signal.alarm(0)
-            signal.signal(signal.SIGALRM, old_handler)
-            
             return -1, "", f"Command timed out after {timeout} seconds", duration
             
         except Exception as e:
@@ -169,14 +143,14 @@ class DocumentWorker:
                 exit_code=-1
             )
             
-            # Reset signal
-            signal.alarm(0)
-            signal.signal(signal.SIGALRM, old_handler)
-            
             return -1, "", str(e), duration
-        """Download file from R2 storage"""
+    
+    def download_file(self, key: str, local_path: str) -> bool:
+        """Download file from storage"""
         try:
-            self.s3_client.download_file(self.bucket_name, key, local_path)
+            with span('download', key=key) as download_span:
+                self.storage.download_file(key, local_path)
+                download_span.set('size', os.path.getsize(local_path))
             logger.info(f"Downloaded {key} to {local_path}")
             return True
         except Exception as e:
@@ -184,29 +158,61 @@ class DocumentWorker:
             return False
     
     def upload_file(self, local_path: str, key: str) -> bool:
-        """Upload file to R2 storage"""
+        """Upload file to storage"""
         try:
-            self.s3_client.upload_file(local_path, self.bucket_name, key)
+            with span('upload', key=key, size=os.path.getsize(local_path)):
+                self.storage.upload_file(local_path, key)
             logger.info(f"Uploaded {local_path} to {key}")
             return True
         except Exception as e:
             logger.error(f"Failed to upload {local_path}: {e}")
             return False
     
-    def update_job_status(self, job_id: str, status: str, progress: int = 0, error: str = None):
-        """Update job status in Redis"""
+    def update_job_status(self, job_id: str, status: str, progress: int = 0, error: str = None,
+                          eta: float = None):
+        """Update job status in Redis and publish it as a progress event"""
         job_data = {
             'status': status,
             'progress': progress,
-            'error': error
+            'error': error or ''
         }
-        self.redis_client.hset(f"job:{job_id}", mapping=job_data)
+        if eta is not None:
+            job_data['estimatedTimeRemaining'] = int(round(eta))
+        with span('status.write', status=status, progress=progress):
+            write_job_status(self.redis_client, job_id, job_data)
         logger.info(f"Updated job {job_id}: {status} ({progress}%)")
     
-    def pdf_to_docx(self, input_path: str, output_path: str, job_id: str) -> bool:
-        """Convert PDF to DOCX using LibreOffice with timeout and progress tracking"""
+    def count_pdf_pages(self, input_path: str) -> Optional[float]:
+        """Count page objects by scanning the file in chunks"""
+        pattern = re.compile(rb'/Type\s*/Page(?![a-zA-Z])')
+        pages = 0
+        tail = b''
+        with open(input_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                data = tail + chunk
+                # Matches lying entirely in the carried-over tail were counted already
+                pages += sum(1 for match in pattern.finditer(data) if match.end() > len(tail))
+                tail = data[-32:]
+        return float(pages) if pages else None
+    
+    def measure_input(self, converter_type: str, input_path: str) -> Optional[float]:
+        """Page or slide count for the duration model, None if unknown"""
+        try:
+            if converter_type.startswith('pdf-'):
+                return self.count_pdf_pages(input_path)
+            if converter_type in ('docx-to-pdf', 'pptx-to-pdf'):
+                with zipfile.ZipFile(input_path) as archive:
+                    app_xml = archive.read('docProps/app.xml').decode('utf-8', errors='ignore')
+                match = re.search(r'<(Pages|Slides)>(\d+)</', app_xml)
+                return float(match.group(2)) if match else None
+        except Exception:
+            pass
+        return None
+    
+    @converter('pdf-to-docx')
+    def pdf_to_docx(self, input_path: str, output_path: str, job_id: str, timeout: int = 300) -> bool:
+        """Convert PDF to DOCX using LibreOffice with timeout and structured logging"""
         tool = "libreoffice-pdf-to-docx"
-        timeout = self.timeouts.get('pdf-to-docx', self.timeouts['default'])
         
         try:
             cmd = [
@@ -257,7 +263,8 @@ class DocumentWorker:
             )
             return False
     
-    def docx_to_pdf(self, input_path: str, output_path: str) -> bool:
+    @converter('docx-to-pdf')
+    def docx_to_pdf(self, input_path: str, output_path: str, timeout: int = 300) -> bool:
         """Convert DOCX to PDF using LibreOffice"""
         try:
             cmd = [
@@ -267,7 +274,7 @@ class DocumentWorker:
                 '--outdir', os.path.dirname(output_path),
                 input_path
             ]
-            result = subprocess.run(cmd, capture_output=True, text=True, timeout=120)
+            result = run_command(cmd, timeout=timeout, text=True)
             if result.returncode == 0:
                 # LibreOffice creates file with same name but .pdf extension
                 base_name = Path(input_path).stem
@@ -281,7 +288,8 @@ class DocumentWorker:
             logger.error(f"DOCX to PDF conversion error: {e}")
             return False
     
-    def pdf_to_txt(self, input_path: str, output_path: str) -> bool:
+    @converter('pdf-to-txt')
+    def pdf_to_txt(self, input_path: str, output_path: str, timeout: int = 180) -> bool:
         """Extract text from PDF using Ghostscript and OCR"""
         try:
             # First try to extract text directly
@@ -293,7 +301,8 @@ class DocumentWorker:
                 f'-sOutputFile={output_path}',
                 input_path
             ]
-            result = subprocess.run(cmd, capture_output=True, text=True, timeout=60)
+            started = time.time()
+            result = run_command(cmd, timeout=timeout, text=True)
             
             if result.returncode == 0 and os.path.getsize(output_path) > 0:
                 return True
@@ -306,14 +315,38 @@ class DocumentWorker:
                 output_path.replace('.txt', ''),
                 '-l', 'eng+hun+deu+fra+spa+ita+pol+ces+slk+ron'
             ]
-            result = subprocess.run(cmd, capture_output=True, text=True, timeout=120)
+            remaining = max(timeout - (time.time() - started), 1)
+            result = run_command(cmd, timeout=remaining, text=True)
             return result.returncode == 0
             
         except Exception as e:
             logger.error(f"PDF to TXT conversion error: {e}")
             return False
     
-    def txt_to_pdf(self, input_path: str, output_path: str) -> bool:
+    @converter('txt-to-pdf', engine='native', font='mono', paper='a4', orientation='portrait', points=10, margin=50)
+    def txt_to_pdf(self, input_path: str, output_path: str, engine: str = 'native', font: str = 'mono',
+                   paper: str = 'a4', orientation: str = 'portrait', points: float = 10, margin: float = 50,
+                   timeout: int = 120) -> bool:
+        """
+        Convert TXT to PDF with the native writer (doc.txtpdf). LibreOffice
+        is used when asked for (engine='libreoffice') or when the native
+        writer can't run, e.g. without its fonts.
+        """
+        if engine == 'native':
+            try:
+                start_time = time.time()
+                pages = text_file_to_pdf(input_path, output_path, font=font, page_size=paper,
+                                         landscape=orientation == 'landscape', font_size=points, margin=margin)
+                logger.info(f"Rendered {pages} pages natively in {time.time() - start_time:.3f}s")
+                return True
+            except (TextPdfError, ValueError) as e:
+                if not shutil.which('libreoffice'):
+                    logger.error(f"TXT to PDF conversion failed: {e}")
+                    return False
+                logger.warning(f"Native TXT to PDF failed, using LibreOffice: {e}")
+        return self.txt_to_pdf_libreoffice(input_path, output_path, timeout)
+    
+    def txt_to_pdf_libreoffice(self, input_path: str, output_path: str, timeout: int = 120) -> bool:
         """Convert TXT to PDF using LibreOffice"""
         try:
             cmd = [
@@ -323,7 +356,7 @@ class DocumentWorker:
                 '--outdir', os.path.dirname(output_path),
                 input_path
             ]
-            result = subprocess.run(cmd, capture_output=True, text=True, timeout=60)
+            result = run_command(cmd, timeout=timeout, text=True)
             if result.returncode == 0:
                 base_name = Path(input_path).stem
                 pdf_path = os.path.join(os.path.dirname(output_path), f"{base_name}.pdf")
@@ -336,7 +369,8 @@ class DocumentWorker:
             logger.error(f"TXT to PDF conversion error: {e}")
             return False
     
-    def pptx_to_pdf(self, input_path: str, output_path: str) -> bool:
+    @converter('pptx-to-pdf')
+    def pptx_to_pdf(self, input_path: str, output_path: str, timeout: int = 300) -> bool:
         """Convert PPTX to PDF using LibreOffice"""
         try:
             cmd = [
@@ -346,7 +380,7 @@ class DocumentWorker:
                 '--outdir', os.path.dirname(output_path),
                 input_path
             ]
-            result = subprocess.run(cmd, capture_output=True, text=True, timeout=120)
+            result = run_command(cmd, timeout=timeout, text=True)
             if result.returncode == 0:
                 base_name = Path(input_path).stem
                 pdf_path = os.path.join(os.path.dirname(output_path), f"{base_name}.pdf")
@@ -359,6 +393,46 @@ class DocumentWorker:
             logger.error(f"PPTX to PDF conversion error: {e}")
             return False
     
+    def convert_in_memory(self, converter_type: str, data: bytes, job_id: str, timeout: int = 60) -> Optional[bytes]:
+        """Convert a small document through stdin/stdout pipes"""
+        tool = f"{converter_type}-memory"
+        start_time = time.time()
+        try:
+            if converter_type == 'pdf-to-txt':
+                cmd = [
+                    'gs',
+                    '-q',
+                    '-dNOPAUSE',
+                    '-dBATCH',
+                    '-sDEVICE=txtwrite',
+                    '-sOutputFile=-',
+                    '-'
+                ]
+                result = run_command(cmd, timeout=timeout, input=data)
+                self.log_with_context(
+                    'INFO',
+                    f"Command completed: {tool}",
+                    job_id=job_id,
+                    tool=tool,
+                    duration=time.time() - start_time,
+                    size=len(result.stdout),
+                    exit_code=result.returncode
+                )
+                # Empty output means a scanned PDF; the disk pipeline handles OCR
+                if result.returncode == 0 and result.stdout.strip():
+                    return result.stdout
+            return None
+        except Exception as e:
+            self.log_with_context(
+                'ERROR',
+                f"In-memory conversion error: {str(e)}",
+                job_id=job_id,
+                tool=tool,
+                duration=time.time() - start_time,
+                exit_code=-1
+            )
+            return None
+    
     def process_job(self, job_data: Dict[str, Any]):
         """Process a conversion job with retry policy"""
         job_id = job_data['id']
@@ -378,6 +452,29 @@ class DocumentWorker:
             input_key=input_key
         )
         
+        if self.in_memory.qualifies(job_data):
+            def convert(data: bytes, timeout: int) -> Optional[bytes]:
+                return self.convert_in_memory(converter_type, data, job_id, timeout)
+            
+            if self.in_memory.run(job_data, convert):
+                self.log_with_context(
+                    'INFO',
+                    f"Job completed successfully in memory",
+                    job_id=job_id,
+                    tool=converter_type,
+                    input_key=input_key,
+                    duration=time.time() - start_time,
+                    exit_code=0
+                )
+                return
+            self.log_with_context(
+                'INFO',
+                f"In-memory pipeline failed, falling back to disk",
+                job_id=job_id,
+                tool=converter_type,
+                input_key=input_key
+            )
+        
         # Create temporary files
         with tempfile.NamedTemporaryFile(delete=False) as input_file:
             input_path = input_file.name
@@ -392,57 +489,40 @@ class DocumentWorker:
                 raise Exception("Failed to download input file")
             
             input_size = self.get_file_size(input_path)
+            # The core's header probe spares a second look at the file
+            units = probed_units(job_data)
+            if units is None:
+                units = self.measure_input(converter_type, input_path)
+            timeout = self.durations.timeout_for(
+                converter_type, input_size, units, self.timeouts.get(converter_type, self.timeouts['default'])
+            )
+            expected = self.durations.estimate(converter_type, input_size, units)
             
-            # Process conversion with retry
+            # Process conversion
             self.update_job_status(job_id, 'processing', 30)
+            self.log_with_context(
+                'INFO',
+                f"Conversion budget: timeout {timeout}s, expected {expected:.1f}s" if expected is not None
+                else f"Conversion budget: timeout {timeout}s (no duration model yet)",
+                job_id=job_id,
+                tool=converter_type,
+                size=input_size
+            )
             
-            success = False
-            last_error = None
+            def report_progress(progress: int, eta: Optional[float]):
+                self.update_job_status(job_id, 'processing', progress, eta=eta)
             
-            for attempt in range(self.max_retries + 1):
-                try:
-                    if attempt > 0:
-                        self.log_with_context(
-                            'INFO',
-                            f"Retry attempt {attempt} for job {job_id}",
-                            job_id=job_id,
-                            tool=converter_type
-                        )
-                        self.update_job_status(job_id, 'processing', 30 + (attempt * 10))
-                    
-                    if converter_type == 'pdf-to-docx':
-                        success = self.pdf_to_docx(input_path, output_path, job_id)
-                    elif converter_type == 'docx-to-pdf':
-                        success = self.docx_to_pdf(input_path, output_path, job_id)
-                    elif converter_type == 'pdf-to-txt':
-                        success = self.pdf_to_txt(input_path, output_path, job_id)
-                    elif converter_type == 'txt-to-pdf':
-                        success = self.txt_to_pdf(input_path, output_path, job_id)
-                    elif converter_type == 'pptx-to-pdf':
-                        success = self.pptx_to_pdf(input_path, output_path, job_id)
-                    else:
-                        raise Exception(f"Unknown converter type: {converter_type}")
-                    
-                    if success:
-                        break
-                    else:
-                        last_error = f"Conversion failed on attempt {attempt + 1}"
-                        
-                except Exception as e:
-                    last_error = str(e)
-                    if attempt < self.max_retries:
-                        self.log_with_context(
-                            'WARNING',
-                            f"Conversion attempt {attempt + 1} failed, retrying: {last_error}",
-                            job_id=job_id,
-                            tool=converter_type
-                        )
-                        time.sleep(2 ** attempt)  # Exponential backoff
-                    else:
-                        raise e
+            # One attempt per pickup; failures go through the delayed retry queue
+            convert_start = time.time()
+            with span('convert', tool=converter_type, attempt=retry_count + 1, size=input_size, units=units,
+                      timeout=timeout), \
+                    self.durations.track(expected, timeout, report_progress):
+                success = dispatch(self, converter_type, input_path, output_path,
+                                   job_data.get('options', {}), timeout=timeout, job_id=job_id)
             
             if not success:
-                raise Exception(last_error or "Conversion failed after all retries")
+                raise Exception(f"Conversion failed on attempt {retry_count + 1}")
+            self.durations.record(converter_type, input_size, units, time.time() - convert_start)
             
             # Upload output file
             self.update_job_status(job_id, 'uploading', 80)
@@ -470,22 +550,20 @@ class DocumentWorker:
             duration = time.time() - start_time
             error_msg = str(e)
             
-            # Check if we should retry the entire job
-            if retry_count < self.max_retries and "timeout" in error_msg.lower():
+            # Schedule a delayed retry unless the failure is permanent or retries are exhausted
+            delay = None
+            if not isinstance(e, (PermanentJobError, UnknownConverterError)):
+                delay = self.retry_queue.schedule(job_data, error_msg)
+            
+            if delay is not None:
                 self.log_with_context(
                     'WARNING',
-                    f"Job failed with timeout, scheduling retry {retry_count + 1}",
+                    f"Job failed, retry {retry_count + 1} scheduled in {delay:.0f}s: {error_msg}",
                     job_id=job_id,
                     tool=converter_type,
                     duration=duration,
                     exit_code=-1
                 )
-                
-                # Schedule retry
-                retry_job = job_data.copy()
-                retry_job['retryCount'] = retry_count + 1
-                self.redis_client.lpush('doc_queue', json.dumps(retry_job))
-                
                 self.update_job_status(job_id, 'retrying', 0, f"Retrying job (attempt {retry_count + 1})")
             else:
                 self.log_with_context(
@@ -513,25 +591,7 @@ class DocumentWorker:
     def run(self):
         """Main worker loop"""
         logger.info("Document worker started")
-        
-        while True:
-            try:
-                # Get job from queue
-                job_data = self.redis_client.blpop('doc_queue', timeout=10)
-                if job_data:
-                    job_json = job_data[1].decode('utf-8')
-                    job_data = json.loads(job_json)
-                    self.process_job(job_data)
-                else:
-                    logger.debug("No jobs in queue, waiting...")
-                    
-            except KeyboardInterrupt:
-                logger.info("Worker shutting down...")
-                break
-            except Exception as e:
-                logger.error(f"Worker error: {e}")
-                continue
+        AsyncWorkerCore(self, 'doc_queue').run()
 
 if __name__ == "__main__":
-    worker = DocumentWorker()
-    worker.run()
+    serve(DocumentWorker, 'doc_queue')
@@ -0,0 +1,178 @@
+"""
+In-process SVG rasterizer
+Renders SVG with CairoSVG (optional; the worker falls back to ImageMagick
+without it). The output size is worked out from the root element's
+width, height and viewBox before the document is parsed or drawn, and
+renders past SVG_MAX_MEGAPIXELS are refused (on the ImageMagick path as
+well), so a huge viewBox can't exhaust memory.
+Parsed documents are kept in a small LRU keyed by a hash of the SVG
+source, so the same icon rendered at several resolutions is parsed once.
+"""
+
+import io
+import os
+import re
+import math
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+from xml.etree import ElementTree
+
+logger = logging.getLogger(__name__)
+
+# Largest output a render may produce, in millions of pixels
+MAX_MEGAPIXELS = float(os.getenv('SVG_MAX_MEGAPIXELS') or 64)
+# Parsed documents kept per process
+CACHE_ENTRIES = int(os.getenv('SVG_CACHE_ENTRIES') or 128)
+
+# SVG user units are CSS pixels, 96 per inch
+CSS_DPI = 96.0
+UNITS = {
+    '': 1.0, 'px': 1.0, 'pt': 96 / 72, 'pc': 16.0, 'in': 96.0,
+    'cm': 96 / 2.54, 'mm': 96 / 25.4, 'em': 16.0, 'ex': 8.0
+}
+# Size browsers give an SVG that declares neither size nor viewBox
+DEFAULT_SIZE = (300.0, 150.0)
+LENGTH = re.compile(r'^\s*([+-]?(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?)\s*([a-z%]*)\s*$')
+
+
+# CairoSVG rewrites these while drawing, so documents using them are parsed per render
+MUTATED_TAGS = {'mask', 'pattern', 'image'}
+MUTATED_ATTRIBUTES = {'rotate'}
+
+
+class SvgBudgetError(Exception):
+    """The requested render is larger than the pixel budget"""
+
+
+def available() -> bool:
+    """Whether CairoSVG (and the cairo library under it) can be loaded"""
+    try:
+        import cairosvg  # noqa: F401
+    except (ImportError, OSError):
+        return False
+    return True
+
+
+def root_attributes(data: bytes) -> Dict[str, str]:
+    """Attributes of an SVG's root element, read without parsing the rest of the document"""
+    try:
+        for _, element in ElementTree.iterparse(io.BytesIO(data), events=('start',)):
+            return dict(element.attrib)
+    except ElementTree.ParseError:
+        pass
+    return {}
+
+
+def _length(value: Optional[str], reference: Optional[float]) -> Optional[float]:
+    """A width or height attribute in CSS pixels; percentages are of the reference (the viewBox)"""
+    match = LENGTH.match(value or '')
+    if not match:
+        return None
+    number, unit = float(match.group(1)), match.group(2)
+    if unit == '%':
+        return number / 100 * reference if reference else None
+    return number * UNITS[unit] if unit in UNITS else None
+
+
+def intrinsic_size(root: Dict[str, str]) -> Tuple[float, float]:
+    """Width and height of a document in CSS pixels from its root element's attributes"""
+    view_box = None
+    try:
+        values = [float(v) for v in re.split(r'[\s,]+', (root.get('viewBox') or '').strip()) if v]
+        if len(values) == 4 and values[2] > 0 and values[3] > 0:
+            view_box = (values[2], values[3])
+    except ValueError:
+        pass
+    width = _length(root.get('width'), view_box[0] if view_box else None)
+    height = _length(root.get('height'), view_box[1] if view_box else None)
+    if width and height:
+        return width, height
+    if view_box:
+        # One given dimension keeps the viewBox aspect ratio
+        if width:
+            return width, width * view_box[1] / view_box[0]
+        if height:
+            return height * view_box[0] / view_box[1], height
+        return view_box
+    return width or DEFAULT_SIZE[0], height or DEFAULT_SIZE[1]
+
+
+def output_size(root: Dict[str, str], resolution: float) -> Tuple[int, int]:
+    """
+    Pixel size of a render at a resolution in DPI (96 draws one pixel per
+    CSS pixel, like -density for ImageMagick), checked against the budget
+    """
+    width, height = intrinsic_size(root)
+    scale = float(resolution) / CSS_DPI
+    pixels = (max(1, math.ceil(width * scale)), max(1, math.ceil(height * scale)))
+    if pixels[0] * pixels[1] > MAX_MEGAPIXELS * 1e6:
+        raise SvgBudgetError(
+            f"SVG render of {pixels[0]}x{pixels[1]} at {resolution} DPI exceeds {MAX_MEGAPIXELS:g} megapixels"
+        )
+    return pixels
+
+
+def reusable(tree: Any) -> bool:
+    """Whether a parsed tree renders the same every time it is drawn"""
+    pending = [tree]
+    while pending:
+        node = pending.pop()
+        if node.tag in MUTATED_TAGS or MUTATED_ATTRIBUTES.intersection(node):
+            return False
+        pending.extend(node.children)
+    return True
+
+
+class SvgRasterizer:
+    """
+    Parses and renders SVG documents. Parsed trees are shared between
+    renders, and a tree is only drawn by one thread at a time.
+    """
+
+    def __init__(self, max_entries: int = None):
+        self.max_entries = max_entries or CACHE_ENTRIES
+        self._trees: 'OrderedDict[str, Tuple[Any, threading.Lock]]' = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def parse(self, data: bytes) -> Tuple[Any, threading.Lock]:
+        """Parsed tree of an SVG source and its render lock, from the cache when possible"""
+        from cairosvg.parser import Tree
+
+        digest = hashlib.sha256(data).hexdigest()
+        with self._lock:
+            entry = self._trees.get(digest)
+            if entry:
+                self._trees.move_to_end(digest)
+                self.hits += 1
+                return entry
+            self.misses += 1
+        # unsafe=False keeps out external files, XML entities and oversized documents
+        entry = (Tree(bytestring=data, unsafe=False), threading.Lock())
+        if not reusable(entry[0]):
+            return entry
+        with self._lock:
+            entry = self._trees.setdefault(digest, entry)
+            while len(self._trees) > self.max_entries:
+                self._trees.popitem(last=False)
+        return entry
+
+    def render(self, data: bytes, resolution: float = 300) -> Any:
+        """Rasterize an SVG source into an RGBA Pillow image"""
+        from cairosvg.surface import PNGSurface
+        from PIL import Image
+
+        width, height = output_size(root_attributes(data), resolution)
+        tree, render_lock = self.parse(data)
+        with render_lock:
+            # Drawing happens in the constructor; the cairo surface is read directly, not encoded as PNG
+            surface = PNGSurface(tree, None, CSS_DPI, output_width=width, output_height=height)
+            surface.cairo.flush()
+            image = Image.frombuffer('RGBA', (surface.cairo.get_width(), surface.cairo.get_height()),
+                                     bytes(surface.cairo.get_data()), 'raw', 'BGRa', surface.cairo.get_stride(), 1)
+            surface.finish()
+        return image
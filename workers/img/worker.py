@@ -1,41 +1,87 @@
 #!/usr/bin/env python3
 """
 Image conversion worker using ImageMagick and libheif
-Handles: JPG ↔ PNG, HEIC → JPG, WEBP → JPG, SVG → PNG, Background removal
+Handles: JPG ↔ PNG, HEIC → JPG, WEBP → JPG, SVG → PNG, JPG/PNG → PDF, Background removal
+PNG and JPEG outputs are written with a named encoder preset (options.preset)
+SVG is rasterized in-process by img.svgraster when CairoSVG is installed
 """
 
+import io
 import os
 import sys
-import json
 import redis
-import boto3
-import subprocess
 import tempfile
 import logging
+import time
 from pathlib import Path
-from typing import Dict, Any
+from typing import Dict, Any, NamedTuple, Optional
 from PIL import Image, ImageOps
 
+from common.aio import AsyncWorkerCore, run_command
+from common.durations import DurationModel
+from common.inmemory import InMemoryPipeline
+from common.prefork import serve
+from common.progress import write_job_status
+from common.registry import converter, dispatch, handler_options
+from common.sniff import probed_units
+from common.storage import open_storage
+from common.tracing import span
+from img import svgraster
+from img.svgraster import SvgBudgetError, SvgRasterizer
+
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+
+class EncoderPreset(NamedTuple):
+    # zlib level 0-9, row filter (0 none ... 4 Paeth, 5 adaptive), 256-colour palette (lossy)
+    png_level: int
+    png_filter: int
+    png_palette: bool
+    # Quality, optimized Huffman tables, progressive scan, chroma subsampling
+    jpeg_quality: int
+    jpeg_optimize: bool
+    jpeg_progressive: bool
+    jpeg_sampling: str
+
+
+# Trade encode CPU for output bytes; quality only drops in 'smallest'
+ENCODER_PRESETS = {
+    'fast': EncoderPreset(1, 0, False, 95, False, False, '4:4:4'),
+    'balanced': EncoderPreset(6, 5, False, 95, True, False, '4:4:4'),
+    'smallest': EncoderPreset(9, 5, True, 85, True, True, '4:2:0')
+}
+DEFAULT_PRESET = os.getenv('IMAGE_ENCODER_PRESET') or 'balanced'
+
+# Pillow's subsampling codes
+JPEG_SUBSAMPLING = {'4:4:4': 0, '4:2:2': 1, '4:2:0': 2}
+
+
 class ImageWorker:
     def __init__(self):
         self.redis_client = redis.Redis.from_url(os.getenv('REDIS_URL', 'redis://localhost:6379'))
-        self.s3_client = boto3.client(
-            's3',
-            endpoint_url=os.getenv('R2_PUBLIC_URL', '').replace('https://', 'https://'),
-            aws_access_key_id=os.getenv('R2_ACCESS_KEY_ID'),
-            aws_secret_access_key=os.getenv('R2_SECRET_ACCESS_KEY'),
-            region_name='auto'
-        )
-        self.bucket_name = os.getenv('R2_BUCKET_NAME', 'aic-files')
+        self.storage = open_storage()
+        
+        # Small inputs of these converters never touch the filesystem
+        self.in_memory = InMemoryPipeline(self, {'jpg-to-png', 'png-to-jpg', 'webp-to-jpg', 'svg-to-png', 'jpg-to-pdf'})
         
+        # In-process SVG renderer with its parse cache; ImageMagick renders SVG without it
+        self.svg = SvgRasterizer() if svgraster.available() else None
+        
+        # Fallback timeouts until the duration model has enough samples
+        self.timeouts = {
+            'image-upscaler': 120,
+            'default': 60
+        }
+        self.durations = DurationModel(self.redis_client)
+    
     def download_file(self, key: str, local_path: str) -> bool:
-        """Download file from R2 storage"""
+        """Download file from storage"""
         try:
-            self.s3_client.download_file(self.bucket_name, key, local_path)
+            with span('download', key=key) as download_span:
+                self.storage.download_file(key, local_path)
+                download_span.set('size', os.path.getsize(local_path))
             logger.info(f"Downloaded {key} to {local_path}")
             return True
         except Exception as e:
@@ -43,41 +89,115 @@ class ImageWorker:
             return False
     
     def upload_file(self, local_path: str, key: str) -> bool:
-        """Upload file to R2 storage"""
+        """Upload file to storage"""
         try:
-            self.s3_client.upload_file(local_path, self.bucket_name, key)
+            with span('upload', key=key, size=os.path.getsize(local_path)):
+                self.storage.upload_file(local_path, key)
             logger.info(f"Uploaded {local_path} to {key}")
             return True
         except Exception as e:
             logger.error(f"Failed to upload {local_path}: {e}")
             return False
     
-    def update_job_status(self, job_id: str, status: str, progress: int = 0, error: str = None):
-        """Update job status in Redis"""
+    def update_job_status(self, job_id: str, status: str, progress: int = 0, error: str = None,
+                          eta: float = None):
+        """Update job status in Redis and publish it as a progress event"""
         job_data = {
             'status': status,
             'progress': progress,
-            'error': error
+            'error': error or ''
         }
-        self.redis_client.hset(f"job:{job_id}", mapping=job_data)
+        if eta is not None:
+            job_data['estimatedTimeRemaining'] = int(round(eta))
+        with span('status.write', status=status, progress=progress):
+            write_job_status(self.redis_client, job_id, job_data)
         logger.info(f"Updated job {job_id}: {status} ({progress}%)")
     
-    def jpg_to_png(self, input_path: str, output_path: str) -> bool:
+    def encoder_preset(self, name: Optional[str]) -> tuple:
+        """Resolve a preset name to (name, settings), falling back to the default"""
+        name = name or DEFAULT_PRESET
+        if name not in ENCODER_PRESETS:
+            logger.warning(f"Unknown encoder preset {name}, using {DEFAULT_PRESET}")
+            name = DEFAULT_PRESET
+        return name, ENCODER_PRESETS[name]
+    
+    def png_output(self, output_path: str, preset: str) -> list:
+        """ImageMagick arguments that write a PNG with a preset's settings"""
+        _, settings = self.encoder_preset(preset)
+        args = [
+            '-define', f'png:compression-level={settings.png_level}',
+            '-define', f'png:compression-filter={settings.png_filter}'
+        ]
+        if settings.png_palette:
+            return args + ['-colors', '256', f'PNG8:{output_path}']
+        return args + [f'PNG:{output_path}']
+    
+    def jpeg_output(self, output_path: str, preset: str) -> list:
+        """ImageMagick arguments that write a JPEG with a preset's settings"""
+        _, settings = self.encoder_preset(preset)
+        return [
+            '-quality', str(settings.jpeg_quality),
+            '-sampling-factor', settings.jpeg_sampling,
+            '-define', f'jpeg:optimize-coding={str(settings.jpeg_optimize).lower()}',
+            '-interlace', 'JPEG' if settings.jpeg_progressive else 'none',
+            f'JPEG:{output_path}'
+        ]
+    
+    def save_png(self, image: Image.Image, output: Any, preset: str):
+        """Write a PNG with Pillow; Pillow picks row filters itself"""
+        _, settings = self.encoder_preset(preset)
+        if settings.png_palette:
+            image = image.quantize(256, method=Image.Quantize.FASTOCTREE) if image.mode == 'RGBA' \
+                else image.convert('RGB').quantize(256)
+        image.save(output, 'PNG', compress_level=settings.png_level)
+    
+    def save_jpeg(self, image: Image.Image, output: Any, preset: str):
+        """Write a JPEG with Pillow"""
+        _, settings = self.encoder_preset(preset)
+        self.flatten_to_rgb(image).save(
+            output, 'JPEG',
+            quality=settings.jpeg_quality,
+            optimize=settings.jpeg_optimize,
+            progressive=settings.jpeg_progressive,
+            subsampling=JPEG_SUBSAMPLING[settings.jpeg_sampling]
+        )
+    
+    def record_encoding(self, job_id: str, converter_type: str, options: Dict[str, Any], input_size: int,
+                        output_size: int, seconds: float):
+        """Store output size and encode time on the job, and per-preset totals for preset converters"""
+        fields = {'outputSize': output_size, 'encodeSeconds': round(seconds, 3)}
+        try:
+            pipe = self.redis_client.pipeline(transaction=False)
+            if 'preset' in handler_options(self, converter_type):
+                preset, _ = self.encoder_preset(options.get('preset'))
+                fields['encoderPreset'] = preset
+                stats_key = f"encoder:{converter_type}:{preset}"
+                pipe.hincrby(stats_key, 'jobs', 1)
+                pipe.hincrby(stats_key, 'inputBytes', input_size)
+                pipe.hincrby(stats_key, 'outputBytes', output_size)
+                pipe.hincrbyfloat(stats_key, 'seconds', round(seconds, 3))
+            pipe.hset(f"job:{job_id}", mapping=fields)
+            pipe.execute()
+        except Exception as e:
+            logger.warning(f"Could not record encoding stats for job {job_id}: {e}")
+    
+    @converter('jpg-to-png', preset=DEFAULT_PRESET)
+    def jpg_to_png(self, input_path: str, output_path: str, preset: str = DEFAULT_PRESET, timeout: int = 60) -> bool:
         """Convert JPG to PNG using ImageMagick"""
         try:
             cmd = [
                 'convert',
                 input_path,
-                '-quality', '100',
-                output_path
+                *self.png_output(output_path, preset)
             ]
-            result = subprocess.run(cmd, capture_output=True, text=True, timeout=60)
+            result = run_command(cmd, timeout=timeout, text=True)
             return result.returncode == 0
         except Exception as e:
             logger.error(f"JPG to PNG conversion error: {e}")
             return False
     
-    def png_to_jpg(self, input_path: str, output_path: str) -> bool:
+    @converter('png-to-jpg', preset=DEFAULT_PRESET)
+    def png_to_jpg(self, input_path: str, output_path: str, preset: str = DEFAULT_PRESET, timeout: int = 60) -> bool:
         """Convert PNG to JPG using ImageMagick"""
         try:
             cmd = [
@@ -85,16 +205,16 @@ class ImageWorker:
                 input_path,
                 '-background', 'white',
                 '-flatten',
-                '-quality', '95',
-                output_path
+                *self.jpeg_output(output_path, preset)
             ]
-            result = subprocess.run(cmd, capture_output=True, text=True, timeout=60)
+            result = run_command(cmd, timeout=timeout, text=True)
             return result.returncode == 0
         except Exception as e:
             logger.error(f"PNG to JPG conversion error: {e}")
             return False
     
-    def heic_to_jpg(self, input_path: str, output_path: str) -> bool:
+    @converter('heic-to-jpg')
+    def heic_to_jpg(self, input_path: str, output_path: str, timeout: int = 60) -> bool:
         """Convert HEIC to JPG using libheif"""
         try:
             cmd = [
@@ -102,44 +222,79 @@ class ImageWorker:
                 input_path,
                 output_path
             ]
-            result = subprocess.run(cmd, capture_output=True, text=True, timeout=60)
+            result = run_command(cmd, timeout=timeout, text=True)
             return result.returncode == 0
         except Exception as e:
             logger.error(f"HEIC to JPG conversion error: {e}")
             return False
     
-    def webp_to_jpg(self, input_path: str, output_path: str) -> bool:
+    @converter('webp-to-jpg', preset=DEFAULT_PRESET)
+    def webp_to_jpg(self, input_path: str, output_path: str, preset: str = DEFAULT_PRESET, timeout: int = 60) -> bool:
         """Convert WEBP to JPG using ImageMagick"""
         try:
             cmd = [
                 'convert',
                 input_path,
-                '-quality', '95',
-                output_path
+                '-background', 'white',
+                '-flatten',
+                *self.jpeg_output(output_path, preset)
             ]
-            result = subprocess.run(cmd, capture_output=True, text=True, timeout=60)
+            result = run_command(cmd, timeout=timeout, text=True)
             return result.returncode == 0
         except Exception as e:
             logger.error(f"WEBP to JPG conversion error: {e}")
             return False
     
-    def svg_to_png(self, input_path: str, output_path: str, resolution: int = 300) -> bool:
-        """Convert SVG to PNG using ImageMagick"""
+    def render_svg(self, data: bytes, output: Any, resolution: int, preset: Optional[str]) -> bool:
+        """
+        Rasterize SVG in-process into output; False when the renderer is
+        missing or fails and ImageMagick should take over. Renders over
+        the pixel budget raise SvgBudgetError.
+        """
+        if not self.svg:
+            return False
         try:
-            cmd = [
-                'convert',
-                '-density', str(resolution),
-                '-background', 'transparent',
-                input_path,
-                output_path
-            ]
-            result = subprocess.run(cmd, capture_output=True, text=True, timeout=60)
+            image = self.svg.render(data, resolution)
+        except SvgBudgetError:
+            raise
+        except Exception as e:
+            logger.warning(f"In-process SVG render failed, using ImageMagick: {e}")
+            return False
+        self.save_png(image, output, preset)
+        return True
+    
+    def svg_command(self, data: bytes, source: str, output: str, resolution: int, preset: Optional[str]) -> list:
+        """ImageMagick command for an SVG, after checking its output size against the pixel budget"""
+        svgraster.output_size(svgraster.root_attributes(data), resolution)
+        return [
+            'convert',
+            '-density', str(resolution),
+            '-background', 'transparent',
+            source,
+            *self.png_output(output, preset)
+        ]
+    
+    @converter('svg-to-png', resolution=300, preset=DEFAULT_PRESET)
+    def svg_to_png(self, input_path: str, output_path: str, resolution: int = 300, preset: str = DEFAULT_PRESET,
+                   timeout: int = 60) -> bool:
+        """Convert SVG to PNG in-process, or with ImageMagick"""
+        try:
+            with open(input_path, 'rb') as f:
+                data = f.read()
+            if self.render_svg(data, output_path, resolution, preset):
+                return True
+            cmd = self.svg_command(data, f'SVG:{input_path}', output_path, resolution, preset)
+            result = run_command(cmd, timeout=timeout, text=True)
             return result.returncode == 0
+        except SvgBudgetError:
+            raise
         except Exception as e:
             logger.error(f"SVG to PNG conversion error: {e}")
             return False
     
-    def remove_background(self, input_path: str, output_path: str) -> bool:
+    @converter('remove-background', preset=DEFAULT_PRESET)
+    def remove_background(self, input_path: str, output_path: str, preset: str = DEFAULT_PRESET,
+                          timeout: int = 60) -> bool:
         """Remove background using ImageMagick (simple approach)"""
         try:
             # This is a simplified background removal
@@ -149,15 +304,16 @@ class ImageWorker:
                 input_path,
                 '-fuzz', '10%',
                 '-transparent', 'white',
-                output_path
+                *self.png_output(output_path, preset)
             ]
-            result = subprocess.run(cmd, capture_output=True, text=True, timeout=60)
+            result = run_command(cmd, timeout=timeout, text=True)
             return result.returncode == 0
         except Exception as e:
             logger.error(f"Background removal error: {e}")
             return False
     
-    def upscale_image(self, input_path: str, output_path: str, scale: int = 2) -> bool:
+    @converter('image-upscaler', scale=2)
+    def upscale_image(self, input_path: str, output_path: str, scale: int = 2, timeout: int = 120) -> bool:
         """Upscale image using ImageMagick"""
         try:
             cmd = [
@@ -168,12 +324,74 @@ class ImageWorker:
                 '-quality', '100',
                 output_path
             ]
-            result = subprocess.run(cmd, capture_output=True, text=True, timeout=120)
+            result = run_command(cmd, timeout=timeout, text=True)
             return result.returncode == 0
         except Exception as e:
             logger.error(f"Image upscaling error: {e}")
             return False
     
+    @converter('jpg-to-pdf', resolution=150)
+    def jpg_to_pdf(self, input_path: str, output_path: str, resolution: int = 150) -> bool:
+        """Wrap a JPG or PNG in a single-page PDF using Pillow"""
+        try:
+            with Image.open(input_path) as image:
+                self.flatten_to_rgb(ImageOps.exif_transpose(image)).save(
+                    output_path, 'PDF', resolution=float(resolution)
+                )
+            return True
+        except Exception as e:
+            logger.error(f"Image to PDF conversion error: {e}")
+            return False
+    
+    def flatten_to_rgb(self, image: Image.Image) -> Image.Image:
+        """Flatten transparency onto a white background for JPEG output"""
+        if image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info):
+            image = image.convert('RGBA')
+            background = Image.new('RGB', image.size, 'white')
+            background.paste(image, mask=image.getchannel('A'))
+            return background
+        return image.convert('RGB')
+    
+    def convert_in_memory(self, converter_type: str, data: bytes, options: Dict[str, Any],
+                          timeout: int = 60) -> Optional[bytes]:
+        """Convert a small image entirely in memory using Pillow or ImageMagick pipes"""
+        try:
+            if converter_type == 'svg-to-png':
+                resolution = options.get('resolution', 300)
+                output = io.BytesIO()
+                if self.render_svg(data, output, resolution, options.get('preset')):
+                    return output.getvalue()
+                cmd = self.svg_command(data, 'svg:-', '-', resolution, options.get('preset'))
+                result = run_command(cmd, timeout=timeout, input=data)
+                return result.stdout if result.returncode == 0 and result.stdout else None
+            
+            output = io.BytesIO()
+            with Image.open(io.BytesIO(data)) as image:
+                if converter_type == 'jpg-to-png':
+                    self.save_png(image, output, options.get('preset'))
+                elif converter_type in ('png-to-jpg', 'webp-to-jpg'):
+                    self.save_jpeg(image, output, options.get('preset'))
+                elif converter_type == 'jpg-to-pdf':
+                    resolution = float(options.get('resolution', 150))
+                    self.flatten_to_rgb(ImageOps.exif_transpose(image)).save(output, 'PDF', resolution=resolution)
+                else:
+                    return None
+            return output.getvalue()
+        except SvgBudgetError:
+            raise
+        except Exception as e:
+            logger.error(f"In-memory {converter_type} conversion error: {e}")
+            return None
+    
+    def measure_input(self, converter_type: str, input_path: str) -> Optional[float]:
+        """Megapixels for the duration model, read from the header without decoding"""
+        try:
+            with Image.open(input_path) as image:
+                width, height = image.size
+            return width * height / 1_000_000
+        except Exception:
+            return None
+    
     def process_job(self, job_data: Dict[str, Any]):
         """Process a conversion job"""
         job_id = job_data['id']
@@ -184,6 +402,24 @@ class ImageWorker:
         
         logger.info(f"Processing job {job_id}: {converter_type}")
         
+        if self.in_memory.qualifies(job_data):
+            def convert(data: bytes, timeout: int) -> Optional[bytes]:
+                return self.convert_in_memory(converter_type, data, options, timeout)
+            
+            def converted(data: bytes, output: bytes, seconds: float):
+                self.record_encoding(job_id, converter_type, options or {}, len(data), len(output), seconds)
+            
+            try:
+                if self.in_memory.run(job_data, convert, converted):
+                    logger.info(f"Job {job_id} completed successfully in memory")
+                    return
+            except SvgBudgetError as e:
+                # The disk path would refuse the same render; fail now with the budget message
+                logger.error(f"Job {job_id} failed: {e}")
+                self.update_job_status(job_id, 'failed', 0, str(e))
+                return
+            logger.info(f"In-memory pipeline failed for job {job_id}, falling back to disk")
+        
         # Create temporary files
         with tempfile.NamedTemporaryFile(delete=False) as input_file:
             input_path = input_file.name
@@ -200,28 +436,32 @@ class ImageWorker:
             # Process conversion
             self.update_job_status(job_id, 'processing', 30)
             
-            success = False
-            if converter_type == 'jpg-to-png':
-                success = self.jpg_to_png(input_path, output_path)
-            elif converter_type == 'png-to-jpg':
-                success = self.png_to_jpg(input_path, output_path)
-            elif converter_type == 'heic-to-jpg':
-                success = self.heic_to_jpg(input_path, output_path)
-            elif converter_type == 'webp-to-jpg':
-                success = self.webp_to_jpg(input_path, output_path)
-            elif converter_type == 'svg-to-png':
-                resolution = options.get('resolution', 300)
-                success = self.svg_to_png(input_path, output_path, resolution)
-            elif converter_type == 'remove-background':
-                success = self.remove_background(input_path, output_path)
-            elif converter_type == 'image-upscaler':
-                scale = options.get('scale', 2)
-                success = self.upscale_image(input_path, output_path, scale)
-            else:
-                raise Exception(f"Unknown converter type: {converter_type}")
+            input_size = os.path.getsize(input_path)
+            # The core's header probe spares a second look at the file
+            units = probed_units(job_data)
+            if units is None:
+                units = self.measure_input(converter_type, input_path)
+            timeout = self.durations.timeout_for(
+                converter_type, input_size, units, self.timeouts.get(converter_type, self.timeouts['default'])
+            )
+            expected = self.durations.estimate(converter_type, input_size, units)
+            budget = f"expected {expected:.1f}s" if expected is not None else "no duration model yet"
+            logger.info(f"Job {job_id} budget: timeout {timeout}s, {budget}")
+            
+            def report_progress(progress: int, eta: Optional[float]):
+                self.update_job_status(job_id, 'processing', progress, eta=eta)
+            
+            convert_start = time.time()
+            with span('convert', tool=converter_type, size=input_size, units=units, timeout=timeout), \
+                    self.durations.track(expected, timeout, report_progress):
+                success = dispatch(self, converter_type, input_path, output_path, options, timeout=timeout)
             
             if not success:
                 raise Exception("Conversion failed")
+            convert_seconds = time.time() - convert_start
+            self.durations.record(converter_type, input_size, units, convert_seconds)
+            self.record_encoding(job_id, converter_type, options or {}, input_size, os.path.getsize(output_path),
+                                 convert_seconds)
             
             # Upload output file
             self.update_job_status(job_id, 'uploading', 80)
@@ -231,7 +471,7 @@ class ImageWorker:
             # Mark as completed
             self.update_job_status(job_id, 'completed', 100)
             logger.info(f"Job {job_id} completed successfully")
-            
+        
         except Exception as e:
             logger.error(f"Job {job_id} failed: {e}")
             self.update_job_status(job_id, 'failed', 0, str(e))
@@ -247,25 +487,7 @@ class ImageWorker:
     def run(self):
         """Main worker loop"""
         logger.info("Image worker started")
-        
-        while True:
-            try:
-                # Get job from queue
-                job_data = self.redis_client.blpop('img_queue', timeout=10)
-                if job_data:
-                    job_json = job_data[1].decode('utf-8')
-                    job_data = json.loads(job_json)
-                    self.process_job(job_data)
-                else:
-                    logger.debug("No jobs in queue, waiting...")
-                    
-            except KeyboardInterrupt:
-                logger.info("Worker shutting down...")
-                break
-            except Exception as e:
-                logger.error(f"Worker error: {e}")
-                continue
+        AsyncWorkerCore(self, 'img_queue').run()
 
 if __name__ == "__main__":
-    worker = ImageWorker()
-    worker.run()
+    serve(ImageWorker, 'img_queue')
@@ -1,19 +1,21 @@
 #!/usr/bin/env python3
 """
 File cleanup worker (Janitor)
-Automatically deletes old files from R2 storage and cleans up Redis job data
+Automatically deletes old files from storage and cleans up Redis job data
 """
 
 import os
 import sys
 import json
 import redis
-import boto3
 import logging
 import time
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 from typing import Dict, Any, List
 
+from common.progress import events_key
+from common.storage import open_storage
+
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -21,14 +23,7 @@ logger = logging.getLogger(__name__)
 class JanitorWorker:
     def __init__(self):
         self.redis_client = redis.Redis.from_url(os.getenv('REDIS_URL', 'redis://localhost:6379'))
-        self.s3_client = boto3.client(
-            's3',
-            endpoint_url=os.getenv('R2_PUBLIC_URL', '').replace('https://', 'https://'),
-            aws_access_key_id=os.getenv('R2_ACCESS_KEY_ID'),
-            aws_secret_access_key=os.getenv('R2_SECRET_ACCESS_KEY'),
-            region_name='auto'
-        )
-        self.bucket_name = os.getenv('R2_BUCKET_NAME', 'aic-files')
+        self.storage = open_storage()
         self.retention_hours = int(os.getenv('FILE_RETENTION_HOURS', '1'))  # Default 1 hour
         
     def get_expired_jobs(self) -> List[str]:
@@ -52,8 +47,11 @@ class JanitorWorker:
                 created_at = job_data.get(b'createdAt', b'').decode('utf-8')
                 if created_at:
                     try:
-                        created_time = datetime.fromisoformat(created_at)
-                        if datetime.now() - created_time > timedelta(hours=self.retention_hours):
+                        # The web tier writes UTC timestamps ending in 'Z'
+                        created_time = datetime.fromisoformat(created_at.replace('Z', '+00:00'))
+                        if created_time.tzinfo is None:
+                            created_time = created_time.replace(tzinfo=timezone.utc)
+                        if datetime.now(timezone.utc) - created_time > timedelta(hours=self.retention_hours):
                             job_id = job_key.decode('utf-8').replace('job:', '')
                             expired_jobs.append(job_id)
                     except ValueError:
@@ -65,6 +63,13 @@ class JanitorWorker:
             logger.error(f"Error getting expired jobs: {e}")
             return []
     
+    def extra_output_keys(self, job_data: Dict[bytes, bytes]) -> List[str]:
+        """Storage keys of a multi-output job's outputs (outputKeys, a JSON list)"""
+        try:
+            return [key for key in json.loads(job_data.get(b'outputKeys', b'[]')) if key]
+        except ValueError:
+            return []
+    
     def cleanup_job_data(self, job_id: str) -> bool:
         """Clean up Redis data for a job"""
         try:
@@ -77,22 +82,23 @@ class JanitorWorker:
             input_key = job_data.get(b'inputKey', b'').decode('utf-8')
             output_key = job_data.get(b'outputKey', b'').decode('utf-8')
             
-            # Delete files from R2 storage
+            # Delete files from storage
             files_to_delete = []
             if input_key:
                 files_to_delete.append(input_key)
             if output_key:
                 files_to_delete.append(output_key)
+            files_to_delete.extend(key for key in self.extra_output_keys(job_data) if key != output_key)
             
             for file_key in files_to_delete:
                 try:
-                    self.s3_client.delete_object(Bucket=self.bucket_name, Key=file_key)
+                    self.storage.delete(file_key)
                     logger.info(f"Deleted file from storage: {file_key}")
                 except Exception as e:
                     logger.error(f"Failed to delete file {file_key}: {e}")
             
             # Delete job data from Redis
-            self.redis_client.delete(f'job:{job_id}')
+            self.redis_client.delete(f'job:{job_id}', events_key(job_id))
             logger.info(f"Cleaned up job data: {job_id}")
             
             return True
@@ -104,11 +110,6 @@ class JanitorWorker:
     def cleanup_orphaned_files(self):
         """Clean up files in storage that don't have corresponding job data"""
         try:
-            # List all files in bucket
-            response = self.s3_client.list_objects_v2(Bucket=self.bucket_name)
-            if 'Contents' not in response:
-                return
-            
             # Get all job keys from Redis
             job_keys = self.redis_client.keys('job:*')
             active_files = set()
@@ -122,16 +123,17 @@ class JanitorWorker:
                     active_files.add(input_key)
                 if output_key:
                     active_files.add(output_key)
+                active_files.update(self.extra_output_keys(job_data))
             
-            # Delete orphaned files
-            for obj in response['Contents']:
-                file_key = obj['Key']
+            # Delete orphaned files (listed after the job scan, so new uploads are too young to go)
+            for obj in self.storage.list():
+                file_key = obj.key
                 if file_key not in active_files:
                     # Check if file is old enough
-                    file_age = datetime.now() - obj['LastModified'].replace(tzinfo=None)
+                    file_age = datetime.now(timezone.utc) - obj.last_modified
                     if file_age > timedelta(hours=self.retention_hours):
                         try:
-                            self.s3_client.delete_object(Bucket=self.bucket_name, Key=file_key)
+                            self.storage.delete(file_key)
                             logger.info(f"Deleted orphaned file: {file_key}")
                         except Exception as e:
                             logger.error(f"Failed to delete orphaned file {file_key}: {e}")
@@ -0,0 +1,655 @@
+#!/usr/bin/env python3
+"""
+Queue load simulator
+Pushes a configurable mix of jobs, in the same ConversionJob shape the web
+tier creates, into a local Redis. The real worker processes (async core,
+process_job, optional work-stealing peers) run against a filesystem stand-in
+for R2, or against the local storage backend. Converters are either stubbed
+with sleep/CPU-spin subprocesses timed by cost class, or the real tools fed
+with sample files. Reports throughput, latency percentiles, queue growth and
+the offered rate at which the system saturates.
+
+    cd workers
+    python -m loadsim --mix jpg-to-png=5,pdf-to-docx=1,mp4-to-mp3=2 --rate 10 --duration 60
+"""
+
+import io
+import os
+import sys
+import json
+import time
+import uuid
+import random
+import shutil
+import signal
+import logging
+import argparse
+import tempfile
+import importlib
+import threading
+import multiprocessing
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional, Tuple
+
+import redis
+from botocore.exceptions import ClientError
+
+from common.registry import CONVERTERS, QUEUES, Peer, capabilities, handlers
+from common.storage import LocalStorage, S3Storage
+
+logger = logging.getLogger('loadsim')
+
+# Mean stub conversion time per cost class, plus a per-MB term
+STUB_SECONDS = {'light': 0.2, 'medium': 1.0, 'heavy': 3.0}
+STUB_SECONDS_PER_MB = 0.05
+
+# Busy loop for --stub-cpu so stubs contend for cores like real converters
+SPIN_SCRIPT = "import sys, time\nend = time.time() + float(sys.argv[1])\nwhile time.time() < end: pass"
+
+
+class FilesystemS3:
+    """Stand-in for the boto3 S3 client that keeps objects under a local directory"""
+
+    def __init__(self, root: str, latency: float = 0.0, bandwidth: float = 0.0):
+        self.root = root
+        self.latency = latency
+        # Bytes per second, 0 = unlimited
+        self.bandwidth = bandwidth
+
+    def _path(self, bucket: str, key: str) -> str:
+        return os.path.join(self.root, bucket, key)
+
+    def _transfer(self, size: int = 0):
+        """Simulate request latency and limited bandwidth"""
+        delay = self.latency + (size / self.bandwidth if self.bandwidth else 0)
+        if delay > 0:
+            time.sleep(delay)
+
+    def _existing(self, bucket: str, key: str, operation: str) -> str:
+        path = self._path(bucket, key)
+        if not os.path.exists(path):
+            raise ClientError({'Error': {'Code': '404', 'Message': 'Not Found'}}, operation)
+        return path
+
+    def _prepare(self, bucket: str, key: str) -> str:
+        path = self._path(bucket, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return path
+
+    def download_file(self, Bucket: str, Key: str, Filename: str):
+        path = self._existing(Bucket, Key, 'GetObject')
+        self._transfer(os.path.getsize(path))
+        shutil.copyfile(path, Filename)
+
+    def upload_file(self, Filename: str, Bucket: str, Key: str):
+        self._transfer(os.path.getsize(Filename))
+        # Write then rename so readers never see a partial object
+        path = self._prepare(Bucket, Key)
+        shutil.copyfile(Filename, path + '.part')
+        os.replace(path + '.part', path)
+
+    def download_fileobj(self, Bucket: str, Key: str, Fileobj: Any):
+        path = self._existing(Bucket, Key, 'GetObject')
+        self._transfer(os.path.getsize(path))
+        with open(path, 'rb') as f:
+            shutil.copyfileobj(f, Fileobj)
+
+    def upload_fileobj(self, Fileobj: Any, Bucket: str, Key: str):
+        path = self._prepare(Bucket, Key)
+        with open(path + '.part', 'wb') as f:
+            shutil.copyfileobj(Fileobj, f)
+        self._transfer(os.path.getsize(path + '.part'))
+        os.replace(path + '.part', path)
+
+    def head_object(self, Bucket: str, Key: str) -> Dict[str, Any]:
+        path = self._existing(Bucket, Key, 'HeadObject')
+        self._transfer()
+        stat = os.stat(path)
+        return {
+            'ContentLength': stat.st_size,
+            'LastModified': datetime.fromtimestamp(stat.st_mtime, timezone.utc),
+            'ETag': f'"{stat.st_ino:x}-{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+        }
+
+    def get_object(self, Bucket: str, Key: str, Range: str = None) -> Dict[str, Any]:
+        path = self._existing(Bucket, Key, 'GetObject')
+        with open(path, 'rb') as f:
+            if Range:
+                start, end = Range.split('=', 1)[1].split('-')
+                f.seek(int(start))
+                data = f.read(int(end) - int(start) + 1)
+            else:
+                data = f.read()
+        self._transfer(len(data))
+        return {'Body': io.BytesIO(data), 'ContentLength': len(data)}
+
+    def create_multipart_upload(self, Bucket: str, Key: str) -> Dict[str, Any]:
+        self._transfer()
+        upload_id = uuid.uuid4().hex
+        os.makedirs(self._path(Bucket, f".uploads/{upload_id}"))
+        return {'UploadId': upload_id}
+
+    def upload_part(self, Bucket: str, Key: str, UploadId: str, PartNumber: int, Body: bytes) -> Dict[str, Any]:
+        self._transfer(len(Body))
+        with open(self._path(Bucket, f".uploads/{UploadId}/{PartNumber:05d}"), 'wb') as f:
+            f.write(Body)
+        return {'ETag': f'"{UploadId}-{PartNumber}"'}
+
+    def complete_multipart_upload(self, Bucket: str, Key: str, UploadId: str, MultipartUpload: Dict[str, Any]):
+        self._transfer()
+        parts_dir = self._path(Bucket, f".uploads/{UploadId}")
+        path = self._prepare(Bucket, Key)
+        with open(path + '.part', 'wb') as out:
+            for part in MultipartUpload['Parts']:
+                with open(os.path.join(parts_dir, f"{part['PartNumber']:05d}"), 'rb') as f:
+                    shutil.copyfileobj(f, out)
+        os.replace(path + '.part', path)
+        shutil.rmtree(parts_dir)
+
+    def abort_multipart_upload(self, Bucket: str, Key: str, UploadId: str):
+        self._transfer()
+        shutil.rmtree(self._path(Bucket, f".uploads/{UploadId}"), ignore_errors=True)
+
+    def delete_object(self, Bucket: str, Key: str):
+        self._transfer()
+        try:
+            os.unlink(self._path(Bucket, Key))
+        except FileNotFoundError:
+            pass
+
+    def list_objects_v2(self, Bucket: str, Prefix: str = '', **kwargs) -> Dict[str, Any]:
+        self._transfer()
+        base = os.path.join(self.root, Bucket)
+        contents = []
+        for directory, _, files in os.walk(base):
+            for name in files:
+                path = os.path.join(directory, name)
+                key = os.path.relpath(path, base)
+                if key.startswith(Prefix) and not key.endswith('.part'):
+                    stat = os.stat(path)
+                    contents.append({
+                        'Key': key,
+                        'Size': stat.st_size,
+                        'LastModified': datetime.fromtimestamp(stat.st_mtime, timezone.utc)
+                    })
+        return {'Contents': contents} if contents else {}
+
+
+def make_stub(method: Any, spec: Any, scale: float, spin: bool) -> Any:
+    """Replacement handler that takes about as long as the converter's cost class suggests"""
+    from common.aio import run_command
+
+    def stub(input_path: str, output_path: str, timeout: int = 300, **options) -> bool:
+        size_mb = os.path.getsize(input_path) / (1024 * 1024)
+        mean = (STUB_SECONDS[spec.cost] + STUB_SECONDS_PER_MB * size_mb) * scale
+        seconds = random.lognormvariate(0, 0.3) * mean
+        cmd = [sys.executable, '-c', SPIN_SCRIPT, f'{seconds:.3f}'] if spin else ['sleep', f'{seconds:.3f}']
+        result = run_command(cmd, timeout=timeout)
+        if result.returncode != 0:
+            return False
+        shutil.copyfile(input_path, output_path)
+        return True
+
+    stub.converter_name = method.converter_name
+    stub.converter_options = method.converter_options
+    stub.converter_params = {'timeout'}
+    return stub
+
+
+def open_sim_storage(args: argparse.Namespace, root: str) -> Any:
+    """Storage backend of the simulation, rooted in its scratch directory"""
+    if args.storage == 'local':
+        return LocalStorage(root)
+    bandwidth = args.s3_bandwidth_mbps * 1024 * 1024 / 8
+    return S3Storage(FilesystemS3(root, args.s3_latency_ms / 1000, bandwidth), 'loadsim')
+
+
+def build_worker(queue: str, storage: Any, stub: bool, scale: float, spin: bool) -> Any:
+    """Construct the real worker of a queue wired to the simulation's storage"""
+    entry = QUEUES[queue]
+    worker_class = getattr(importlib.import_module(entry['module']), entry['worker'])
+    worker = worker_class()
+    worker.storage = storage
+    if stub:
+        # Stubs replace the disk handlers; the in-memory paths would bypass them
+        worker.in_memory.threshold = 0
+        for name, method_name in handlers(worker_class).items():
+            method = getattr(worker_class, method_name)
+            setattr(worker, method_name, make_stub(method, CONVERTERS[name], scale, spin))
+    return worker
+
+
+def worker_process(queue: str, args: argparse.Namespace, storage_root: str):
+    """Entry point of a forked worker process running the real async core"""
+    os.environ['REDIS_URL'] = args.redis_url
+    os.environ.setdefault('R2_PUBLIC_URL', 'http://localhost:9000')
+    if not args.real:
+        # Stub inputs are random bytes, which input sniffing would reject as mislabelled;
+        # set before common.aio is imported, as common.sniff reads it at import
+        os.environ['INPUT_SNIFF'] = 'off'
+
+    from common.aio import AsyncWorkerCore
+
+    storage = open_sim_storage(args, storage_root)
+    worker = build_worker(queue, storage, not args.real, args.stub_scale, args.stub_cpu)
+    logging.getLogger().setLevel(args.worker_log_level)
+
+    peers = {}
+    if args.steal:
+        for other in QUEUES:
+            if other == queue:
+                continue
+            peer = build_worker(other, storage, not args.real, args.stub_scale, args.stub_cpu)
+            converters = handlers(type(peer)) if not args.real else capabilities(type(peer))
+            if converters:
+                peers[other] = Peer(peer, frozenset(converters))
+
+    AsyncWorkerCore(worker, queue, peers=peers).run()
+
+
+class JobTracker:
+    """Follows submitted jobs through their status hashes"""
+
+    def __init__(self, client: redis.Redis):
+        self.client = client
+        self.jobs: Dict[str, Dict[str, Any]] = {}
+        self.lock = threading.Lock()
+
+    def add(self, job_id: str, converter: str, queue: str, created: float, stage: int):
+        with self.lock:
+            self.jobs[job_id] = {
+                'converter': converter,
+                'queue': queue,
+                'created': created,
+                'stage': stage,
+                'started': None,
+                'finished': None,
+                'status': 'pending'
+            }
+
+    def outstanding(self) -> List[str]:
+        with self.lock:
+            return [job_id for job_id, job in self.jobs.items() if job['finished'] is None]
+
+    def poll(self):
+        """Record when each outstanding job was picked up and when it finished"""
+        job_ids = self.outstanding()
+        if not job_ids:
+            return
+        pipe = self.client.pipeline(transaction=False)
+        for job_id in job_ids:
+            pipe.hget(f"job:{job_id}", 'status')
+        statuses = pipe.execute()
+        now = time.time()
+        with self.lock:
+            for job_id, raw in zip(job_ids, statuses):
+                status = raw.decode('utf-8') if raw else 'pending'
+                job = self.jobs[job_id]
+                job['status'] = status
+                if status != 'pending' and job['started'] is None:
+                    job['started'] = now
+                if status in ('completed', 'failed'):
+                    job['finished'] = now
+
+
+def percentile(values: List[float], pct: float) -> float:
+    """Nearest-rank percentile, 0 for an empty list"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(pct / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def summarize(values: List[float]) -> Dict[str, float]:
+    return {
+        'p50': round(percentile(values, 50), 3),
+        'p90': round(percentile(values, 90), 3),
+        'p99': round(percentile(values, 99), 3),
+        'max': round(max(values), 3) if values else 0.0
+    }
+
+
+class LoadSimulator:
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        self.client = redis.Redis.from_url(args.redis_url)
+        self.mix = self.parse_mix(args.mix)
+        self.queues = sorted({CONVERTERS[name].queue for name in self.mix} | set(self.parse_workers(args.workers)))
+        self.workers = self.parse_workers(args.workers) or {queue: 1 for queue in self.queues}
+        self.storage_root = tempfile.mkdtemp(prefix='loadsim-storage-')
+        # Inputs are staged without the simulated latency
+        self.storage = LocalStorage(self.storage_root) if args.storage == 'local' else \
+            S3Storage(FilesystemS3(self.storage_root), 'loadsim')
+        self.tracker = JobTracker(self.client)
+        self.samples = self.load_samples(args.samples) if args.real else {}
+
+        self.depth_series: List[Tuple[float, Dict[str, int]]] = []
+        self.janitor_cycles: List[Tuple[float, float]] = []
+        self.stages: List[Tuple[float, float]] = []  # (start time, offered rate)
+        self.processes: List[multiprocessing.Process] = []
+        self.stop_event = threading.Event()
+
+    def parse_mix(self, mix: str) -> Dict[str, float]:
+        weights = {}
+        for part in mix.split(','):
+            name, _, weight = part.partition('=')
+            name = name.strip()
+            if name not in CONVERTERS:
+                raise SystemExit(f"Unknown converter in mix: {name}")
+            weights[name] = float(weight or 1)
+        return weights
+
+    def parse_workers(self, workers: Optional[str]) -> Dict[str, int]:
+        counts = {}
+        for part in (workers or '').split(','):
+            if not part:
+                continue
+            name, _, count = part.partition('=')
+            queue = name if name.endswith('_queue') else f"{name}_queue"
+            if queue not in QUEUES:
+                raise SystemExit(f"Unknown queue in --workers: {name}")
+            counts[queue] = int(count or 1)
+        return counts
+
+    def load_samples(self, directory: Optional[str]) -> Dict[str, str]:
+        """Sample input per converter for real runs, matched by file extension"""
+        if not directory:
+            raise SystemExit("--real needs --samples DIR with an input file per format")
+        by_format = {}
+        for name in os.listdir(directory):
+            fmt = os.path.splitext(name)[1].lstrip('.').lower()
+            by_format.setdefault(fmt, os.path.join(directory, name))
+        samples = {}
+        for name in self.mix:
+            found = [by_format[fmt] for fmt in CONVERTERS[name].inputs if fmt in by_format]
+            if not found:
+                raise SystemExit(f"No sample in {directory} for {name} ({', '.join(CONVERTERS[name].inputs)})")
+            samples[name] = found[0]
+        return samples
+
+    def stage_rate(self, elapsed: float) -> Tuple[int, float]:
+        """Ramp stage index and offered job rate at a point of the run"""
+        if not self.args.ramp:
+            return 0, self.args.rate
+        start, step, every = (float(x) for x in self.args.ramp.split(':'))
+        stage = int(elapsed // every)
+        return stage, start + stage * step
+
+    def create_job(self, converter: str, stage: int):
+        """Upload an input and enqueue a job exactly as the web tier's createJob does"""
+        spec = CONVERTERS[converter]
+        source = spec.inputs[0] if spec.inputs else 'bin'
+        input_key = f"input/{uuid.uuid4()}.{source}"
+        output_key = f"output/{uuid.uuid4()}.{spec.output_format(source)}"
+
+        if self.args.real:
+            self.storage.upload_file(self.samples[converter], input_key)
+        else:
+            size = int(random.lognormvariate(0, 0.5) * self.args.size_kb * 1024)
+            self.storage.upload_fileobj(io.BytesIO(os.urandom(max(size, 1))), input_key)
+
+        job_id = str(uuid.uuid4())
+        created = time.time()
+        job = {
+            'id': job_id,
+            'converter': converter,
+            'inputKey': input_key,
+            'outputKey': output_key,
+            'options': {},
+            'createdAt': datetime.fromtimestamp(created, timezone.utc).isoformat(timespec='milliseconds')
+                         .replace('+00:00', 'Z'),
+            'status': 'pending',
+            'progress': 0
+        }
+        self.client.hset(f"job:{job_id}", mapping=dict(job, options=json.dumps(job['options'])))
+        self.client.lpush(spec.queue, json.dumps(job))
+        self.tracker.add(job_id, converter, spec.queue, created, stage)
+
+    def submit(self):
+        """Offer jobs as a Poisson process (or one burst) for the configured duration"""
+        names = list(self.mix)
+        weights = [self.mix[name] for name in names]
+
+        if self.args.burst:
+            self.stages.append((time.time(), 0.0))
+            for _ in range(self.args.burst):
+                self.create_job(random.choices(names, weights)[0], 0)
+            return
+
+        started = time.time()
+        current_stage = -1
+        next_at = started
+        while True:
+            now = time.time()
+            elapsed = now - started
+            if elapsed >= self.args.duration:
+                break
+            stage, rate = self.stage_rate(elapsed)
+            if stage != current_stage:
+                current_stage = stage
+                self.stages.append((now, rate))
+                logger.info(f"Offering {rate:g} jobs/s")
+            if now < next_at:
+                time.sleep(min(next_at - now, 0.05))
+                continue
+            self.create_job(random.choices(names, weights)[0], stage)
+            next_at += random.expovariate(rate) if rate > 0 else self.args.duration
+
+    def monitor(self):
+        """Poll job statuses and queue depths until stopped"""
+        while not self.stop_event.is_set():
+            try:
+                self.tracker.poll()
+                pipe = self.client.pipeline(transaction=False)
+                for queue in self.queues:
+                    pipe.llen(queue)
+                self.depth_series.append((time.time(), dict(zip(self.queues, pipe.execute()))))
+            except redis.RedisError as e:
+                logger.warning(f"Monitor poll failed: {e}")
+            self.stop_event.wait(self.args.poll_interval)
+
+    def run_janitor(self):
+        """Run janitor cleanup cycles against the same Redis and storage"""
+        from janitor.worker import JanitorWorker
+        janitor = JanitorWorker()
+        janitor.redis_client = redis.Redis.from_url(self.args.redis_url)
+        janitor.storage = self.storage
+        while not self.stop_event.wait(self.args.janitor_interval):
+            started = time.time()
+            janitor.run_cleanup_cycle()
+            self.janitor_cycles.append((started, time.time()))
+
+    def start_workers(self):
+        context = multiprocessing.get_context('fork')
+        for queue, count in self.workers.items():
+            for _ in range(count):
+                process = context.Process(target=worker_process, args=(queue, self.args, self.storage_root), daemon=True)
+                process.start()
+                self.processes.append(process)
+        logger.info(f"Started {len(self.processes)} worker processes: "
+                    + ', '.join(f"{queue}×{count}" for queue, count in self.workers.items()))
+
+    def stop_workers(self):
+        for process in self.processes:
+            if process.is_alive():
+                os.kill(process.pid, signal.SIGTERM)
+        for process in self.processes:
+            process.join(timeout=30)
+            if process.is_alive():
+                process.kill()
+
+    def run(self) -> Dict[str, Any]:
+        # Start from empty queues so leftovers don't skew the numbers
+        for queue in QUEUES:
+            self.client.delete(queue, f"{queue}:delayed")
+
+        self.start_workers()
+        monitor = threading.Thread(target=self.monitor, daemon=True)
+        monitor.start()
+        if self.args.janitor_interval > 0:
+            threading.Thread(target=self.run_janitor, daemon=True).start()
+
+        run_started = time.time()
+        try:
+            self.submit()
+            submitted_at = time.time()
+            logger.info(f"Submitted {len(self.tracker.jobs)} jobs, draining...")
+            while self.tracker.outstanding() and time.time() - submitted_at < self.args.drain_timeout:
+                time.sleep(0.5)
+        finally:
+            self.stop_event.set()
+            monitor.join()
+            self.tracker.poll()
+            self.stop_workers()
+            shutil.rmtree(self.storage_root, ignore_errors=True)
+
+        return self.report(run_started)
+
+    def depth_slope(self, start: float, end: float) -> Dict[str, float]:
+        """Average growth (jobs/s) of each queue over a time window"""
+        window = [(t, depths) for t, depths in self.depth_series if start <= t <= end]
+        if len(window) < 2 or window[-1][0] <= window[0][0]:
+            return {queue: 0.0 for queue in self.queues}
+        span = window[-1][0] - window[0][0]
+        return {queue: round((window[-1][1][queue] - window[0][1][queue]) / span, 3) for queue in self.queues}
+
+    def report(self, run_started: float) -> Dict[str, Any]:
+        jobs = list(self.tracker.jobs.values())
+        done = [job for job in jobs if job['finished'] is not None]
+        completed = [job for job in done if job['status'] == 'completed']
+        last_finish = max((job['finished'] for job in done), default=time.time())
+        wall = max(last_finish - run_started, 1e-6)
+
+        result = {
+            'submitted': len(jobs),
+            'completed': len(completed),
+            'failed': len(done) - len(completed),
+            'unfinished': len(jobs) - len(done),
+            'wallSeconds': round(wall, 2),
+            'throughput': round(len(completed) / wall, 3),
+            'latency': summarize([job['finished'] - job['created'] for job in completed]),
+            'queueWait': summarize([job['started'] - job['created'] for job in done if job['started']]),
+            'converters': {},
+            'queues': {},
+            'stages': [],
+            'janitor': {}
+        }
+
+        for name in self.mix:
+            finished = [job for job in completed if job['converter'] == name]
+            result['converters'][name] = dict(
+                summarize([job['finished'] - job['created'] for job in finished]), completed=len(finished)
+            )
+
+        for queue in self.queues:
+            depths = [depths[queue] for _, depths in self.depth_series]
+            result['queues'][queue] = {
+                'maxDepth': max(depths, default=0),
+                'workers': self.workers.get(queue, 0)
+            }
+
+        # Per ramp stage: offered vs. completed rate and whether the queues kept growing
+        for index, (start, rate) in enumerate(self.stages):
+            end = self.stages[index + 1][0] if index + 1 < len(self.stages) else run_started + self.args.duration
+            stage_jobs = [job for job in jobs if job['stage'] == index]
+            finished_in_window = [job for job in completed if start <= job['finished'] < end]
+            slope = self.depth_slope(start, end)
+            result['stages'].append({
+                'offeredRate': rate,
+                'completedRate': round(len(finished_in_window) / max(end - start, 1e-6), 3),
+                'depthGrowth': slope,
+                'p99': summarize([job['finished'] - job['created'] for job in stage_jobs
+                                  if job['finished'] and job['status'] == 'completed'])['p99'],
+                'saturated': sum(slope.values()) > self.args.saturation_growth
+            })
+        saturated = [stage['offeredRate'] for stage in result['stages'] if stage['saturated']]
+        result['saturationRate'] = saturated[0] if saturated and not self.args.burst else None
+
+        if self.janitor_cycles:
+            during = [job['finished'] - job['created'] for job in completed
+                      if any(start <= job['finished'] <= end for start, end in self.janitor_cycles)]
+            result['janitor'] = {
+                'cycles': len(self.janitor_cycles),
+                'cycleSeconds': summarize([end - start for start, end in self.janitor_cycles]),
+                'latencyDuringCycles': summarize(during),
+                'jobsDuringCycles': len(during)
+            }
+        return result
+
+
+def print_report(result: Dict[str, Any]):
+    latency, wait = result['latency'], result['queueWait']
+    print()
+    print(f"Jobs: {result['submitted']} submitted, {result['completed']} completed, "
+          f"{result['failed']} failed, {result['unfinished']} unfinished")
+    print(f"Throughput: {result['throughput']} jobs/s over {result['wallSeconds']}s")
+    print(f"Latency (createJob → completed): p50 {latency['p50']}s  p90 {latency['p90']}s  "
+          f"p99 {latency['p99']}s  max {latency['max']}s")
+    print(f"Queue wait (createJob → picked up): p50 {wait['p50']}s  p99 {wait['p99']}s  max {wait['max']}s")
+
+    print("\nPer converter:")
+    for name, stats in result['converters'].items():
+        print(f"  {name:<20} {stats['completed']:>6} done  p50 {stats['p50']:>7}s  p99 {stats['p99']:>7}s")
+
+    print("\nQueues:")
+    for queue, stats in result['queues'].items():
+        print(f"  {queue:<10} {stats['workers']} worker(s), max depth {stats['maxDepth']}")
+
+    if len(result['stages']) > 1 or result['saturationRate'] is not None:
+        print("\nStages:")
+        for stage in result['stages']:
+            growth = sum(stage['depthGrowth'].values())
+            flag = '  SATURATED' if stage['saturated'] else ''
+            print(f"  offered {stage['offeredRate']:>6g}/s  completed {stage['completedRate']:>7}/s  "
+                  f"queue growth {growth:+.2f}/s  p99 {stage['p99']}s{flag}")
+        if result['saturationRate'] is not None:
+            print(f"Saturates at about {result['saturationRate']:g} jobs/s offered")
+
+    if result['janitor']:
+        janitor = result['janitor']
+        print(f"\nJanitor: {janitor['cycles']} cycles, p50 {janitor['cycleSeconds']['p50']}s each; "
+              f"p99 latency of {janitor['jobsDuringCycles']} jobs finishing during a cycle: "
+              f"{janitor['latencyDuringCycles']['p99']}s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Simulate queue load against the real workers')
+    parser.add_argument('--redis-url', default=os.getenv('LOADSIM_REDIS_URL', 'redis://localhost:6379/15'),
+                        help='Redis to use; a separate database keeps the simulation away from real queues')
+    parser.add_argument('--mix', default='jpg-to-png=4,pdf-to-txt=2,mp4-to-mp3=1',
+                        help='converter=weight list')
+    parser.add_argument('--workers', help='processes per queue, e.g. doc=2,img=1,av=1 (default: 1 per queue in the mix)')
+    parser.add_argument('--rate', type=float, default=5.0, help='offered jobs per second')
+    parser.add_argument('--ramp', help='START:STEP:EVERY, raise the rate by STEP every EVERY seconds')
+    parser.add_argument('--burst', type=int, default=0, help='push this many jobs at once instead of a steady rate')
+    parser.add_argument('--duration', type=float, default=60.0, help='seconds to offer load')
+    parser.add_argument('--drain-timeout', type=float, default=300.0, help='seconds to wait for the backlog afterwards')
+    parser.add_argument('--size-kb', type=float, default=512.0, help='median stub input size')
+    parser.add_argument('--real', action='store_true', help='run the real converters on sample inputs')
+    parser.add_argument('--samples', help='directory with one sample input per format, for --real')
+    parser.add_argument('--stub-scale', type=float, default=1.0, help='multiply stub conversion times')
+    parser.add_argument('--stub-cpu', action='store_true', help='stubs spin a core instead of sleeping')
+    parser.add_argument('--steal', action='store_true', help='let workers take jobs from other queues')
+    parser.add_argument('--storage', choices=['s3', 'local'], default='s3',
+                        help='s3: the S3 backend over a filesystem stand-in; local: the local storage backend')
+    parser.add_argument('--s3-latency-ms', type=float, default=0.0, help='added latency per storage request')
+    parser.add_argument('--s3-bandwidth-mbps', type=float, default=0.0, help='storage bandwidth limit (0 = unlimited)')
+    parser.add_argument('--janitor-interval', type=float, default=0.0, help='run a janitor cycle every N seconds')
+    parser.add_argument('--saturation-growth', type=float, default=0.5,
+                        help='queue growth (jobs/s) above which a stage counts as saturated')
+    parser.add_argument('--poll-interval', type=float, default=0.2, help='status polling interval')
+    parser.add_argument('--worker-log-level', default='WARNING', help='log level inside worker processes')
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(name)s %(message)s')
+    result = LoadSimulator(args).run()
+    print_report(result)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()